@@ -0,0 +1,243 @@
+"""Архив реплик диалогов: сжатые блоки по пользователям, только дописывание.
+
+Реплики (роль, текст, режим, время) копятся в памяти по пользователям и пишутся одним
+блоком, сжатым zlib, когда у пользователя набралось `chunk_turns` реплик или самой старой
+из них исполнилось `max_age` секунд (и при остановке). Запись — одна вставка строки на блок,
+уже записанные блоки не переписываются.
+
+У каждого блока в строке лежат время первой и последней реплики и число реплик, поэтому
+постраничное чтение и выборка по времени распаковывают только нужные блоки, от новых
+к старым. На пользователя хранится не больше `max_user_bytes` сжатых данных: при
+превышении самые старые блоки удаляются в той же транзакции.
+"""
+import asyncio
+import json
+import logging
+import time
+import zlib
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversation_chunks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    first_at REAL NOT NULL,
+    last_at REAL NOT NULL,
+    turns INTEGER NOT NULL,
+    raw_bytes INTEGER NOT NULL,
+    stored_bytes INTEGER NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_conversation_chunks_user ON conversation_chunks (user_id, last_at);
+"""
+
+# Сколько блоков читать из БД за раз при постраничном чтении
+READ_BATCH = 8
+
+
+def create_schema(conn):
+    conn.executescript(SCHEMA)
+
+
+def encode_chunk(turns: list, level: int = 6) -> tuple:
+    """Возвращает (сжатые данные, размер до сжатия)."""
+    raw = json.dumps(turns, ensure_ascii=False, separators=(",", ":")).encode()
+    return zlib.compress(raw, level), len(raw)
+
+
+def decode_chunk(data: bytes) -> list:
+    return json.loads(zlib.decompress(data))
+
+
+def write_chunks(conn, chunks, max_user_bytes: int) -> int:
+    """Дописывает блоки [(user_id, turns, data, raw_bytes)] и укладывает пользователей в бюджет.
+
+    Возвращает число удалённых старых блоков. Самый новый блок пользователя не удаляется,
+    даже если он один больше бюджета."""
+    conn.executemany(
+        "INSERT INTO conversation_chunks (user_id, first_at, last_at, turns, raw_bytes, stored_bytes, data) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        ((user_id, turns[0]["t"], turns[-1]["t"], len(turns), raw_bytes, len(data), data)
+         for user_id, turns, data, raw_bytes in chunks)
+    )
+    trimmed = 0
+    for user_id in {chunk[0] for chunk in chunks}:
+        rows = conn.execute(
+            "SELECT id, stored_bytes FROM conversation_chunks WHERE user_id = ? ORDER BY id DESC", (user_id,)
+        ).fetchall()
+        total = 0
+        for index, (chunk_id, stored_bytes) in enumerate(rows):
+            total += stored_bytes
+            if total > max_user_bytes and index > 0:
+                expired = [(old_id,) for old_id, _ in rows[index:]]
+                conn.executemany("DELETE FROM conversation_chunks WHERE id = ?", expired)
+                trimmed += len(expired)
+                break
+    return trimmed
+
+
+def read_chunks(conn, user_id: int, before_id: int = None, start: float = None, end: float = None,
+                limit: int = READ_BATCH) -> list:
+    """Блоки пользователя от новых к старым: [(id, data)], пересекающиеся с [start, end)."""
+    conditions, params = ["user_id = ?"], [user_id]
+    if before_id is not None:
+        conditions.append("id < ?")
+        params.append(before_id)
+    if start is not None:
+        conditions.append("last_at >= ?")
+        params.append(start)
+    if end is not None:
+        conditions.append("first_at < ?")
+        params.append(end)
+    return conn.execute(
+        f"SELECT id, data FROM conversation_chunks WHERE {' AND '.join(conditions)} ORDER BY id DESC LIMIT ?",
+        (*params, limit)
+    ).fetchall()
+
+
+def user_usage(conn, user_id: int) -> tuple:
+    """(блоков, реплик, байт до сжатия, байт в БД) пользователя."""
+    return conn.execute(
+        "SELECT COUNT(*), COALESCE(SUM(turns), 0), COALESCE(SUM(raw_bytes), 0), COALESCE(SUM(stored_bytes), 0) "
+        "FROM conversation_chunks WHERE user_id = ?",
+        (user_id,)
+    ).fetchone()
+
+
+def parse_cursor(cursor: str) -> tuple:
+    """Курсор страницы «id блока:позиция» — следующая страница начинается с реплики перед позицией."""
+    chunk_id, _, position = cursor.partition(":")
+    return int(chunk_id), int(position)
+
+
+class ConversationArchive:
+    def __init__(self, db, chunk_turns: int = 32, max_age: float = 300, flush_interval: float = 5.0,
+                 max_user_bytes: int = 512 * 1024, level: int = 6):
+        self.db = db
+        self.chunk_turns = chunk_turns
+        self.max_age = max_age
+        self.flush_interval = flush_interval
+        self.max_user_bytes = max_user_bytes
+        self.level = level
+        self._pending = {}  # user_id -> реплики, ещё не записанные в БД
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+        # Метрики
+        self.turns_total = 0
+        self.chunks_total = 0
+        self.raw_bytes_total = 0
+        self.stored_bytes_total = 0
+        self.trimmed_total = 0
+
+    def add(self, user_id: int, mode: str, role: str, content: str, at: float = None):
+        """Добавляет реплику; в БД она попадёт со следующим блоком пользователя."""
+        self._pending.setdefault(user_id, []).append(
+            {"t": round(at or time.time(), 3), "mode": mode, "role": role, "content": content}
+        )
+        self.turns_total += 1
+
+    # --- Запись ---
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush(force=True)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def _ready(self, force: bool, user_ids=None) -> dict:
+        now = time.time()
+        ready = {}
+        for user_id in list(user_ids if user_ids is not None else self._pending):
+            turns = self._pending.get(user_id)
+            if turns and (force or len(turns) >= self.chunk_turns or turns[0]["t"] <= now - self.max_age):
+                ready[user_id] = self._pending.pop(user_id)
+        return ready
+
+    async def flush(self, force: bool = False, user_ids=None):
+        """Записывает готовые блоки; force — все накопленные реплики (user_ids — только этих пользователей)."""
+        async with self._flush_lock:
+            ready = self._ready(force, user_ids)
+            if not ready:
+                return
+            # Сжатие — в потоке, чтобы не задерживать event loop на больших блоках
+            chunks = await asyncio.to_thread(
+                lambda: [(user_id, turns, *encode_chunk(turns, self.level)) for user_id, turns in ready.items()]
+            )
+            try:
+                trimmed = await self.db.transaction(write_chunks, chunks, self.max_user_bytes)
+            except Exception as e:
+                logging.error(f"Не удалось записать {len(chunks)} блоков архива диалогов: {e}")
+                # Возвращаем реплики в начало очереди пользователя, чтобы повторить при следующем сбросе
+                for user_id, turns in ready.items():
+                    self._pending[user_id] = turns + self._pending.get(user_id, [])
+                return
+            self.chunks_total += len(chunks)
+            self.raw_bytes_total += sum(chunk[3] for chunk in chunks)
+            self.stored_bytes_total += sum(len(chunk[2]) for chunk in chunks)
+            self.trimmed_total += trimmed
+
+    # --- Чтение ---
+    async def recent(self, user_id: int, limit: int, mode: str = None, since: float = None) -> list:
+        """Последние `limit` реплик пользователя (в режиме `mode`, не старше `since`), от старых к новым."""
+        def matches(turn):
+            return (mode is None or turn["mode"] == mode) and (since is None or turn["t"] >= since)
+
+        # Под блокировкой сброса: иначе реплики из записываемого блока не видны ни в памяти, ни в БД
+        async with self._flush_lock:
+            turns = [turn for turn in self._pending.get(user_id, []) if matches(turn)][-limit:] if limit > 0 else []
+            before_id = None
+            while len(turns) < limit:
+                rows = await self.db.read(read_chunks, user_id, before_id, since)
+                if not rows:
+                    break
+                for chunk_id, data in rows:
+                    before_id = chunk_id
+                    older = [turn for turn in decode_chunk(data) if matches(turn)]
+                    turns = older[-(limit - len(turns)):] + turns if older else turns
+                    if len(turns) >= limit:
+                        break
+            return turns
+
+    async def page(self, user_id: int, start: float = None, end: float = None, cursor: str = None,
+                   limit: int = 20) -> tuple:
+        """Страница реплик от новых к старым в [start, end). Возвращает (реплики, курсор следующей страницы или None)."""
+        await self.flush(force=True, user_ids=[user_id])
+        before_id, position = parse_cursor(cursor) if cursor else (None, None)
+        turns = []
+        while True:
+            # Блок из курсора перечитываем: страница могла закончиться на его середине
+            rows = await self.db.read(read_chunks, user_id, before_id + 1 if position is not None else before_id, start, end)
+            if not rows:
+                return turns, None
+            for chunk_id, data in rows:
+                chunk = decode_chunk(data)
+                top = position if position is not None and chunk_id == before_id else len(chunk)
+                position = None
+                for index in range(top - 1, -1, -1):
+                    turn = chunk[index]
+                    if (start is not None and turn["t"] < start) or (end is not None and turn["t"] >= end):
+                        continue
+                    if len(turns) == limit:
+                        return turns, f"{chunk_id}:{index + 1}"
+                    turns.append(turn)
+                before_id = chunk_id
+
+    def metrics(self) -> dict:
+        return {
+            "pending_users": len(self._pending),
+            "pending_turns": sum(len(turns) for turns in self._pending.values()),
+            "turns_total": self.turns_total,
+            "chunks_total": self.chunks_total,
+            "raw_bytes_total": self.raw_bytes_total,
+            "stored_bytes_total": self.stored_bytes_total,
+            "trimmed_chunks_total": self.trimmed_total,
+        }
@@ -0,0 +1,185 @@
+"""Архив диалогов: сжатые блоки против строки на реплику.
+
+--users пользователей пишут по --turns реплик вперемешку (как в живом боте). Одни и те же
+реплики пишутся в ConversationArchive и в таблицу «строка на реплику» с индексом
+(user_id, t). Печатаются скорость записи, размер базы, время чтения первой и глубокой
+страницы, страницы за период и последних реплик для продолжения сессии, а также сколько
+стоила бы распаковка всей истории пользователя. В конце — проверка бюджета на пользователя.
+
+Запуск: python benchmarks/bench_archive.py [--users 1000] [--turns 200] [--budget-kb 16]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import archive
+from database import Database
+
+ROW_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversation_turns (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    t REAL NOT NULL,
+    mode TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_conversation_turns_user ON conversation_turns (user_id, t);
+"""
+WORDS = (
+    "я мне чувствую после развода тревога одиночество муж жена дети думаю кажется снова тяжело "
+    "понимаю вас это нормально давайте попробуем мысль эмоция ситуация что вы почувствовали когда "
+    "поведение сегодня вчера утром вечером не могу уснуть злость обида вина страх будущее работа "
+    "друзья поддержка упражнение дневник мыслей когнитивное искажение катастрофизация как часто"
+).split()
+MODE = "UserJourney:in_session"
+
+
+def make_text(rng: random.Random) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(10, 80)))
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def db_size(path: str) -> int:
+    return sum(os.path.getsize(path + suffix) for suffix in ("", "-wal") if os.path.exists(path + suffix))
+
+
+def generate(users: int, turns: int):
+    """Реплики вперемешку по пользователям: (user_id, t, role, content)."""
+    rng = random.Random(1)
+    started = time.time() - turns * 60
+    for step in range(turns):
+        for user_id in range(users):
+            yield user_id, started + step * 60 + user_id * 0.001, "user" if step % 2 == 0 else "assistant", make_text(rng)
+
+
+async def timed(fn, samples):
+    durations = []
+    for sample in samples:
+        started = time.perf_counter()
+        await fn(sample)
+        durations.append(time.perf_counter() - started)
+    return f"p50 {percentile(durations, 0.5) * 1000:.2f} мс, p95 {percentile(durations, 0.95) * 1000:.2f} мс"
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--chunk-turns", type=int, default=32)
+    parser.add_argument("--budget-kb", type=int, default=16)
+    parser.add_argument("--samples", type=int, default=200)
+    args = parser.parse_args()
+    workdir = tempfile.mkdtemp(prefix="bench-archive-")
+    # Текст генерируется заранее, чтобы не входить в замеры записи
+    dialog = list(generate(args.users, args.turns))
+
+    # --- Строка на реплику ---
+    rows_path = os.path.join(workdir, "rows.db")
+    conn = sqlite3.connect(rows_path)
+    conn.executescript(ROW_SCHEMA)
+    conn.close()
+    rows_db = Database(rows_path)
+    pending = []
+    started = time.perf_counter()
+    for user_id, t, role, content in dialog:
+        pending.append((user_id, t, MODE, role, content))
+        if len(pending) == 500:
+            await rows_db.executemany("INSERT INTO conversation_turns (user_id, t, mode, role, content) VALUES (?, ?, ?, ?, ?)", pending)
+            pending = []
+    if pending:
+        await rows_db.executemany("INSERT INTO conversation_turns (user_id, t, mode, role, content) VALUES (?, ?, ?, ?, ?)", pending)
+    rows_write = time.perf_counter() - started
+
+    # --- Архив сжатыми блоками ---
+    archive_path = os.path.join(workdir, "archive.db")
+    conn = sqlite3.connect(archive_path)
+    archive.create_schema(conn)
+    conn.close()
+    archive_db = Database(archive_path)
+    # Реплики датированы прошлым, поэтому запись неполных блоков по возрасту отключена: блоки пишутся по chunk_turns
+    conversation_archive = archive.ConversationArchive(archive_db, chunk_turns=args.chunk_turns, max_age=float("inf"),
+                                                       max_user_bytes=2 ** 40)
+    started = time.perf_counter()
+    for index, (user_id, t, role, content) in enumerate(dialog):
+        conversation_archive.add(user_id, MODE, role, content, at=t)
+        if index % 500 == 499:
+            await conversation_archive.flush()
+    await conversation_archive.flush(force=True)
+    archive_write = time.perf_counter() - started
+
+    total = args.users * args.turns
+    print(f"{total} реплик, {args.users} пользователей")
+    print(f"запись: строки {total / rows_write:.0f} реплик/с, архив {total / archive_write:.0f} реплик/с")
+    print(f"размер базы: строки {db_size(rows_path) / 2 ** 20:.1f} МБ, архив {db_size(archive_path) / 2 ** 20:.1f} МБ "
+          f"(сжатие блоков {conversation_archive.raw_bytes_total / conversation_archive.stored_bytes_total:.1f}x)")
+
+    rng = random.Random(2)
+    users = [rng.randrange(args.users) for _ in range(args.samples)]
+    midpoint = time.time() - args.turns * 30
+    deep_offset = min(100, args.turns - 20)
+
+    async def deep_page(user_id):
+        # Архив листает курсором, как кнопка «Старее» в /history
+        turns, cursor = [], None
+        for _ in range(deep_offset // 20 + 1):
+            turns, cursor = await conversation_archive.page(user_id, cursor=cursor, limit=20)
+
+    def rows_query(sql, *params):
+        return lambda user_id: rows_db.fetchall(sql, (user_id, *params))
+
+    def decode_all(conn, user_id):
+        return sum(len(archive.decode_chunk(data)) for (data,) in
+                   conn.execute("SELECT data FROM conversation_chunks WHERE user_id = ?", (user_id,)))
+
+    print(f"{'операция':<36}{'строки':<34}архив")
+    checks = [
+        ("первая страница (20)",
+         rows_query("SELECT t, role, content FROM conversation_turns WHERE user_id = ? ORDER BY t DESC LIMIT 20"),
+         lambda user_id: conversation_archive.page(user_id, limit=20)),
+        (f"страница после {deep_offset} реплик",
+         rows_query("SELECT t, role, content FROM conversation_turns WHERE user_id = ? ORDER BY t DESC LIMIT 20 OFFSET ?", deep_offset),
+         deep_page),
+        ("период: час в середине истории",
+         rows_query("SELECT t, role, content FROM conversation_turns WHERE user_id = ? AND t >= ? AND t < ? ORDER BY t DESC LIMIT 20",
+                    midpoint, midpoint + 3600),
+         lambda user_id: conversation_archive.page(user_id, midpoint, midpoint + 3600, limit=20)),
+        ("последние 20 реплик режима",
+         rows_query("SELECT role, content FROM conversation_turns WHERE user_id = ? AND mode = ? ORDER BY t DESC LIMIT 20", MODE),
+         lambda user_id: conversation_archive.recent(user_id, 20, mode=MODE)),
+        ("вся история пользователя",
+         rows_query("SELECT t, role, content FROM conversation_turns WHERE user_id = ?"),
+         lambda user_id: archive_db.read(decode_all, user_id)),
+    ]
+    for name, rows_fn, archive_fn in checks:
+        print(f"{name:<36}{await timed(rows_fn, users):<34}{await timed(archive_fn, users)}")
+
+    # --- Бюджет на пользователя ---
+    conversation_archive.max_user_bytes = args.budget_kb * 1024
+    for index, (user_id, t, role, content) in enumerate(generate(10, args.turns * 2)):
+        conversation_archive.add(user_id, MODE, role, content, at=t + args.turns * 120)
+        if index % 100 == 99:
+            await conversation_archive.flush()
+    await conversation_archive.flush(force=True)
+    usage = [await archive_db.read(archive.user_usage, user_id) for user_id in range(10)]
+    print(f"бюджет {args.budget_kb} КБ: у 10 пользователей после ещё {args.turns * 2} реплик хранится "
+          f"до {max(stored for _, _, _, stored in usage) / 1024:.1f} КБ, "
+          f"до {max(turns for _, turns, _, _ in usage)} реплик; удалено блоков {conversation_archive.trimmed_total}")
+
+    rows_db.close()
+    archive_db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,67 @@
+"""Нагрузочный прогон автосписаний на локальном фейковом провайдере.
+
+Проверяет, что повторный прогон по тем же периодам не создаёт новых платежей,
+и показывает, что event loop остаётся отзывчивым во время списаний.
+
+Запуск: python benchmarks/bench_billing.py [--subscribers 100000] [--concurrency 200] [--rate 5000]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from billing import BillingEngine
+from fake_yookassa import FakePaymentProvider
+
+
+async def measure_loop_lag(stop, lags, interval=0.01):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - started - interval)
+
+
+async def run_once(engine, subscribers):
+    stop = asyncio.Event()
+    lags = []
+    lag_task = asyncio.create_task(measure_loop_lag(stop, lags))
+    charges = ((user_id, f"pm-{user_id}", "2026-01-01T10:00:00") for user_id in range(subscribers))
+    started = time.perf_counter()
+    report = await engine.run(charges)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await lag_task
+    print(f"  {report.summary()}")
+    print(f"  {report.attempted / elapsed:.0f} charges/sec, max loop lag {max(lags, default=0) * 1000:.1f} ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--subscribers", type=int, default=100000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=5000)
+    parser.add_argument("--latency", type=float, default=0.03)
+    parser.add_argument("--transient-errors", type=float, default=0.02)
+    parser.add_argument("--errors", type=float, default=0.01)
+    args = parser.parse_args()
+
+    provider = FakePaymentProvider(latency=args.latency, transient_error_rate=args.transient_errors, error_rate=args.errors)
+    engine = BillingEngine(provider, concurrency=args.concurrency, rate_per_second=args.rate, backoff=0.05)
+
+    # Ошибки списаний ожидаемы (их вносит фейковый провайдер) и только засоряют вывод
+    logging.disable(logging.ERROR)
+    print("first run:")
+    await run_once(engine, args.subscribers)
+    print("rerun of the same periods:")
+    await run_once(engine, args.subscribers)
+    duplicates = sum(1 for count in provider.charges_per_user.values() if count > 1)
+    print(f"users charged: {len(provider.charges_per_user)}, charged more than once: {duplicates}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,85 @@
+"""Размер запроса к модели по мере роста диалога: вся история vs ConversationMemory.
+
+Модель для конспекта подменена локальной заглушкой, которая возвращает
+конспект фиксированной длины, поэтому бенчмарк не ходит в сеть.
+
+Запуск: python benchmarks/bench_context.py [--turns 300]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from conversation import ContextBudget, ConversationMemory, message_tokens
+
+MODE = "UserJourney:in_session"
+WORDS = "я чувствую обиду злость вину усталость тревогу надежду сегодня снова думаю о нём дети работа".split()
+
+
+class FakeCompletions:
+    async def create(self, **kwargs):
+        await asyncio.sleep(0.01)
+        summary = " ".join(random.choices(WORDS, k=120))
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=summary))])
+
+
+class FakeState:
+    """Минимальная замена FSMContext с хранением данных в словаре."""
+
+    def __init__(self):
+        self.key = "bench"
+        self.data = {}
+
+    async def get_data(self):
+        return dict(self.data)
+
+    async def update_data(self, **kwargs):
+        self.data.update(kwargs)
+        return dict(self.data)
+
+
+def phrase(words):
+    return " ".join(random.choices(WORDS, k=words))
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=300)
+    args = parser.parse_args()
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=FakeCompletions()))
+    memory = ConversationMemory(client, {MODE: ContextBudget(max_prompt_tokens=6000, recent_tokens=3000)})
+    state = FakeState()
+    system = {"role": "system", "content": phrase(300)}
+    await state.update_data(messages=[system], summary="", summarized=0)
+    full_history = [system]
+
+    print(f"{'turn':>6} {'full history':>14} {'memory':>8} {'fsm msgs':>9}")
+    for turn in range(1, args.turns + 1):
+        user = {"role": "user", "content": phrase(40)}
+        answer = {"role": "assistant", "content": phrase(120)}
+
+        data = await state.get_data()
+        history = memory.history(data)
+        history.append(user)
+        prompt = memory.prompt(history, data.get("summary"), MODE)
+        full_history.append(user)
+
+        if turn in (1, 10, 25, 50, 100, 200) or turn == args.turns:
+            full_tokens = sum(message_tokens(m) for m in full_history)
+            prompt_tokens = sum(message_tokens(m) for m in prompt)
+            print(f"{turn:>6} {full_tokens:>14} {prompt_tokens:>8} {len(history):>9}")
+
+        history.append(answer)
+        full_history.append(answer)
+        await memory.save(state, data, history)
+        memory.maybe_summarize(state, MODE)
+        await asyncio.sleep(0.02)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
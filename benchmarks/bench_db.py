@@ -0,0 +1,124 @@
+"""Сравнение пропускной способности доступа к БД: sqlite3.connect на каждый вызов vs Database.
+
+Каждое «обновление» повторяет типичную работу обработчика /start:
+ensure_user_exists + log_event + is_user_subscribed.
+
+Запуск: python benchmarks/bench_db.py [--updates 5000] [--concurrency 100]
+"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS analytics (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    event_type TEXT NOT NULL,
+    timestamp DATETIME NOT NULL
+);
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    subscription_status TEXT DEFAULT 'free',
+    subscription_expires_at DATETIME,
+    yookassa_payment_method_id TEXT,
+    session_plan TEXT
+);
+"""
+
+
+def make_db(path):
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    conn.commit()
+    conn.close()
+
+
+# --- Старый способ: новое соединение на каждый вызов прямо в event loop ---
+async def legacy_update(path, user_id):
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
+    if cursor.fetchone() is None:
+        cursor.execute("INSERT INTO users (user_id) VALUES (?)", (user_id,))
+        conn.commit()
+    conn.close()
+
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "INSERT INTO analytics (user_id, event_type, timestamp) VALUES (?, ?, ?)",
+        (user_id, 'start_command', datetime.utcnow().isoformat(" "))
+    )
+    conn.commit()
+    conn.close()
+
+    conn = sqlite3.connect(path)
+    conn.execute("SELECT subscription_status, subscription_expires_at FROM users WHERE user_id = ?", (user_id,)).fetchone()
+    conn.close()
+
+
+# --- Новый способ: долгоживущие соединения вне event loop ---
+async def pooled_update(db, user_id):
+    await db.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
+    await db.execute(
+        "INSERT INTO analytics (user_id, event_type, timestamp) VALUES (?, ?, ?)",
+        (user_id, 'start_command', datetime.utcnow().isoformat(" "))
+    )
+    await db.fetchone("SELECT subscription_status, subscription_expires_at FROM users WHERE user_id = ?", (user_id,))
+
+
+async def measure_loop_lag(stop, lags, interval=0.01):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - started - interval)
+
+
+async def run(name, update, updates, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    stop = asyncio.Event()
+    lags = []
+    lag_task = asyncio.create_task(measure_loop_lag(stop, lags))
+
+    async def one(i):
+        async with semaphore:
+            await update(i % 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(updates)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await lag_task
+    max_lag_ms = max(lags, default=0) * 1000
+    print(f"{name:>8}: {updates / elapsed:8.0f} updates/sec, max loop lag {max_lag_ms:.1f} ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, "legacy.db")
+        make_db(legacy_path)
+        await run("before", lambda uid: legacy_update(legacy_path, uid), args.updates, args.concurrency)
+
+        pooled_path = os.path.join(tmp, "pooled.db")
+        make_db(pooled_path)
+        db = Database(pooled_path)
+        await run("after", lambda uid: pooled_update(db, uid), args.updates, args.concurrency)
+        db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,98 @@
+"""Всплеск запросов к OpenAI с планировщиком и без него (на локальном фейковом сервере).
+
+Фейковый сервер отвечает 429 сверх --server-limit одновременных запросов.
+Без планировщика всплеск упирается в 429, с планировщиком запросы ждут в очереди,
+а платные сессии обслуживаются раньше генерации планов.
+
+Запуск: python benchmarks/bench_llm_scheduler.py [--users 100] [--turns 3]
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+from contextlib import asynccontextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web
+from openai import AsyncOpenAI
+
+from fake_openai import FakeOpenAI
+from llm_scheduler import LLMScheduler
+from streaming import chat_completion_chunks
+
+
+@asynccontextmanager
+async def no_slot(*args, **kwargs):
+    yield
+
+
+async def user(client, scheduler, user_id, turns, latencies, errors, notices):
+    call_site = "session_turn" if user_id % 2 else "plan_generation"
+    for _ in range(turns):
+        messages = [{"role": "user", "content": "Мне тяжело после развода " * 20}]
+
+        async def on_queued(position):
+            notices.append(position)
+
+        started = time.perf_counter()
+        try:
+            if scheduler is None:
+                slot, turn = no_slot(), no_slot()
+            else:
+                slot, turn = scheduler.slot(call_site, 500, on_queued=on_queued), scheduler.user_turn(user_id)
+            async with turn:
+                async with slot:
+                    async for _ in chat_completion_chunks(client, model="gpt-4o", messages=messages):
+                        pass
+            latencies.setdefault(call_site, []).append(time.perf_counter() - started)
+        except Exception as e:
+            errors.append(type(e).__name__)
+        await asyncio.sleep(random.uniform(0, 0.2))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0
+
+
+async def run(name, client, scheduler, args):
+    latencies, errors, notices = {}, [], []
+    started = time.perf_counter()
+    await asyncio.gather(*(user(client, scheduler, uid, args.turns, latencies, errors, notices) for uid in range(args.users)))
+    elapsed = time.perf_counter() - started
+    print(f"{name}: {elapsed:.1f}s, errors={len(errors)} ({', '.join(sorted(set(errors))) or '-'}), queue notices={len(notices)}")
+    for call_site, values in sorted(latencies.items()):
+        print(f"  {call_site:>16}: n={len(values)} p50={statistics.median(values):.2f}s p95={percentile(values, 0.95):.2f}s")
+    if scheduler is not None:
+        print(f"  scheduler: {scheduler.metrics()}")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--server-limit", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--port", type=int, default=8181)
+    args = parser.parse_args()
+
+    fake = FakeOpenAI(latency=args.latency, token_delay=0.002, max_concurrency=args.server_limit)
+    runner = web.AppRunner(fake.app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.port).start()
+
+    client = AsyncOpenAI(api_key="fake", base_url=f"http://127.0.0.1:{args.port}/v1", max_retries=0)
+    await run("without scheduler", client, None, args)
+    scheduler = LLMScheduler(max_concurrency=args.server_limit, tokens_per_minute=10_000_000)
+    await run("with scheduler", client, scheduler, args)
+
+    await client.close()
+    await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
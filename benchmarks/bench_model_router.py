@@ -0,0 +1,112 @@
+"""Маршрутизатор моделей против деградации основной модели.
+
+Локальный фейковый OpenAI проходит фазы: основная модель исправна, изредка отвечает очень
+медленно (хвост задержек — здесь помогает --hedge), отвечает 500 на часть запросов, отвечает
+медленно всегда, снова исправна. В каждой фазе одни и те же потоковые запросы
+отправляются напрямую к основной модели и через ModelRouter (основная → запасная);
+печатаются доля успешных ответов, p50/p95 времени до первого токена и какие модели ответили.
+
+Запуск: python benchmarks/bench_model_router.py [--requests 200] [--hedge]
+"""
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web
+from openai import AsyncOpenAI
+
+from fake_openai import FakeOpenAI
+from model_router import ModelRouter, Route, percentile
+from streaming import chat_completion_chunks
+
+PRIMARY, FALLBACK = "gpt-4o", "gpt-4o-mini"
+PHASES = [
+    ("исправна", {"latency": 0.2, "error_rate": 0.0}),
+    ("хвост 10% по 3с", {"latency": 0.2, "tail_rate": 0.1, "tail_latency": 3.0}),
+    ("500 на 60%", {"latency": 0.2, "tail_rate": 0.0, "error_rate": 0.6}),
+    ("медленная", {"latency": 3.0, "error_rate": 0.0}),
+    ("восстановилась", {"latency": 0.2, "error_rate": 0.0}),
+]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def measure(open_stream, requests: int, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    ttft = []
+
+    async def one():
+        async with semaphore:
+            started = time.perf_counter()
+            first = None
+            try:
+                async for _ in open_stream():
+                    first = first or time.perf_counter() - started
+            except Exception:
+                return
+            ttft.append(first)
+
+    await asyncio.gather(*(one() for _ in range(requests)))
+    return {
+        "ok": len(ttft) / requests,
+        "p50": percentile(ttft, 0.5) if ttft else float("nan"),
+        "p95": percentile(ttft, 0.95) if ttft else float("nan"),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--hedge", action="store_true", help="дублировать медленные запросы к запасной модели")
+    args = parser.parse_args()
+
+    fake = FakeOpenAI(token_delay=0.002, completion_words=20, models={FALLBACK: {"latency": 0.4}})
+    runner = web.AppRunner(fake.app())
+    await runner.setup()
+    port = free_port()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    # Без повторов внутри SDK: повторять или переключаться решает маршрутизатор
+    client = AsyncOpenAI(api_key="bench", base_url=f"http://127.0.0.1:{port}/v1", max_retries=0)
+    router = ModelRouter(client, {"bench": Route([PRIMARY, FALLBACK], hedge=args.hedge)}, default_route=Route([PRIMARY]),
+                         window=10, min_samples=5, slow_threshold=1.0, cooldown=2)
+    messages = [{"role": "user", "content": "Мне тяжело после развода"}]
+
+    def direct():
+        return chat_completion_chunks(client, "bench", model=PRIMARY, messages=messages)
+
+    def routed():
+        return router.stream("bench", messages=messages)
+
+    print(f"{'фаза':<17}{'режим':<10}{'успешно':>9}{'p50 TTFT':>10}{'p95 TTFT':>10}  ответившие модели")
+    for name, options in PHASES:
+        fake.set_model(PRIMARY, **options)
+        for mode, open_stream in (("напрямую", direct), ("роутер", routed)):
+            before = Counter(fake.served)
+            result = await measure(open_stream, args.requests, args.concurrency)
+            served = fake.served - before
+            print(f"{name:<17}{mode:<10}{result['ok']:>8.0%}{result['p50']:>9.2f}с{result['p95']:>9.2f}с  "
+                  f"{dict(served)}")
+        states = {model: health.state for model, health in router.health.items()}
+        print(f"{'':<17}состояние моделей: {states}")
+        # Дадим истечь паузе автомата защиты, чтобы следующая фаза началась с пробного запроса
+        await asyncio.sleep(2)
+
+    print(f"переключений на запасную модель: {router.fallbacks}, дублирующих запросов: {router.hedges}, "
+          f"из них выиграли: {router.hedge_wins}")
+    await client.close()
+    await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
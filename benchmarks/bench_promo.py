@@ -0,0 +1,168 @@
+"""Промокоды: генерация пакета, гонка за один код и пропускная способность активации.
+
+1. Пакет из --codes кодов создаётся одной транзакцией — печатается время.
+2. Один одноразовый код (и один код на --max-uses активаций) одновременно активируют
+   --users пользователей через Database — победителей должно быть ровно 1 (и --max-uses).
+3. --processes процессов (как воркеры в многопроцессном режиме) со своими соединениями
+   --rounds раз одновременно активируют очередной одноразовый код; для сравнения так же
+   прогоняется прежняя активация (SELECT, затем два UPDATE). Печатается, в скольких
+   раундах код достался больше чем одному пользователю.
+4. --redemptions разных кодов активируются разными пользователями — активаций в секунду.
+
+Запуск: python benchmarks/bench_promo.py [--codes 100000] [--users 1000] [--processes 8] [--rounds 200]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import promo
+from database import Database
+
+USERS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    subscription_status TEXT DEFAULT 'free',
+    subscription_expires_at DATETIME,
+    yookassa_payment_method_id TEXT,
+    session_plan TEXT
+);
+"""
+
+
+def legacy_redeem(conn, code, user_id):
+    """Активация до перехода на условный UPDATE — для сравнения."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT duration_days FROM promo_codes WHERE code = ? AND is_active = 1", (code,))
+    result = cursor.fetchone()
+    if not result:
+        return None
+    duration_days = result[0]
+    expires_at = datetime.utcnow() + timedelta(days=duration_days)
+    cursor.execute(
+        "UPDATE users SET subscription_status = ?, subscription_expires_at = ? WHERE user_id = ?",
+        ('paid', expires_at.isoformat(), user_id)
+    )
+    cursor.execute("UPDATE promo_codes SET is_active = 0 WHERE code = ?", (code,))
+    return duration_days
+
+
+def make_db(path, users):
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(USERS_SCHEMA)
+    promo.create_schema(conn)
+    conn.executemany("INSERT INTO users (user_id) VALUES (?)", ((user_id,) for user_id in range(users)))
+    conn.commit()
+    return conn
+
+
+def new_batch(conn, count, max_uses=1):
+    batch_id = promo.create_batch(conn, count, 30, max_uses)
+    conn.commit()
+    return promo.batch_codes(conn, batch_id)
+
+
+def process_worker(path, index, codes, mode, barrier, results):
+    redeem = legacy_redeem if mode == "legacy" else promo.redeem
+    conn = sqlite3.connect(path, timeout=5)
+    conn.execute("PRAGMA busy_timeout=5000")
+    wins, errors = [], 0
+    for code in codes:
+        barrier.wait()
+        try:
+            with conn:
+                if redeem(conn, code, index):
+                    wins.append(code)
+        except sqlite3.OperationalError:
+            errors += 1
+    conn.close()
+    results.put((wins, errors))
+
+
+def race_processes(path, codes, mode, processes):
+    barrier = multiprocessing.Barrier(processes)
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=process_worker, args=(path, index, codes, mode, barrier, results))
+               for index in range(processes)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    collected = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    winners = Counter(code for wins, _ in collected for code in wins)
+    errors = sum(errors for _, errors in collected)
+    return winners, errors, elapsed
+
+
+async def race_in_process(db, code, users):
+    results = await asyncio.gather(*(db.transaction(promo.redeem, code, user_id) for user_id in range(users)))
+    return sum(1 for days in results if days)
+
+
+async def throughput(db, codes, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(user_id, code):
+        async with semaphore:
+            return await db.transaction(promo.redeem, code, user_id)
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(one(user_id, code) for user_id, code in enumerate(codes)))
+    return sum(1 for days in results if days), time.perf_counter() - started
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--codes", type=int, default=100000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--max-uses", type=int, default=50)
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--redemptions", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(prefix="bench-promo-"), "bot_data.db")
+    conn = make_db(path, max(args.users, args.redemptions, args.processes))
+
+    started = time.perf_counter()
+    batch = new_batch(conn, args.codes)
+    print(f"генерация пакета: {len(batch)} кодов за {time.perf_counter() - started:.2f} с")
+
+    db = Database(path)
+    try:
+        single = new_batch(conn, 1)[0]
+        multi = new_batch(conn, 1, max_uses=args.max_uses)[0]
+        print(f"один процесс, {args.users} пользователей на одноразовый код: "
+              f"победителей {await race_in_process(db, single, args.users)} (ожидается 1)")
+        print(f"один процесс, {args.users} пользователей на код с лимитом {args.max_uses}: "
+              f"победителей {await race_in_process(db, multi, args.users)} (ожидается {args.max_uses})")
+
+        for mode in ("legacy", "atomic"):
+            codes = new_batch(conn, args.rounds)
+            winners, errors, elapsed = race_processes(path, codes, mode, args.processes)
+            doubled = sum(1 for count in winners.values() if count > 1)
+            print(f"{args.processes} процессов, {args.rounds} раундов, {mode:<6}: код достался больше чем одному "
+                  f"в {doubled} раундах (всего активаций {sum(winners.values())}), ошибок блокировки {errors}, "
+                  f"{elapsed:.2f} с")
+
+        redeemed, elapsed = await throughput(db, batch[:args.redemptions], args.concurrency)
+        print(f"пропускная способность: {redeemed} активаций за {elapsed:.2f} с — {redeemed / elapsed:.0f} в секунду")
+    finally:
+        db.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,164 @@
+"""Планировщик автопродлений против ежедневного сканирования в 10:00.
+
+1. Стоимость запросов на --users подписчиках (сроки равномерно на 30 дней вперёд):
+   прежний запрос «все истёкшие» без индекса и с частичным индексом, загрузка кучи
+   при запуске, сверка окна ближайших окончаний.
+2. Живой прогон: --due подписок истекают в ближайшие --window секунд. Часть из них
+   продлевается «в другом процессе» (только в БД), часть — в этом процессе с refresh(),
+   у части отвязывается карта. Проверяется, что списания пришли ровно тем, кому нужно,
+   и печатаются задержка списания после окончания подписки и пиковая нагрузка.
+   Для сравнения — задержка и пиковая нагрузка при ежедневном запуске на тех же сроках,
+   растянутых на сутки.
+
+Запуск: python benchmarks/bench_renewals.py [--users 100000] [--due 2000] [--window 20] [--jitter 2]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import renewals
+from database import Database
+
+USERS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    subscription_status TEXT DEFAULT 'free',
+    subscription_expires_at DATETIME,
+    yookassa_payment_method_id TEXT,
+    session_plan TEXT
+);
+"""
+LEGACY_QUERY = (
+    "SELECT user_id, yookassa_payment_method_id, subscription_expires_at FROM users "
+    "WHERE subscription_status = 'paid' AND subscription_expires_at < ? AND yookassa_payment_method_id IS NOT NULL"
+)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else float("nan")
+
+
+def make_db(path, users, due, window, now):
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(USERS_SCHEMA)
+    rows = []
+    for user_id in range(users):
+        if user_id < due:
+            expires = now + window * user_id / due
+        else:
+            expires = now + window + random.uniform(0, 30 * 86400)
+        rows.append((user_id, "paid", renewals.isoformat(expires), f"pm-{user_id}"))
+    conn.executemany("INSERT INTO users VALUES (?, ?, ?, ?, NULL)", rows)
+    conn.commit()
+    return conn
+
+
+def timed(fn, *args, repeat=5):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = fn(*args)
+    return (time.perf_counter() - started) / repeat, result
+
+
+def query_costs(conn, now):
+    # Порог из будущего: при ежедневном запуске истёкшими оказываются сутки окончаний
+    threshold = renewals.isoformat(now + 86400)
+    scan, rows = timed(lambda: conn.execute(LEGACY_QUERY, (threshold,)).fetchall())
+    renewals.create_schema(conn)
+    conn.commit()
+    indexed, _ = timed(lambda: conn.execute(LEGACY_QUERY, (threshold,)).fetchall())
+    load, everything = timed(renewals.expiring_between, conn, "", renewals.MAX_EXPIRY, repeat=1)
+    window, _ = timed(renewals.expiring_between, conn, renewals.isoformat(now - 300), renewals.isoformat(now + 600))
+    print(f"прежний запрос (сутки окончаний, {len(rows)} строк): без индекса {scan * 1000:.1f} мс, "
+          f"с индексом {indexed * 1000:.1f} мс")
+    print(f"загрузка кучи при запуске: {len(everything)} строк за {load * 1000:.0f} мс; "
+          f"сверка окна 15 минут: {window * 1000:.2f} мс")
+
+
+async def live_run(path, args, now):
+    db = Database(path)
+    charged = []
+
+    async def charge(charges):
+        moment = time.time()
+        charged.extend((user_id, period, moment) for user_id, _, period in charges)
+
+    scheduler = renewals.RenewalScheduler(db, charge, jitter=args.jitter, sync_interval=1, retry_interval=3600)
+    started = time.perf_counter()
+    scheduler.start()
+    await asyncio.sleep(0)
+    while scheduler._needs_rebuild:
+        await asyncio.sleep(0.01)
+    print(f"куча построена за {time.perf_counter() - started:.2f} с: {scheduler.metrics()['tracked']} подписок")
+
+    # Каждое изменение — до окончания подписки: оплата прошла раньше, чем сработало бы списание
+    users = list(range(args.due))
+    random.shuffle(users)
+    share = args.due // 10
+    elsewhere, local, cancelled = users[:share], users[share:2 * share], users[2 * share:3 * share]
+    changes = sorted(
+        [(user_id, "elsewhere") for user_id in elsewhere] + [(user_id, "local") for user_id in local]
+        + [(user_id, "cancel") for user_id in cancelled],
+        key=lambda change: change[0]
+    )
+    for user_id, kind in changes:
+        delay = now + args.window * user_id / args.due - 0.5 - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if kind == "cancel":
+            await db.execute("UPDATE users SET yookassa_payment_method_id = NULL WHERE user_id = ?", (user_id,))
+        else:
+            await db.execute("UPDATE users SET subscription_expires_at = ? WHERE user_id = ?",
+                             (renewals.isoformat(time.time() + 7 * 86400), user_id))
+        if kind != "elsewhere":
+            await scheduler.refresh([user_id])
+
+    await asyncio.sleep(max(0, now + args.window + args.jitter + 2 - time.time()))
+    await scheduler.stop()
+    db.close()
+
+    expected = set(range(args.due)) - set(elsewhere) - set(local) - set(cancelled)
+    got = Counter(user_id for user_id, _, _ in charged)
+    lags = [moment - renewals.timestamp(period) for _, period, moment in charged]
+    per_second = Counter(int(moment) for _, _, moment in charged)
+    print(f"списаний: {len(charged)}, ожидалось {len(expected)}; пропущено {len(expected - set(got))}, "
+          f"лишних {len(set(got) - expected)}, повторных {sum(1 for count in got.values() if count > 1)}")
+    print(f"задержка после окончания: p50 {percentile(lags, 0.5):.2f} с, p95 {percentile(lags, 0.95):.2f} с, "
+          f"макс {max(lags, default=0):.2f} с (jitter {args.jitter} с); пик {max(per_second.values(), default=0)} списаний в секунду")
+
+    # Те же окончания, растянутые на сутки, при запуске раз в день в 10:00 UTC
+    day = [random.uniform(0, 86400) for _ in range(len(expected))]
+    legacy_lags = [(10 * 3600 - moment) % 86400 for moment in day]
+    print(f"ежедневный запуск на тех же окончаниях за сутки: задержка p50 {percentile(legacy_lags, 0.5) / 3600:.1f} ч, "
+          f"p95 {percentile(legacy_lags, 0.95) / 3600:.1f} ч; все {len(day)} списаний одной пачкой")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--due", type=int, default=2000)
+    parser.add_argument("--window", type=float, default=20)
+    parser.add_argument("--jitter", type=float, default=2)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(prefix="bench-renewals-"), "bot_data.db")
+    # Запас на заполнение базы и замеры запросов: первые окончания должны наступить после запуска планировщика
+    now = time.time() + 15
+    conn = make_db(path, args.users, args.due, args.window, now)
+    query_costs(conn, now)
+    conn.close()
+    await live_run(path, args, now)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,120 @@
+"""Время запуска бота: от `python main.py` до готовности принимать апдейты.
+
+Запускает бот против локального фейкового Bot API несколько раз подряд с одной и той же
+базой (первый запуск — на пустой базе) и замеряет по каждому запуску:
+  listening — порт начал отвечать (/healthz),
+  ready     — /readyz отвечает 200 (у старых версий без /readyz — /metrics отвечает 200).
+
+Запуск: python benchmarks/bench_startup.py [--runs 5] [--main путь/к/main.py] [--json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+from aiohttp import web
+
+from fake_telegram import FakeTelegram
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_status(session: aiohttp.ClientSession, url: str, paths: list, deadline: float) -> float:
+    """Ждёт ответа 200 на один из путей; возвращает момент (perf_counter), когда он пришёл."""
+    while time.perf_counter() < deadline:
+        for path in paths:
+            try:
+                async with session.get(f"{url}{path}") as response:
+                    if response.status == 200:
+                        return time.perf_counter()
+            except aiohttp.ClientError:
+                break
+        await asyncio.sleep(0.01)
+    raise TimeoutError(f"{url} не стал готов")
+
+
+async def run_once(script: str, workdir: str, telegram_port: int, timeout: float) -> dict:
+    port = free_port()
+    env = {
+        **os.environ,
+        "TELEGRAM_BOT_TOKEN": "123456:BENCH", "ADMIN_ID": "1", "OPENAI_API_KEY": "bench",
+        "YOOKASSA_SHOP_ID": "bench", "YOOKASSA_SECRET_KEY": "bench",
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{telegram_port}",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{telegram_port}/v1",
+        "YOOKASSA_API_URL": f"http://127.0.0.1:{telegram_port}/v3",
+        "DB_FILE": os.path.join(workdir, "bot_data.db"), "PORT": str(port), "WEB_SERVER_HOST": "127.0.0.1",
+        "WEBHOOK_URL": f"http://127.0.0.1:{port}",
+    }
+    for name in ("WORKERS", "WORKER_INDEX"):
+        env.pop(name, None)
+    log = open(os.path.join(workdir, "bot.log"), "ab")
+    started = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(sys.executable, script, cwd=workdir, env=env,
+                                                   stdout=log, stderr=subprocess.STDOUT)
+    try:
+        url = f"http://127.0.0.1:{port}"
+        deadline = started + timeout
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=2)) as session:
+            listening = await wait_status(session, url, ["/healthz", "/metrics"], deadline)
+            ready = await wait_status(session, url, ["/readyz"], deadline) if await has_readyz(session, url) else listening
+    finally:
+        process.terminate()
+        await asyncio.wait_for(process.wait(), timeout=30)
+        log.close()
+    return {"listening": listening - started, "ready": ready - started}
+
+
+async def has_readyz(session: aiohttp.ClientSession, url: str) -> bool:
+    async with session.get(f"{url}/readyz") as response:
+        return response.status != 404
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--main", default=os.path.join(ROOT, "main.py"), help="какой main.py запускать")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    fake = FakeTelegram(latency=0.05)
+    runner = web.AppRunner(fake.app())
+    await runner.setup()
+    telegram_port = free_port()
+    await web.TCPSite(runner, "127.0.0.1", telegram_port).start()
+
+    workdir = tempfile.mkdtemp(prefix="bench-startup-")
+    results = []
+    try:
+        for index in range(args.runs):
+            result = await run_once(os.path.abspath(args.main), workdir, telegram_port, args.timeout)
+            result["run"] = "первый (пустая база)" if index == 0 else f"повторный {index}"
+            results.append(result)
+    finally:
+        await runner.cleanup()
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False))
+        return
+    print(f"{'запуск':<24}{'listening':>11}{'ready':>9}")
+    for result in results:
+        print(f"{result['run']:<24}{result['listening']:>10.2f}с{result['ready']:>8.2f}с")
+    warm = results[1:] or results
+    print(f"{'среднее повторных':<24}{sum(r['listening'] for r in warm) / len(warm):>10.2f}с"
+          f"{sum(r['ready'] for r in warm) / len(warm):>8.2f}с")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
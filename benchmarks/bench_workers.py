@@ -0,0 +1,134 @@
+"""Пропускная способность бота в зависимости от числа воркеров.
+
+Для каждого значения --workers запускает `python main.py` с WORKERS=<n> против локального
+фейкового Bot API, отправляет мастеру --updates апдейтов /start от разных пользователей
+(это запись в БД, аналитика, FSM и ответ в Telegram) и ждёт, пока бот ответит на все.
+В конце проверяет, что аренду лидера держит ровно один процесс.
+
+Прирост ограничен числом ядер машины и тем, что все процессы пишут в один файл SQLite.
+
+Запуск: python benchmarks/bench_workers.py [--workers 1 2 4] [--updates 3000]
+"""
+import argparse
+import asyncio
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiohttp
+from aiohttp import web
+
+from fake_telegram import FakeTelegram
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_ready(session: aiohttp.ClientSession, urls: list, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    for url in urls:
+        while True:
+            try:
+                async with session.get(f"{url}/readyz") as response:
+                    if response.status == 200:
+                        break
+            except aiohttp.ClientError:
+                pass
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{url} не запустился")
+            await asyncio.sleep(0.2)
+
+
+async def run(workers: int, updates: int, concurrency: int, telegram_latency: float) -> dict:
+    fake = FakeTelegram(latency=telegram_latency)
+    runner = web.AppRunner(fake.app())
+    await runner.setup()
+    telegram_port, port = free_port(), free_port()
+    await web.TCPSite(runner, "127.0.0.1", telegram_port).start()
+
+    workdir = tempfile.mkdtemp(prefix="bench-workers-")
+    db_file = os.path.join(workdir, "bot_data.db")
+    base_port = free_port()
+    env = {
+        **os.environ,
+        "TELEGRAM_BOT_TOKEN": "123456:BENCH", "ADMIN_ID": "1", "OPENAI_API_KEY": "bench",
+        "YOOKASSA_SHOP_ID": "bench", "YOOKASSA_SECRET_KEY": "bench",
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{telegram_port}", "TELEGRAM_RATE_LIMIT": "1000000",
+        "DB_FILE": db_file, "PORT": str(port), "WEB_SERVER_HOST": "127.0.0.1",
+        "WORKERS": str(workers), "WORKER_BASE_PORT": str(base_port),
+    }
+    env.pop("WORKER_INDEX", None)
+    log = open(os.path.join(workdir, "bot.log"), "wb")
+    process = await asyncio.create_subprocess_exec(sys.executable, os.path.join(ROOT, "main.py"), cwd=workdir, env=env,
+                                                   stdout=log, stderr=subprocess.STDOUT)
+    try:
+        async with aiohttp.ClientSession() as session:
+            urls = [f"http://127.0.0.1:{port}"]
+            if workers > 1:
+                urls += [f"http://127.0.0.1:{base_port + index}" for index in range(workers)]
+            await wait_ready(session, urls)
+
+            semaphore = asyncio.Semaphore(concurrency)
+            baseline = fake.calls["sendMessage"]
+
+            async def send(index):
+                user = {"id": 200000 + index, "is_bot": False, "first_name": "Bench"}
+                update = {"update_id": index + 1, "message": {
+                    "message_id": index + 1, "date": int(time.time()), "text": "/start",
+                    "chat": {"id": user["id"], "type": "private"}, "from": user,
+                }}
+                async with semaphore:
+                    async with session.post(f"{urls[0]}/webhook", json=update) as response:
+                        await response.read()
+
+            started = time.perf_counter()
+            await asyncio.gather(*(send(index) for index in range(updates)))
+            while fake.calls["sendMessage"] - baseline < updates:
+                await asyncio.sleep(0.01)
+            elapsed = time.perf_counter() - started
+
+        conn = sqlite3.connect(db_file)
+        leaders = conn.execute("SELECT COUNT(*) FROM leases WHERE expires_at > ?", (time.time(),)).fetchone()[0]
+        conn.close()
+    finally:
+        # Бот при остановке обращается к фейковому Bot API, поэтому ждём его асинхронно
+        process.terminate()
+        await asyncio.wait_for(process.wait(), timeout=30)
+        await runner.cleanup()
+        log.close()
+
+    return {"workers": workers, "elapsed": elapsed, "rate": updates / elapsed, "leases": leaders}
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--updates", type=int, default=3000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--telegram-latency", type=float, default=0.02)
+    args = parser.parse_args()
+
+    print(f"CPU cores: {os.cpu_count()}")
+    print(f"{'workers':>8}{'seconds':>10}{'updates/s':>12}{'speedup':>10}")
+    first = None
+    for workers in args.workers:
+        result = await run(workers, args.updates, args.concurrency, args.telegram_latency)
+        first = first or result["rate"]
+        print(f"{workers:>8}{result['elapsed']:>10.2f}{result['rate']:>12.0f}{result['rate'] / first:>10.2f}x")
+        if result["leases"] != 1:
+            print(f"  внимание: действующих аренд лидера {result['leases']}, ожидалась одна")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
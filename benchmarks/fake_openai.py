@@ -0,0 +1,128 @@
+"""Локальный фейковый сервер OpenAI Chat Completions для нагрузочных тестов.
+
+Поддерживает обычные и потоковые (stream=True) ответы, искусственную задержку
+и ограничение одновременных запросов: сверх лимита отвечает 429, как настоящий API.
+Задержку, долю ответов 500 и «хвост» (доля tail_rate запросов ждёт tail_latency секунд)
+можно задать отдельно для каждой модели (`models` или set_model()).
+
+Запуск отдельно: python benchmarks/fake_openai.py --port 8081 --latency 0.5 --max-concurrency 8 \
+    [--model gpt-4o:latency=3,error_rate=0.5]
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from collections import Counter
+
+from aiohttp import web
+
+WORDS = "Я слышу вас. Это действительно непросто. Расскажите, что вы чувствуете, когда думаете об этом?".split()
+
+
+class FakeOpenAI:
+    def __init__(self, latency: float = 0.5, token_delay: float = 0.01, completion_words: int = 60, max_concurrency: int = 0,
+                 error_rate: float = 0.0, models: dict = None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.models = {model: dict(options) for model, options in (models or {}).items()}
+        self.token_delay = token_delay
+        self.completion_words = completion_words
+        self.max_concurrency = max_concurrency
+        self.active = 0
+        self.requests = 0
+        self.rejected = 0
+        self.failed = 0
+        # Полностью отданные ответы по моделям
+        self.served = Counter()
+
+    def set_model(self, model: str, **options):
+        """Меняет задержку (latency, tail_rate, tail_latency) и долю ошибок (error_rate) модели на ходу."""
+        self.models.setdefault(model, {}).update(options)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        return app
+
+    def _words(self):
+        return [WORDS[i % len(WORDS)] + " " for i in range(self.completion_words)]
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.requests += 1
+        if self.max_concurrency and self.active >= self.max_concurrency:
+            self.rejected += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                status=429,
+            )
+        self.active += 1
+        try:
+            model = body.get("model", "gpt-4o")
+            options = self.models.get(model, {})
+            slow = random.random() < options.get("tail_rate", 0.0)
+            await asyncio.sleep(options["tail_latency"] if slow else options.get("latency", self.latency))
+            if random.random() < options.get("error_rate", self.error_rate):
+                self.failed += 1
+                return web.json_response(
+                    {"error": {"message": "The server had an error while processing your request", "type": "server_error"}},
+                    status=500,
+                )
+            completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+            words = self._words()
+            prompt_tokens = sum(len(m.get("content", "")) // 3 for m in body.get("messages", []))
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(words), "total_tokens": prompt_tokens + len(words)}
+            if not body.get("stream"):
+                await asyncio.sleep(self.token_delay * len(words))
+                self.served[model] += 1
+                return web.json_response({
+                    "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": model,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(words)}, "finish_reason": "stop"}],
+                    "usage": usage,
+                })
+
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+
+            async def send(choices, **extra):
+                chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                         "model": model, "choices": choices, **extra}
+                await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+
+            for word in words:
+                await send([{"index": 0, "delta": {"content": word}, "finish_reason": None}])
+                await asyncio.sleep(self.token_delay)
+            await send([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            if body.get("stream_options", {}).get("include_usage"):
+                await send([], usage=usage)
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+            self.served[model] += 1
+            return response
+        except ConnectionResetError:
+            # Клиент отменил запрос (например, проигравший дублирующий запрос)
+            return web.Response(status=499)
+        finally:
+            self.active -= 1
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--max-concurrency", type=int, default=0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--model", action="append", default=[], help="модель:latency=3,error_rate=0.5")
+    args = parser.parse_args()
+    models = {}
+    for item in args.model:
+        model, _, options = item.partition(":")
+        models[model] = {key: float(value) for key, value in (option.split("=") for option in options.split(",") if option)}
+    fake = FakeOpenAI(latency=args.latency, max_concurrency=args.max_concurrency, error_rate=args.error_rate, models=models)
+    web.run_app(fake.app(), port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Локальный фейковый Telegram Bot API для нагрузочных тестов.
+
+Отвечает на запросы вида /bot<token>/<method> правдоподобными объектами (Message, User, True),
+с настраиваемой задержкой, и считает вызовы по методам.
+
+Запуск отдельно: python benchmarks/fake_telegram.py --port 8082 --latency 0.05
+"""
+import argparse
+import asyncio
+import itertools
+import time
+from collections import Counter
+
+from aiohttp import web
+
+BOT_USER = {"id": 1000000, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+
+# Методы, которые возвращают отправленное или изменённое сообщение
+MESSAGE_METHODS = {"sendMessage", "editMessageText", "editMessageReplyMarkup", "sendDocument", "sendPhoto"}
+
+
+class FakeTelegram:
+    def __init__(self, latency: float = 0.05):
+        self.latency = latency
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=50 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await request.post()
+        self.calls[method] += 1
+        await asyncio.sleep(self.latency)
+
+        if method == "getMe":
+            result = BOT_USER
+        elif method in MESSAGE_METHODS:
+            chat_id = int(params.get("chat_id") or 0)
+            message_id = int(params["message_id"]) if params.get("message_id") else next(self._message_ids)
+            result = {
+                "message_id": message_id, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--latency", type=float, default=0.05)
+    args = parser.parse_args()
+    web.run_app(FakeTelegram(latency=args.latency).app(), port=args.port)
+
+
+if __name__ == "__main__":
+    main()
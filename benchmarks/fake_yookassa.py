@@ -0,0 +1,124 @@
+"""Локальный фейковый API ЮKassa для нагрузочных тестов.
+
+POST /v3/payments создаёт платёж и возвращает ссылку на оплату. Если задан `webhook_url`,
+через `confirm_delay` секунд сервер сам присылает боту уведомление payment.succeeded,
+как будто пользователь оплатил. Повторный запрос с тем же Idempotence-Key возвращает тот же платёж.
+
+FakePaymentProvider — та же замена без HTTP, для прогонов BillingEngine в одном процессе.
+
+Запуск отдельно: python benchmarks/fake_yookassa.py --port 8083 --webhook-url http://127.0.0.1:8000/yookassa_webhook
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import uuid
+from collections import Counter
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from payments import TransientPaymentError
+
+
+class FakePaymentProvider:
+    """Локальная замена провайдера для нагрузочных тестов.
+
+    Как и настоящий API, на повтор запроса с тем же ключом идемпотентности
+    возвращает уже созданный платёж, а не создаёт новый.
+    """
+
+    def __init__(self, latency: float = 0.05, transient_error_rate: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.transient_error_rate = transient_error_rate
+        self.error_rate = error_rate
+        self.payments = {}
+        self.charges_per_user = Counter()
+        self.requests = 0
+
+    async def create_payment(self, payload: dict, idempotency_key: str):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        if idempotency_key in self.payments:
+            return self.payments[idempotency_key]
+        roll = random.random()
+        if roll < self.transient_error_rate:
+            raise TransientPaymentError("fake provider is busy")
+        if roll < self.transient_error_rate + self.error_rate:
+            raise ValueError("payment method declined")
+        payment = {"id": str(uuid.uuid4()), "status": "pending", "metadata": payload.get("metadata", {})}
+        self.payments[idempotency_key] = payment
+        self.charges_per_user[payload.get("metadata", {}).get("user_id")] += 1
+        return payment
+
+
+class FakeYooKassa:
+    def __init__(self, latency: float = 0.2, webhook_url: str = None, confirm_delay: float = 0.5):
+        self.latency = latency
+        self.webhook_url = webhook_url
+        self.confirm_delay = confirm_delay
+        self.payments = {}
+        self.created = 0
+        self.webhooks_sent = 0
+        self._tasks = set()
+        self._session = None
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v3/payments", self.create_payment)
+        app.on_cleanup.append(self._cleanup)
+        return app
+
+    async def create_payment(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        await asyncio.sleep(self.latency)
+        key = request.headers.get("Idempotence-Key") or uuid.uuid4().hex
+        payment = self.payments.get(key)
+        if payment is None:
+            self.created += 1
+            payment_id = uuid.uuid4().hex
+            payment = self.payments[key] = {
+                "id": payment_id, "status": "pending", "paid": False,
+                "amount": body.get("amount"), "metadata": body.get("metadata", {}),
+                "confirmation": {"type": "redirect", "confirmation_url": f"https://yoomoney.example/checkout/{payment_id}"},
+            }
+            if self.webhook_url and body.get("confirmation"):
+                task = asyncio.create_task(self._confirm(payment))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        return web.json_response(payment)
+
+    async def _confirm(self, payment: dict):
+        await asyncio.sleep(self.confirm_delay)
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        succeeded = {
+            **payment, "status": "succeeded", "paid": True,
+            "payment_method": {"id": f"pm-{payment['id']}", "saved": True},
+        }
+        async with self._session.post(self.webhook_url, json={"event": "payment.succeeded", "object": succeeded}) as response:
+            await response.read()
+        self.webhooks_sent += 1
+
+    async def _cleanup(self, app):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8083)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--webhook-url")
+    args = parser.parse_args()
+    web.run_app(FakeYooKassa(latency=args.latency, webhook_url=args.webhook_url).app(), port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+"""Сквозной нагрузочный тест бота на локальных фейках Telegram, OpenAI и ЮKassa.
+
+Поднимает настоящее приложение из main.create_app() и отправляет в /webhook синтетические
+апдейты: /start, анкета UserJourney, генерация плана, оплата (фейковая ЮKassa сама присылает
+уведомление об успешном платеже), сессия по плану и свободный диалог. Пользователи идут
+параллельно (не больше --concurrency одновременно), апдейты одного пользователя — по очереди.
+
+Отчёт: апдейтов в секунду, p50/p95/p99 времени обработки апдейта (всего и по шагам сценария),
+рост RSS процесса, число вызовов фейковых сервисов. --json сохраняет отчёт,
+--baseline сравнивает с сохранённым и с --max-regression завершается с кодом 1 при ухудшении.
+
+Запуск: python benchmarks/loadtest.py [--users 200] [--concurrency 50] [--json result.json] [--baseline base.json]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import resource
+import socket
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import ClientSession, web
+
+from fake_openai import FakeOpenAI
+from fake_telegram import FakeTelegram
+from fake_yookassa import FakeYooKassa
+
+BOT_TOKEN = "123456:LOADTEST"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        # Не Linux: пиковое значение вместо текущего
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+
+async def start_site(app: web.Application, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+class UpdateRecorder:
+    """Outer middleware диспетчера: время обработки каждого апдейта и сигнал о его завершении."""
+
+    def __init__(self):
+        self.steps = {}
+        self.waiters = {}
+        self.durations = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def expect(self, update_id: int, step: str) -> asyncio.Future:
+        self.steps[update_id] = step
+        future = self.waiters[update_id] = asyncio.get_running_loop().create_future()
+        return future
+
+    async def __call__(self, handler, event, data):
+        step = self.steps.pop(event.update_id, "other")
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            self.errors[step] += 1
+            raise
+        finally:
+            self.durations[step].append(time.perf_counter() - started)
+            future = self.waiters.pop(event.update_id, None)
+            if future is not None and not future.done():
+                future.set_result(None)
+
+
+class Scenario:
+    """Синтетический пользователь: шаги сценария отправляются в /webhook как апдейты Telegram."""
+
+    def __init__(self, harness, user_id: int, turns: int):
+        self.harness = harness
+        self.user_id = user_id
+        self.turns = turns
+        self.user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "language_code": "ru"}
+        self.chat = {"id": user_id, "type": "private"}
+
+    async def message(self, step: str, text: str):
+        await self.harness.send(step, {"message": {
+            "message_id": next(self.harness.message_ids), "date": int(time.time()),
+            "chat": self.chat, "from": self.user, "text": text,
+        }})
+
+    async def callback(self, step: str, data: str):
+        await self.harness.send(step, {"callback_query": {
+            "id": str(next(self.harness.message_ids)), "from": self.user, "chat_instance": str(self.user_id), "data": data,
+            "message": {"message_id": 1, "date": int(time.time()), "chat": self.chat, "text": "…"},
+        }})
+
+    async def run(self):
+        await self.message("start", "/start")
+        await self.callback("survey", "agree_pressed")
+        for answer in (f"User{self.user_id}", "35", "Нет", "Тяжело после развода", "Хочу снова радоваться жизни"):
+            await self.message("survey", answer)
+        await self.message("plan_generation", "Постоянно думаю о прошлом")
+        await self.callback("plan_accept", "plan_accept")
+        await self.callback("payment", "pay_subscription")
+        await self.harness.wait_subscription(self.user_id)
+        await self.callback("session_opening", "menu_start_plan_session")
+        for turn in range(self.turns):
+            await self.message("session_turn", f"Сегодня мне немного лучше, это мой ответ номер {turn}")
+        await self.message("stop", "/stop")
+        await self.callback("free_talk", "menu_start_free_talk")
+        for turn in range(self.turns):
+            await self.message("free_talk_turn", f"Хочу просто поговорить, сообщение {turn}")
+
+
+class Harness:
+    def __init__(self, args):
+        self.args = args
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.recorder = UpdateRecorder()
+        self.sent = 0
+        self.payment_timeouts = 0
+
+    async def send(self, step: str, payload: dict):
+        update_id = next(self.update_ids)
+        done = self.recorder.expect(update_id, step)
+        async with self.http.post(self.webhook_url, json={"update_id": update_id, **payload}) as response:
+            response.raise_for_status()
+        self.sent += 1
+        await asyncio.wait_for(done, timeout=self.args.update_timeout)
+
+    async def wait_subscription(self, user_id: int):
+        deadline = time.monotonic() + self.args.update_timeout
+        while time.monotonic() < deadline:
+            row = await self.main.db.fetchone("SELECT subscription_status FROM users WHERE user_id = ?", (user_id,))
+            if row and row[0] == "paid":
+                return
+            await asyncio.sleep(0.05)
+        self.payment_timeouts += 1
+
+    async def run(self) -> dict:
+        args = self.args
+        bot_port, telegram_port, openai_port, yookassa_port = (free_port() for _ in range(4))
+        self.webhook_url = f"http://127.0.0.1:{bot_port}/webhook"
+
+        fake_telegram = FakeTelegram(latency=args.telegram_latency)
+        fake_openai = FakeOpenAI(latency=args.openai_latency, token_delay=args.token_delay, max_concurrency=args.openai_server_limit)
+        fake_yookassa = FakeYooKassa(
+            latency=args.yookassa_latency, webhook_url=f"http://127.0.0.1:{bot_port}/yookassa_webhook",
+            confirm_delay=args.confirm_delay,
+        )
+        fakes = [await start_site(fake.app(), port) for fake, port in (
+            (fake_telegram, telegram_port), (fake_openai, openai_port), (fake_yookassa, yookassa_port),
+        )]
+
+        workdir = tempfile.mkdtemp(prefix="loadtest-")
+        os.environ.update({
+            "TELEGRAM_BOT_TOKEN": BOT_TOKEN, "ADMIN_ID": "1",
+            "TELEGRAM_API_URL": f"http://127.0.0.1:{telegram_port}",
+            "OPENAI_API_KEY": "loadtest", "OPENAI_BASE_URL": f"http://127.0.0.1:{openai_port}/v1",
+            "YOOKASSA_SHOP_ID": "loadtest", "YOOKASSA_SECRET_KEY": "loadtest",
+            "YOOKASSA_API_URL": f"http://127.0.0.1:{yookassa_port}/v3",
+            "WEBHOOK_URL": f"http://127.0.0.1:{bot_port}",
+            "DB_FILE": os.path.join(workdir, "bot_data.db"),
+            "OPENAI_TOKENS_PER_MINUTE": str(args.openai_tpm),
+            "OPENAI_MAX_CONCURRENCY": str(args.openai_concurrency),
+        })
+        for item in args.env:
+            key, _, value = item.partition("=")
+            os.environ[key] = value
+        os.chdir(workdir)
+
+        import main
+        self.main = main
+        main.init_db()
+        main.dp.update.outer_middleware(self.recorder)
+        bot_runner = await start_site(main.create_app(), bot_port)
+        await main.bot_startup.wait()
+
+        rss_start = rss_mb()
+        semaphore = asyncio.Semaphore(args.concurrency)
+        failed_users = 0
+
+        async def run_user(user_id):
+            nonlocal failed_users
+            async with semaphore:
+                try:
+                    await Scenario(self, user_id, args.turns).run()
+                except Exception as e:
+                    failed_users += 1
+                    logging.error(f"Сценарий пользователя {user_id} прерван: {e!r}")
+
+        async with ClientSession() as self.http:
+            started = time.perf_counter()
+            await asyncio.gather(*(run_user(100000 + index) for index in range(args.users)))
+            elapsed = time.perf_counter() - started
+        rss_end = rss_mb()
+
+        await bot_runner.cleanup()
+        for runner in fakes:
+            await runner.cleanup()
+
+        all_durations = [d for durations in self.recorder.durations.values() for d in durations]
+        return {
+            "config": {key: value for key, value in vars(args).items() if key not in ("json", "baseline")},
+            "users": args.users,
+            "failed_users": failed_users,
+            "payment_timeouts": self.payment_timeouts,
+            "updates": self.sent,
+            "elapsed_seconds": round(elapsed, 3),
+            "updates_per_second": round(self.sent / elapsed, 2) if elapsed else 0,
+            "latency_ms": self._latency(all_durations),
+            "steps": {
+                step: {"count": len(durations), "errors": self.recorder.errors.get(step, 0), **self._latency(durations)}
+                for step, durations in sorted(self.recorder.durations.items())
+            },
+            "handler_errors": sum(self.recorder.errors.values()),
+            "rss_mb": {"start": round(rss_start, 1), "end": round(rss_end, 1), "growth": round(rss_end - rss_start, 1)},
+            "fake_services": {
+                "telegram_calls": dict(fake_telegram.calls),
+                "openai_requests": fake_openai.requests, "openai_rejected": fake_openai.rejected,
+                "yookassa_payments": fake_yookassa.created, "yookassa_webhooks": fake_yookassa.webhooks_sent,
+            },
+        }
+
+    @staticmethod
+    def _latency(durations: list) -> dict:
+        return {f"p{p}": round(percentile(durations, p) * 1000, 1) for p in (50, 95, 99)}
+
+
+# Метрика, направление («больше — лучше» или нет) и путь к значению в отчёте
+COMPARED = [
+    ("updates_per_second", True, ("updates_per_second",)),
+    ("latency p50, ms", False, ("latency_ms", "p50")),
+    ("latency p95, ms", False, ("latency_ms", "p95")),
+    ("latency p99, ms", False, ("latency_ms", "p99")),
+    ("rss growth, MB", False, ("rss_mb", "growth")),
+]
+
+
+def compare(report: dict, baseline: dict, max_regression: float) -> bool:
+    """Печатает сравнение с базовым отчётом; возвращает False, если что-то ухудшилось сильнее max_regression."""
+    ok = True
+    print(f"\n{'metric':<20}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, higher_is_better, path in COMPARED:
+        current, base = report, baseline
+        for key in path:
+            current, base = current[key], base[key]
+        change = (current - base) / base if base else 0.0
+        worse = -change if higher_is_better else change
+        flag = ""
+        if name != "rss growth, MB" and max_regression is not None and worse > max_regression:
+            flag, ok = "  REGRESSION", False
+        print(f"{name:<20}{base:>12}{current:>12}{change:>+10.1%}{flag}")
+    return ok
+
+
+def print_report(report: dict):
+    print(f"users: {report['users']} (failed: {report['failed_users']}, payment timeouts: {report['payment_timeouts']})")
+    print(f"updates: {report['updates']} in {report['elapsed_seconds']} s -> {report['updates_per_second']} updates/s")
+    latency = report["latency_ms"]
+    print(f"handler latency, ms: p50 {latency['p50']}  p95 {latency['p95']}  p99 {latency['p99']}")
+    print(f"handler errors: {report['handler_errors']}")
+    print(f"RSS, MB: {report['rss_mb']['start']} -> {report['rss_mb']['end']} (+{report['rss_mb']['growth']})")
+    print(f"\n{'step':<18}{'count':>8}{'errors':>8}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for step, stats in report["steps"].items():
+        print(f"{step:<18}{stats['count']:>8}{stats['errors']:>8}{stats['p50']:>10}{stats['p95']:>10}{stats['p99']:>10}")
+    print(f"\nfake services: {json.dumps(report['fake_services'], ensure_ascii=False)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50, help="сколько пользователей проходят сценарий одновременно")
+    parser.add_argument("--turns", type=int, default=3, help="реплик в сессии по плану и в свободном диалоге")
+    parser.add_argument("--telegram-latency", type=float, default=0.05)
+    parser.add_argument("--openai-latency", type=float, default=0.3)
+    parser.add_argument("--token-delay", type=float, default=0.005)
+    parser.add_argument("--openai-server-limit", type=int, default=0, help="429 сверх этого числа одновременных запросов (0 — без лимита)")
+    parser.add_argument("--openai-tpm", type=int, default=10_000_000, help="OPENAI_TOKENS_PER_MINUTE для бота")
+    parser.add_argument("--openai-concurrency", type=int, default=64, help="OPENAI_MAX_CONCURRENCY для бота")
+    parser.add_argument("--yookassa-latency", type=float, default=0.2)
+    parser.add_argument("--confirm-delay", type=float, default=0.5, help="через сколько секунд «пользователь оплачивает»")
+    parser.add_argument("--update-timeout", type=float, default=120)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="дополнительные переменные окружения бота")
+    parser.add_argument("--json", help="куда сохранить отчёт")
+    parser.add_argument("--baseline", help="отчёт предыдущего прогона для сравнения")
+    parser.add_argument("--max-regression", type=float, default=None, help="допустимое ухудшение, например 0.1 = 10%%")
+    args = parser.parse_args()
+    args.json = os.path.abspath(args.json) if args.json else None
+    args.baseline = os.path.abspath(args.baseline) if args.baseline else None
+
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+    report = asyncio.run(Harness(args).run())
+    print_report(report)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if not compare(report, baseline, args.max_regression):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+import asyncio
+import json
+import logging
+import random
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from payments import TransientPaymentError
+from ratelimit import TokenBucket
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS billing_runs (
+    id TEXT PRIMARY KEY,
+    started_at DATETIME NOT NULL,
+    finished_at DATETIME NOT NULL,
+    attempted INTEGER NOT NULL,
+    succeeded INTEGER NOT NULL,
+    failed INTEGER NOT NULL,
+    retried INTEGER NOT NULL,
+    failures TEXT
+);
+"""
+
+# Пространство имён для ключей идемпотентности автосписаний
+IDEMPOTENCY_NAMESPACE = uuid.UUID("6f1c2f0e-8a0b-4f55-9d7e-3c2b1a9e5d10")
+
+RECURRING_PRICE = "250.00"
+RECURRING_DAYS = 7
+
+
+def create_schema(conn):
+    conn.executescript(SCHEMA)
+
+
+@dataclass
+class BillingReport:
+    run_id: str = field(default_factory=lambda: str(uuid.uuid4()))
+    started_at: datetime = field(default_factory=datetime.utcnow)
+    finished_at: datetime = None
+    attempted: int = 0
+    succeeded: int = 0
+    failed: int = 0
+    retried: int = 0
+    failures: list = field(default_factory=list)
+
+    def summary(self) -> str:
+        duration = (self.finished_at - self.started_at).total_seconds() if self.finished_at else 0
+        return (
+            f"billing run {self.run_id}: attempted={self.attempted} succeeded={self.succeeded} "
+            f"failed={self.failed} retried={self.retried} in {duration:.1f}s"
+        )
+
+
+def save_report(conn, report: BillingReport):
+    conn.execute(
+        "INSERT INTO billing_runs (id, started_at, finished_at, attempted, succeeded, failed, retried, failures) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (report.run_id, report.started_at.isoformat(), report.finished_at.isoformat(), report.attempted,
+         report.succeeded, report.failed, report.retried, json.dumps(report.failures, ensure_ascii=False))
+    )
+
+
+def idempotency_key(user_id: int, period: str) -> str:
+    """Ключ идемпотентности списания: один и тот же для пользователя и продлеваемого периода."""
+    return str(uuid.uuid5(IDEMPOTENCY_NAMESPACE, f"recurring:{user_id}:{period}"))
+
+
+class BillingEngine:
+    """Автосписания с ограниченной параллельностью и частотой запросов к провайдеру.
+
+    Каждое списание получает детерминированный ключ идемпотентности (пользователь +
+    дата окончания продлеваемого периода), так что повторный запуск не спишет деньги дважды.
+    Временные ошибки повторяются с экспоненциальной задержкой.
+    """
+
+    def __init__(self, provider, concurrency: int = 10, rate_per_second: float = 5, max_retries: int = 3,
+                 backoff: float = 1.0, on_failure=None):
+        self.provider = provider
+        self.concurrency = concurrency
+        self.rate_limiter = TokenBucket(rate_per_second)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.on_failure = on_failure
+
+    async def run(self, charges) -> BillingReport:
+        """Списывает оплату для каждого (user_id, payment_method_id, period) из `charges`."""
+        report = BillingReport()
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+
+        async def worker():
+            while True:
+                charge = await queue.get()
+                try:
+                    await self._charge(report, *charge)
+                finally:
+                    queue.task_done()
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            for charge in charges:
+                await queue.put(charge)
+            await queue.join()
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        report.finished_at = datetime.utcnow()
+        return report
+
+    async def _charge(self, report: BillingReport, user_id: int, payment_method_id: str, period: str):
+        report.attempted += 1
+        payload = {
+            "amount": {"value": RECURRING_PRICE, "currency": "RUB"},
+            "capture": True,
+            "payment_method_id": payment_method_id,
+            "description": f"Автопродление подписки на {RECURRING_DAYS} дней",
+            "metadata": {"user_id": user_id, "duration_days": RECURRING_DAYS}
+        }
+        key = idempotency_key(user_id, period)
+        for attempt in range(self.max_retries + 1):
+            await self.rate_limiter.acquire()
+            try:
+                await self.provider.create_payment(payload, key)
+                report.succeeded += 1
+                return
+            except TransientPaymentError as e:
+                if attempt == self.max_retries:
+                    error = e
+                    break
+                report.retried += 1
+                delay = self.backoff * 2 ** attempt
+                await asyncio.sleep(delay + random.uniform(0, delay / 2))
+            except Exception as e:
+                error = e
+                break
+
+        report.failed += 1
+        report.failures.append({"user_id": user_id, "error": str(error)})
+        logging.error(f"Failed to charge user {user_id}: {error}")
+        if self.on_failure is not None:
+            try:
+                await self.on_failure(user_id, error)
+            except Exception as e:
+                logging.error(f"Failed to notify user {user_id} about failed charge: {e}")
@@ -0,0 +1,250 @@
+import asyncio
+import contextvars
+import logging
+import time
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+from ratelimit import TokenBucket
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    text TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'running',
+    last_user_id INTEGER NOT NULL DEFAULT 0,
+    total INTEGER NOT NULL DEFAULT 0,
+    sent INTEGER NOT NULL DEFAULT 0,
+    blocked INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    admin_chat_id INTEGER NOT NULL,
+    progress_message_id INTEGER,
+    created_at DATETIME NOT NULL,
+    finished_at DATETIME
+);
+"""
+
+# Пользователи, заблокировавшие бота, пропускаются рассылками, пока снова не разблокируют его
+USER_COLUMNS = {"bot_blocked": "INTEGER NOT NULL DEFAULT 0"}
+
+# Запросы к Telegram, сделанные внутри рассылки, помечаются этим флагом
+broadcast_traffic = contextvars.ContextVar("broadcast_traffic", default=False)
+
+
+def create_schema(conn):
+    conn.executescript(SCHEMA)
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(users)")}
+    for column, definition in USER_COLUMNS.items():
+        if column not in existing:
+            conn.execute(f"ALTER TABLE users ADD COLUMN {column} {definition}")
+
+
+def set_blocked(conn, user_ids: list, blocked: bool = True):
+    conn.executemany("UPDATE users SET bot_blocked = ? WHERE user_id = ?", [(int(blocked), user_id) for user_id in user_ids])
+
+
+class OutgoingRateLimiter(BaseRequestMiddleware):
+    """Общий лимит исходящих запросов бота к Telegram.
+
+    Обычные ответы пользователям никогда не ждут, но расходуют токены (в том числе в долг),
+    а рассылка ждёт, пока токены появятся. Так рассылка забирает только свободную часть лимита.
+    """
+
+    def __init__(self, rate: float = 25):
+        self.bucket = TokenBucket(rate)
+
+    async def __call__(self, make_request, bot, method):
+        if broadcast_traffic.get():
+            await self.bucket.acquire()
+        else:
+            self.bucket.consume()
+        return await make_request(bot, method)
+
+
+def cancel_keyboard(broadcast_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="⏹ Остановить рассылку", callback_data=f"broadcast_cancel_{broadcast_id}")
+    ]])
+
+
+class BroadcastEngine:
+    """Рассылка сообщения всем пользователям из `users`, кроме заблокировавших бота.
+
+    Получатели читаются страницами по возрастанию user_id (курсор — последний обработанный id),
+    после каждой страницы прогресс сохраняется в `broadcasts`, поэтому после перезапуска
+    рассылка продолжается с места остановки. Ход рассылки виден в сообщении администратору.
+
+    Рассылки ведёт только процесс, для которого `is_active()` истинно (лидер). Остальные
+    процессы лишь создают запись в `broadcasts`, а лидер подхватывает её в `resume()`.
+    Перед каждой страницей статус перечитывается из БД, поэтому отмена из любого процесса
+    останавливает рассылку, а процесс, потерявший лидерство, прекращает отправку.
+
+    Ответ 429 (TelegramRetryAfter) приостанавливает все отправки рассылок процесса до общего
+    срока `_resume_at`, а не только ту, что его получила. Получатели, ответившие
+    TelegramForbiddenError, помечаются в `users.bot_blocked` и в следующие рассылки не попадают.
+    """
+
+    def __init__(self, db, bot, page_size: int = 100, concurrency: int = 10, progress_interval: float = 5,
+                 is_active=lambda: True):
+        self.db = db
+        self.bot = bot
+        self.is_active = is_active
+        self.page_size = page_size
+        self.concurrency = concurrency
+        self.progress_interval = progress_interval
+        self._tasks = {}
+        self._cancelled = set()
+        self._resume_at = 0.0
+
+    async def start(self, text: str, admin_chat_id: int) -> int:
+        total = (await self.db.fetchone("SELECT COUNT(*) FROM users WHERE bot_blocked = 0"))[0]
+        broadcast_id = await self.db.transaction(lambda conn: conn.execute(
+            "INSERT INTO broadcasts (text, total, admin_chat_id, created_at) VALUES (?, ?, ?, datetime('now'))",
+            (text, total, admin_chat_id)
+        ).lastrowid)
+        progress = await self.bot.send_message(
+            admin_chat_id, f"📣 Рассылка #{broadcast_id} запущена: {total} получателей.", reply_markup=cancel_keyboard(broadcast_id)
+        )
+        await self.db.execute("UPDATE broadcasts SET progress_message_id = ? WHERE id = ?", (progress.message_id, broadcast_id))
+        # Не лидер только сохраняет рассылку: её подхватит лидер при следующем resume()
+        if self.is_active():
+            self._spawn(broadcast_id)
+        return broadcast_id
+
+    async def resume(self):
+        """Запускает рассылки в статусе running, которые ещё не идут в этом процессе (после перезапуска
+        или созданные другим процессом)."""
+        if not self.is_active():
+            return
+        for (broadcast_id,) in await self.db.fetchall("SELECT id FROM broadcasts WHERE status = 'running'"):
+            if broadcast_id not in self._tasks:
+                logging.info(f"Продолжаю рассылку #{broadcast_id}")
+                self._spawn(broadcast_id)
+
+    async def cancel(self, broadcast_id: int) -> bool:
+        """Отменяет рассылку. Если она идёт в другом процессе, тот остановится перед следующей страницей."""
+        cancelled = await self.db.execute(
+            "UPDATE broadcasts SET status = 'cancelled', finished_at = datetime('now') WHERE id = ? AND status = 'running'",
+            (broadcast_id,)
+        )
+        task = self._tasks.get(broadcast_id)
+        if task is not None:
+            self._cancelled.add(broadcast_id)
+            task.cancel()
+        return cancelled > 0
+
+    async def stop(self):
+        for task in list(self._tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    def _spawn(self, broadcast_id: int):
+        if broadcast_id in self._tasks:
+            return
+        task = asyncio.create_task(self._run(broadcast_id))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    async def _send(self, user_id: int, text: str) -> str:
+        while True:
+            delay = self._resume_at - time.monotonic()
+            if delay > 0:
+                # Пауза могла продлиться, пока отправка спала: срок проверяется заново
+                await asyncio.sleep(delay)
+                continue
+            try:
+                await self.bot.send_message(user_id, text)
+                return "sent"
+            except TelegramRetryAfter as e:
+                self._resume_at = max(self._resume_at, time.monotonic() + e.retry_after)
+            except TelegramForbiddenError:
+                return "blocked"
+            except TelegramBadRequest as e:
+                logging.warning(f"Рассылка: не удалось отправить сообщение {user_id}: {e}")
+                return "failed"
+            except Exception as e:
+                logging.error(f"Рассылка: ошибка при отправке {user_id}: {e}")
+                return "failed"
+
+    async def _run(self, broadcast_id: int):
+        broadcast_traffic.set(True)
+        row = await self.db.fetchone(
+            "SELECT text, last_user_id, total, sent, blocked, failed, admin_chat_id, progress_message_id FROM broadcasts WHERE id = ?",
+            (broadcast_id,)
+        )
+        text, last_user_id, total, sent, blocked, failed, admin_chat_id, progress_message_id = row
+        counts = {"sent": sent, "blocked": blocked, "failed": failed}
+        started, done_at_start = time.monotonic(), sum(counts.values())
+        last_progress = 0.0
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def send(user_id):
+            async with semaphore:
+                result = await self._send(user_id, text)
+                counts[result] += 1
+                if result == "blocked":
+                    blocked_ids.append(user_id)
+
+        def save_page(conn, last_user_id):
+            set_blocked(conn, blocked_ids)
+            conn.execute(
+                "UPDATE broadcasts SET last_user_id = ?, sent = ?, blocked = ?, failed = ? WHERE id = ?",
+                (last_user_id, counts["sent"], counts["blocked"], counts["failed"], broadcast_id)
+            )
+
+        async def report(final_status=None):
+            done = sum(counts.values())
+            elapsed = time.monotonic() - started
+            rate = (done - done_at_start) / elapsed if elapsed > 0 else 0
+            eta = (total - done) / rate if rate > 0 else 0
+            lines = [
+                f"📣 Рассылка #{broadcast_id}" + (f" — {final_status}" if final_status else ""),
+                f"Отправлено: {counts['sent']} из {total}",
+                f"Заблокировали бота: {counts['blocked']}, ошибки: {counts['failed']}",
+            ]
+            if not final_status:
+                lines.append(f"Скорость: {rate:.1f} сообщ./с, осталось ~{eta / 60:.0f} мин")
+            try:
+                await self.bot.edit_message_text(
+                    "\n".join(lines), chat_id=admin_chat_id, message_id=progress_message_id,
+                    reply_markup=None if final_status else cancel_keyboard(broadcast_id)
+                )
+            except Exception as e:
+                logging.warning(f"Рассылка #{broadcast_id}: не удалось обновить прогресс: {e}")
+
+        try:
+            while True:
+                status = (await self.db.fetchone("SELECT status FROM broadcasts WHERE id = ?", (broadcast_id,)))[0]
+                if status != 'running':
+                    if status == 'cancelled':
+                        self._cancelled.discard(broadcast_id)
+                        await report("остановлена")
+                    return
+                if not self.is_active():
+                    # Лидерство перешло к другому процессу: он продолжит рассылку с сохранённого места
+                    logging.info(f"Рассылка #{broadcast_id}: процесс больше не лидер, рассылка передана новому лидеру")
+                    return
+                page = await self.db.fetchall(
+                    "SELECT user_id FROM users WHERE user_id > ? AND bot_blocked = 0 ORDER BY user_id LIMIT ?",
+                    (last_user_id, self.page_size)
+                )
+                if not page:
+                    break
+                blocked_ids = []
+                await asyncio.gather(*(send(user_id) for (user_id,) in page))
+                last_user_id = page[-1][0]
+                await self.db.transaction(save_page, last_user_id)
+                if time.monotonic() - last_progress >= self.progress_interval:
+                    last_progress = time.monotonic()
+                    await report()
+        except asyncio.CancelledError:
+            # При остановке бота рассылка остаётся в статусе running и продолжится после запуска
+            if broadcast_id in self._cancelled:
+                self._cancelled.discard(broadcast_id)
+                await report("остановлена")
+            raise
+
+        await self.db.execute("UPDATE broadcasts SET status = 'done', finished_at = datetime('now') WHERE id = ? AND status = 'running'", (broadcast_id,))
+        await report("завершена")
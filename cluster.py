@@ -0,0 +1,296 @@
+"""Многопроцессный режим бота.
+
+При WORKERS > 1 `python main.py` запускает мастер: он принимает вебхуки Telegram и ЮKassa
+и пересылает их воркерам — обычным экземплярам бота на 127.0.0.1, по одному на процесс.
+Пользователь всегда попадает к одному и тому же воркеру (по user_id), апдейты одному воркеру
+пересылаются по очереди, а Telegram получает 200 только после того, как воркер принял апдейт.
+Внутри воркера `OrderedRequestHandler` обрабатывает апдейты одного пользователя строго
+последовательно. Поэтому кэш FSM пользователя живёт в одном процессе,
+а общее состояние хранится в SQLite. Хранилище FSM подключается как любое
+хранилище aiogram (BaseStorage); по умолчанию это SQLiteStorage.
+
+Плановые задачи выполняет только лидер — процесс, удерживающий аренду в таблице `leases`.
+Сроки аренды сравниваются по системным часам, поэтому процессы должны работать на одной
+машине или с синхронизированными часами.
+"""
+import asyncio
+import logging
+import os
+import sys
+import time
+
+import aiohttp
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    holder TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+
+def create_schema(conn):
+    conn.executescript(SCHEMA)
+
+
+def update_user_id(update: dict) -> int:
+    """id пользователя (или чата), от которого пришёл апдейт; 0, если его нет."""
+    for value in update.values():
+        if isinstance(value, dict):
+            for field in ("from", "user", "chat"):
+                if isinstance(value.get(field), dict) and "id" in value[field]:
+                    return int(value[field]["id"])
+    return 0
+
+
+def worker_for(user_id: int, workers: int) -> int:
+    return abs(user_id) % workers
+
+
+class OrderedRequestHandler(SimpleRequestHandler):
+    """Обработчик вебхука, который обрабатывает апдейты одного пользователя по очереди.
+
+    Задачи на обработку создаются в порядке поступления апдейтов и первым делом берут
+    блокировку пользователя — до того, как FSM прочитает его состояние.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._user_locks = {}
+
+    async def _background_feed_update(self, bot, update):
+        user_id = update_user_id(update)
+        if not user_id:
+            return await super()._background_feed_update(bot, update)
+        entry = self._user_locks.setdefault(user_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super()._background_feed_update(bot, update)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._user_locks[user_id]
+
+
+class LeaderLease:
+    """Выборы лидера через аренду строки в `leases`.
+
+    Процесс продлевает аренду каждые ttl/3 секунд; если держатель пропал,
+    после истечения срока аренду забирает другой процесс. `on_elected()` вызывается
+    при каждом получении лидерства.
+    """
+
+    def __init__(self, db, name: str, holder: str, ttl: float = 30, on_elected=None):
+        self.db = db
+        self.name = name
+        self.holder = holder
+        self.ttl = ttl
+        self.on_elected = on_elected
+        self._valid_until = 0.0
+        self._task = None
+
+    @property
+    def is_leader(self) -> bool:
+        return time.monotonic() < self._valid_until
+
+    def _acquire(self, conn, now: float) -> bool:
+        return conn.execute(
+            """
+            INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+            WHERE leases.holder = excluded.holder OR leases.expires_at < ?
+            """,
+            (self.name, self.holder, now + self.ttl, now)
+        ).rowcount == 1
+
+    async def _attempt(self):
+        started = time.monotonic()
+        was_leader = self.is_leader
+        try:
+            acquired = await self.db.transaction(self._acquire, time.time())
+        except Exception as e:
+            # Не смогли продлить — остаёмся лидером до конца уже полученного срока
+            logging.error(f"Не удалось продлить аренду {self.name}: {e}")
+            return
+        if not acquired:
+            self._valid_until = 0.0
+            if was_leader:
+                logging.warning(f"Аренда {self.name} перешла к другому процессу")
+            return
+        self._valid_until = started + self.ttl
+        if not was_leader:
+            logging.info(f"Процесс {self.holder} стал лидером ({self.name})")
+            if self.on_elected is not None:
+                try:
+                    await self.on_elected()
+                except Exception as e:
+                    logging.error(f"Ошибка при вступлении в лидерство: {e}")
+
+    async def _renew_forever(self):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            await self._attempt()
+
+    async def start(self):
+        await self._attempt()
+        if self._task is None:
+            self._task = asyncio.create_task(self._renew_forever())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.is_leader:
+            self._valid_until = 0.0
+            await self.db.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (self.name, self.holder))
+
+    def only(self, job):
+        """Обёртка для плановой задачи: на остальных процессах задача пропускается."""
+        async def run_if_leader(*args, **kwargs):
+            if not self.is_leader:
+                logging.info(f"{job.__name__}: процесс не лидер, задача пропущена")
+                return
+            return await job(*args, **kwargs)
+        run_if_leader.__name__ = job.__name__
+        return run_if_leader
+
+
+class WorkerPool:
+    """Запускает воркеры — тот же скрипт с WORKER_INDEX и своим портом — и перезапускает упавшие."""
+
+    def __init__(self, count: int, script: str, base_port: int, host: str = "127.0.0.1"):
+        self.count = count
+        self.script = script
+        self.base_port = base_port
+        self.host = host
+        self._processes = {}
+        self._tasks = []
+        self._stopping = False
+        self.restarts = 0
+
+    @property
+    def urls(self) -> list:
+        return [f"http://{self.host}:{self.base_port + index}" for index in range(self.count)]
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._supervise(index)) for index in range(self.count)]
+
+    async def _supervise(self, index: int):
+        env = {**os.environ, "WORKER_INDEX": str(index), "PORT": str(self.base_port + index), "WEB_SERVER_HOST": self.host}
+        while not self._stopping:
+            process = await asyncio.create_subprocess_exec(sys.executable, self.script, env=env)
+            self._processes[index] = process
+            code = await process.wait()
+            if self._stopping:
+                return
+            self.restarts += 1
+            logging.error(f"Воркер {index} завершился с кодом {code}, перезапускаю")
+            await asyncio.sleep(1)
+
+    async def stop(self, timeout: float = 30):
+        self._stopping = True
+        for process in self._processes.values():
+            if process.returncode is None:
+                process.terminate()
+        try:
+            await asyncio.wait_for(asyncio.gather(*self._tasks, return_exceptions=True), timeout)
+        except asyncio.TimeoutError:
+            for process in self._processes.values():
+                if process.returncode is None:
+                    process.kill()
+
+
+class UpdateRouter:
+    """Мастер: раскладывает апдейты по воркерам.
+
+    Апдейт пересылается воркеру синхронно, и Telegram получает 200 только после того, как
+    воркер его принял. Если воркер недоступен дольше `retry_for` секунд (перезапускается),
+    мастер отвечает 503 и Telegram повторит доставку сам — у мастера нет очереди, которая
+    пропала бы при его падении. Пересылки одному воркеру идут по очереди, в порядке поступления.
+    """
+
+    def __init__(self, worker_urls: list, retry_for: float = 5):
+        self.worker_urls = worker_urls
+        self.retry_for = retry_for
+        self._locks = [asyncio.Lock() for _ in worker_urls]
+        self._session = None
+        self.forwarded = 0
+        self.rejected = 0
+        self.retries = 0
+
+    def start(self):
+        self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+
+    async def stop(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def webhook_handler(self, request: web.Request) -> web.Response:
+        update = await request.json()
+        index = worker_for(update_user_id(update), len(self.worker_urls))
+        if await self._forward(index, update):
+            return web.json_response({})
+        # Telegram повторит доставку позже; повтор уже принятого апдейта отсеет дедупликация воркера
+        self.rejected += 1
+        logging.error(f"Апдейт {update.get('update_id')} не принят воркером {index}, Telegram повторит доставку")
+        return web.Response(status=503, headers={"Retry-After": "1"})
+
+    async def _forward(self, index: int, update: dict) -> bool:
+        url = f"{self.worker_urls[index]}/webhook"
+        async with self._locks[index]:
+            deadline = time.monotonic() + self.retry_for
+            delay = 0.1
+            while True:
+                try:
+                    async with self._session.post(url, json=update) as response:
+                        if response.status < 500:
+                            self.forwarded += 1
+                            return True
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    pass
+                # Воркер ещё запускается или перезапускается
+                if time.monotonic() + delay > deadline:
+                    return False
+                self.retries += 1
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 1)
+
+    async def yookassa_handler(self, request: web.Request) -> web.Response:
+        """Уведомление ЮKassa пересылается воркеру пользователя синхронно: ответ 200 означает, что событие сохранено."""
+        body = await request.read()
+        try:
+            user_id = int(((await request.json()).get("object") or {}).get("metadata", {}).get("user_id", 0))
+        except (ValueError, TypeError, AttributeError):
+            user_id = 0
+        url = self.worker_urls[worker_for(user_id, len(self.worker_urls))]
+        try:
+            async with self._session.post(f"{url}/yookassa_webhook", data=body,
+                                          headers={"Content-Type": "application/json"}) as response:
+                return web.Response(status=response.status)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error(f"Не удалось передать уведомление ЮKassa воркеру: {e!r}")
+            return web.Response(status=503)
+
+    async def worker_metrics(self, token: str = None) -> dict:
+        """Тексты /metrics воркеров: номер воркера -> текст (недоступные воркеры пропускаются)."""
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+
+        async def fetch(url):
+            try:
+                async with self._session.get(f"{url}/metrics", headers=headers,
+                                             timeout=aiohttp.ClientTimeout(total=2)) as response:
+                    return await response.text() if response.status == 200 else None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logging.warning(f"Не удалось снять метрики воркера {url}: {e!r}")
+                return None
+
+        texts = await asyncio.gather(*(fetch(url) for url in self.worker_urls))
+        return {str(index): text for index, text in enumerate(texts) if text is not None}
+
+    def metrics(self) -> dict:
+        return {"forwarded": self.forwarded, "rejected": self.rejected, "retries": self.retries}
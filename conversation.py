@@ -0,0 +1,165 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+
+from streaming import chat_completion
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+SUMMARY_PROMPT = """
+Ты ведёшь краткий конспект психологической сессии. Ниже — предыдущий конспект (может быть пустым) и новый фрагмент диалога.
+Обнови конспект: сохрани факты о пользователе, его чувства, ключевые мысли, договорённости и пройденные темы плана.
+Пиши сжато, от третьего лица, без вступлений.
+
+Предыдущий конспект:
+{summary}
+
+Новый фрагмент диалога:
+{dialog}
+"""
+
+_encoding = None
+
+
+def count_tokens(text: str) -> int:
+    """Число токенов в тексте: точно через tiktoken, если он установлен, иначе оценка."""
+    global _encoding
+    if tiktoken is not None:
+        if _encoding is None:
+            _encoding = tiktoken.get_encoding("o200k_base")
+        return len(_encoding.encode(text))
+    # Для русского текста один токен в среднем приходится на ~3 символа
+    return len(text) // 3 + 1
+
+
+def message_tokens(message: dict) -> int:
+    return count_tokens(message["content"]) + 4
+
+
+@dataclass
+class ContextBudget:
+    max_prompt_tokens: int = 6000   # предел размера запроса к модели
+    recent_tokens: int = 3000       # сколько последних реплик держать дословно
+    summary_tokens: int = 400       # длина конспекта старых реплик
+
+
+class ConversationMemory:
+    """Контекст диалога в FSM: системный промпт, конспект старых реплик и окно последних.
+
+    В данных FSM хранятся `messages` (системный промпт и ещё не свёрнутые реплики),
+    `summary` (конспект) и `summarized` — сколько первых реплик уже вошло в конспект
+    и может быть удалено. Конспект обновляется в фоне и не задерживает ответ.
+    """
+
+    def __init__(self, client, budgets: dict, summary_model: str = "gpt-4o-mini", scheduler=None, router=None):
+        self.client = client
+        self.router = router
+        self.budgets = budgets
+        self.summary_model = summary_model
+        self.scheduler = scheduler
+        self._tasks = {}
+
+    def budget(self, mode: str) -> ContextBudget:
+        return self.budgets.get(mode) or ContextBudget()
+
+    @staticmethod
+    def history(data: dict) -> list:
+        """Возвращает историю без реплик, которые уже свёрнуты в конспект."""
+        messages = list(data.get("messages", []))
+        summarized = data.get("summarized", 0)
+        if summarized:
+            messages = messages[:1] + messages[1 + summarized:]
+        return messages
+
+    def prompt(self, history: list, summary: str, mode: str) -> list:
+        """Собирает запрос к модели в пределах бюджета токенов."""
+        budget = self.budget(mode)
+        head = history[:1]
+        if summary:
+            head = head + [{"role": "system", "content": f"Краткое содержание предыдущей части разговора:\n{summary}"}]
+        available = budget.max_prompt_tokens - sum(message_tokens(m) for m in head)
+
+        window = []
+        for message in reversed(history[1:]):
+            cost = message_tokens(message)
+            if window and cost > available:
+                break
+            window.append(message)
+            available -= cost
+        return head + window[::-1]
+
+    @staticmethod
+    async def save(state, data: dict, history: list):
+        """Сохраняет историю; если конспект был применён, сбрасывает счётчик свёрнутых реплик."""
+        updates = {"messages": history}
+        if data.get("summarized"):
+            updates["summarized"] = 0
+        await state.update_data(**updates)
+
+    def maybe_summarize(self, state, mode: str):
+        """Запускает фоновое обновление конспекта, если старые реплики вышли за окно."""
+        key = state.key
+        if key in self._tasks:
+            return
+        task = asyncio.create_task(self._summarize(state, self.budget(mode)))
+        self._tasks[key] = task
+        task.add_done_callback(lambda done: self._tasks.pop(key) if self._tasks.get(key) is done else None)
+
+    def reset(self, state):
+        """Отменяет фоновое обновление конспекта: сессия завершена или начинается заново."""
+        task = self._tasks.pop(state.key, None)
+        if task is not None:
+            task.cancel()
+
+    @staticmethod
+    def _turns_to_fold(turns: list, budget: ContextBudget) -> int:
+        recent = 0
+        for index in range(len(turns) - 1, -1, -1):
+            recent += message_tokens(turns[index])
+            if recent > budget.recent_tokens:
+                return index + 1
+        return 0
+
+    async def _complete(self, request: dict):
+        # Модель для конспекта выбирает маршрутизатор, без него — summary_model
+        if self.router is not None:
+            return await self.router.complete("summary", **request)
+        return await chat_completion(self.client, "summary", model=self.summary_model, **request)
+
+    async def _summarize(self, state, budget: ContextBudget):
+        try:
+            data = await state.get_data()
+            if data.get("summarized"):
+                # Предыдущий конспект ещё не применён к истории
+                return
+            turns = data.get("messages", [])[1:]
+            fold = self._turns_to_fold(turns, budget)
+            # Сворачиваем пачками, чтобы не обращаться к модели на каждой реплике
+            if sum(message_tokens(m) for m in turns[:fold]) < budget.recent_tokens // 2:
+                return
+
+            dialog = "\n".join(
+                f"{'Пользователь' if m['role'] == 'user' else 'Психолог'}: {m['content']}" for m in turns[:fold]
+            )
+            request = dict(
+                messages=[{"role": "user", "content": SUMMARY_PROMPT.format(summary=data.get("summary", ""), dialog=dialog)}],
+                max_tokens=budget.summary_tokens,
+                temperature=0.3,
+            )
+            if self.scheduler is not None:
+                tokens = sum(message_tokens(m) for m in request["messages"]) + budget.summary_tokens
+                async with self.scheduler.slot("summary", tokens):
+                    response = await self._complete(request)
+            else:
+                response = await self._complete(request)
+            # Пока модель отвечала, сессия могла смениться (в том числе в другом процессе):
+            # конспект применяем, только если свёрнутые реплики всё ещё в начале истории
+            current = await state.get_data()
+            if current.get("summarized") or current.get("messages", [])[:1 + fold] != data["messages"][:1 + fold]:
+                return
+            await state.update_data(summary=response.choices[0].message.content, summarized=fold)
+        except Exception as e:
+            logging.error(f"Ошибка при обновлении конспекта диалога: {e}")
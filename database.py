@@ -0,0 +1,97 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+
+class Database:
+    """Асинхронный доступ к SQLite: один поток-писатель и пул потоков-читателей.
+
+    Соединения долгоживущие (по одному на поток), работают в режиме WAL,
+    поэтому чтения не блокируются записью, а запросы не выполняются в event loop.
+    """
+
+    def __init__(self, path: str, readers: int = 4, busy_timeout_ms: int = 5000):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+    # --- Соединения (создаются лениво, по одному на поток) ---
+    def _connect(self, readonly: bool) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={self.busy_timeout_ms}")
+        if readonly:
+            conn.execute("PRAGMA query_only=1")
+        with self._connections_lock:
+            self._connections.append(conn)
+        return conn
+
+    def _conn(self, readonly: bool) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect(readonly)
+            self._local.conn = conn
+        return conn
+
+    # --- Выполнение в потоках ---
+    # statement — метка для метрик: имя функции транзакции или сокращённый текст запроса
+    def _run_write(self, fn, args, statement, queued_at):
+        metrics.db_wait.observe(time.perf_counter() - queued_at, pool="writer")
+        conn = self._conn(readonly=False)
+        with metrics.db_latency.time(pool="writer", statement=statement):
+            with conn:
+                return fn(conn, *args)
+
+    def _run_read(self, fn, args, statement, queued_at):
+        metrics.db_wait.observe(time.perf_counter() - queued_at, pool="reader")
+        conn = self._conn(readonly=True)
+        with metrics.db_latency.time(pool="reader", statement=statement):
+            return fn(conn, *args)
+
+    async def _submit(self, executor, run, statement, fn, args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, run, fn, args, statement, time.perf_counter())
+
+    async def transaction(self, fn, *args):
+        """Выполняет fn(conn, *args) в потоке-писателе внутри одной транзакции."""
+        return await self._submit(self._writer, self._run_write, fn.__qualname__, fn, args)
+
+    async def read(self, fn, *args):
+        """Выполняет fn(conn, *args) на соединении только для чтения."""
+        return await self._submit(self._readers, self._run_read, fn.__qualname__, fn, args)
+
+    # --- Короткие обёртки для одиночных запросов ---
+    async def execute(self, sql: str, params=()) -> int:
+        """Выполняет запрос на запись и возвращает число затронутых строк."""
+        return await self._submit(self._writer, self._run_write, metrics.statement_label(sql),
+                                  lambda conn: conn.execute(sql, params).rowcount, ())
+
+    async def executemany(self, sql: str, seq_of_params) -> int:
+        return await self._submit(self._writer, self._run_write, metrics.statement_label(sql),
+                                  lambda conn: conn.executemany(sql, seq_of_params).rowcount, ())
+
+    async def fetchone(self, sql: str, params=()):
+        return await self._submit(self._readers, self._run_read, metrics.statement_label(sql),
+                                  lambda conn: conn.execute(sql, params).fetchone(), ())
+
+    async def fetchall(self, sql: str, params=()):
+        return await self._submit(self._readers, self._run_read, metrics.statement_label(sql),
+                                  lambda conn: conn.execute(sql, params).fetchall(), ())
+
+    def close(self) -> None:
+        """Дожидается завершения запросов и закрывает все соединения."""
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
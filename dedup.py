@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.event.bases import UNHANDLED
+
+import metrics
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS processed_updates (
+    update_id INTEGER PRIMARY KEY,
+    seen_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_processed_updates_seen_at ON processed_updates (seen_at);
+"""
+
+
+def create_schema(conn):
+    conn.executescript(SCHEMA)
+
+
+class UpdateDeduplicator(BaseMiddleware):
+    """Внешний middleware апдейтов: повторно доставленный апдейт (тот же update_id) не обрабатывается.
+
+    Telegram повторяет доставку, если не получил ответ на вебхук, а мастер многопроцессного
+    режима — если воркер не ответил вовремя; без проверки повтор означал бы второй запрос
+    к модели и дублирующиеся реплики в истории. Увиденные update_id хранятся в памяти
+    `ttl` секунд, но не больше `max_size` штук. Если передана `db`, они раз в `flush_interval`
+    секунд и при остановке сохраняются в `processed_updates` и загружаются при запуске,
+    так что повтор после перезапуска тоже отбрасывается.
+    """
+
+    def __init__(self, db=None, ttl: float = 3600, max_size: int = 100000, flush_interval: float = 5.0):
+        self.db = db
+        self.ttl = ttl
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self._seen = OrderedDict()
+        self._unsaved = []
+        self._task = None
+        self.duplicates = 0
+
+    def _evict(self, now: float):
+        while self._seen and next(iter(self._seen.values())) < now - self.ttl:
+            self._seen.popitem(last=False)
+
+    def check(self, update_id: int) -> bool:
+        """Запоминает update_id; True, если он уже встречался."""
+        now = time.time()
+        self._evict(now)
+        if update_id in self._seen:
+            return True
+        self._seen[update_id] = now
+        if len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
+        if self.db is not None:
+            self._unsaved.append((update_id, now))
+        return False
+
+    async def __call__(self, handler, event, data):
+        if self.check(event.update_id):
+            self.duplicates += 1
+            metrics.duplicate_updates.inc()
+            logging.info(f"Апдейт {event.update_id} уже получен, повтор пропущен")
+            return UNHANDLED
+        return await handler(event, data)
+
+    # --- Сохранение между перезапусками ---
+    async def load(self):
+        if self.db is None:
+            return
+        rows = await self.db.fetchall(
+            "SELECT update_id, seen_at FROM processed_updates WHERE seen_at > ? ORDER BY seen_at DESC LIMIT ?",
+            (time.time() - self.ttl, self.max_size)
+        )
+        # Словарь упорядочен по времени: старые записи должны идти первыми
+        for update_id, seen_at in reversed(rows):
+            self._seen.setdefault(update_id, seen_at)
+        logging.info(f"Загружено {len(rows)} недавних update_id для отсева повторов")
+
+    def start(self):
+        if self.db is not None and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        if not self._unsaved:
+            return
+        batch, self._unsaved = self._unsaved, []
+        try:
+            await self.db.transaction(self._save, batch, time.time() - self.ttl)
+        except Exception as e:
+            logging.error(f"Не удалось сохранить {len(batch)} update_id: {e}")
+            self._unsaved = (batch + self._unsaved)[-self.max_size:]
+
+    @staticmethod
+    def _save(conn, batch, expired_before):
+        conn.executemany("INSERT OR REPLACE INTO processed_updates (update_id, seen_at) VALUES (?, ?)", batch)
+        conn.execute("DELETE FROM processed_updates WHERE seen_at < ?", (expired_before,))
+
+    def metrics(self) -> dict:
+        return {"tracked": len(self._seen), "unsaved": len(self._unsaved), "duplicates": self.duplicates}
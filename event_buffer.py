@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import datetime
+
+
+class EventBuffer:
+    """Буфер событий аналитики: события копятся в памяти и пачками пишутся в `analytics`.
+
+    `add()` не блокирует и не обращается к БД. Сброс происходит при накоплении
+    `batch_size` событий, раз в `flush_interval` секунд и при остановке.
+    Если БД не успевает, буфер ограничен `max_size` — самые старые события отбрасываются.
+    `listeners` — функции fn(conn, batch), вызываемые в той же транзакции, что и вставка пачки.
+    """
+
+    def __init__(self, db, flush_interval: float = 1.0, batch_size: int = 500, max_size: int = 10000, listeners=()):
+        self.db = db
+        self.listeners = list(listeners)
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_size = max_size
+        self._events = deque()
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+        # Метрики
+        self.flushed_total = 0
+        self.dropped_total = 0
+        self.flush_count = 0
+        self.last_flush_duration = 0.0
+
+    @property
+    def depth(self) -> int:
+        return len(self._events)
+
+    def add(self, user_id: int, event_type: str, timestamp: datetime = None):
+        if len(self._events) >= self.max_size:
+            self._events.popleft()
+            self.dropped_total += 1
+        timestamp = timestamp or datetime.utcnow()
+        self._events.append((user_id, event_type, timestamp.isoformat(" ")))
+        if len(self._events) >= self.batch_size:
+            self._wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._events:
+                return
+            batch = list(self._events)
+            self._events.clear()
+            started = time.perf_counter()
+            try:
+                await self.db.transaction(self._write_batch, batch)
+            except Exception as e:
+                logging.error(f"Не удалось записать {len(batch)} событий аналитики: {e}")
+                # Возвращаем пачку в начало буфера, чтобы повторить при следующем сбросе
+                self._events.extendleft(reversed(batch))
+                while len(self._events) > self.max_size:
+                    self._events.popleft()
+                    self.dropped_total += 1
+                return
+            finally:
+                self.last_flush_duration = time.perf_counter() - started
+            self.flushed_total += len(batch)
+            self.flush_count += 1
+
+    def _write_batch(self, conn, batch):
+        conn.executemany(
+            "INSERT INTO analytics (user_id, event_type, timestamp) VALUES (?, ?, ?)",
+            batch
+        )
+        for listener in self.listeners:
+            listener(conn, batch)
+
+    def metrics(self) -> dict:
+        return {
+            "depth": self.depth,
+            "flushed_total": self.flushed_total,
+            "dropped_total": self.dropped_total,
+            "flush_count": self.flush_count,
+            "last_flush_duration_seconds": self.last_flush_duration,
+        }
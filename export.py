@@ -0,0 +1,158 @@
+"""Выгрузка аналитики и пользователей в CSV или NDJSON.
+
+Строки читаются страницами по первичному ключу (курсор — последний выданный id) на
+соединениях-читателях, поэтому выгрузка любого размера занимает постоянную память и
+не мешает записи. Данные отдаются по мере чтения: в HTTP-ответ с chunked-передачей
+или в файл для отправки администратору; сжатие gzip — тоже потоково.
+"""
+import asyncio
+import csv
+import hmac
+import io
+import json
+import zlib
+from datetime import date, timedelta
+
+from aiohttp import web
+
+# Для каждой таблицы: выгружаемые колонки и SQL страницы (курсор — первая колонка).
+# Из users не выгружаются id сохранённых способов оплаты и тексты планов.
+TABLES = {
+    "analytics": (
+        ["id", "user_id", "event_type", "timestamp"],
+        "SELECT id, user_id, event_type, timestamp FROM analytics "
+        "WHERE id > ? AND id <= ? AND timestamp >= ? AND timestamp < ? ORDER BY id LIMIT ?",
+    ),
+    "users": (
+        ["user_id", "subscription_status", "subscription_expires_at", "has_plan"],
+        "SELECT user_id, subscription_status, subscription_expires_at, session_plan IS NOT NULL FROM users "
+        "WHERE user_id > ? AND user_id <= ? ORDER BY user_id LIMIT ?",
+    ),
+}
+FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+MIN_DAY = "0000-01-01"
+MAX_DAY = "9999-12-31"
+
+
+def _analytics_id_range(conn, start: str, end: str):
+    """Границы id событий периода — по индексу (event_type, timestamp), отдельно для каждого типа."""
+    low, high = None, None
+    for (event_type,) in conn.execute("SELECT DISTINCT event_type FROM daily_event_counts").fetchall():
+        first = conn.execute(
+            "SELECT MIN(id) FROM analytics WHERE event_type = ? AND timestamp >= ? AND timestamp < ?", (event_type, start, end)
+        ).fetchone()[0]
+        last = conn.execute(
+            "SELECT MAX(id) FROM analytics WHERE event_type = ? AND timestamp >= ? AND timestamp < ?", (event_type, start, end)
+        ).fetchone()[0]
+        if first is not None:
+            low = first if low is None else min(low, first)
+            high = last if high is None else max(high, last)
+    return low, high
+
+
+async def iter_pages(db, table: str, start_day: str = None, end_day: str = None, page_size: int = 5000):
+    """Отдаёт страницы строк таблицы. Период [start_day, end_day] относится к analytics."""
+    _, sql = TABLES[table]
+    if table == "analytics":
+        start = start_day or MIN_DAY
+        end = (date.fromisoformat(end_day) + timedelta(days=1)).isoformat() if end_day else MAX_DAY
+        low, high = await db.read(_analytics_id_range, start, end)
+        if low is None:
+            return
+        cursor, params = low - 1, lambda cursor: (cursor, high, start, end, page_size)
+    else:
+        cursor, params = -2 ** 63, lambda cursor: (cursor, 2 ** 63 - 1, page_size)
+
+    while True:
+        page = await db.fetchall(sql, params(cursor))
+        if not page:
+            return
+        yield page
+        cursor = page[-1][0]
+
+
+def _encode(columns: list, page: list, fmt: str) -> bytes:
+    if fmt == "ndjson":
+        return "".join(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n" for row in page).encode()
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(page)
+    return buffer.getvalue().encode()
+
+
+async def export_chunks(db, table: str, fmt: str = "csv", start_day: str = None, end_day: str = None, compress: bool = False):
+    """Выгрузка по кусочкам байтов (сжатых gzip, если compress=True)."""
+    columns, _ = TABLES[table]
+    # wbits=31 — формат gzip
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+    def pack(data: bytes) -> bytes:
+        return compressor.compress(data) if compressor else data
+
+    if fmt == "csv":
+        # Заголовок CSV выдаётся и для пустой выгрузки
+        yield pack(_encode(columns, [columns], fmt))
+    async for page in iter_pages(db, table, start_day, end_day):
+        chunk = pack(_encode(columns, page, fmt))
+        if chunk:
+            yield chunk
+    if compressor:
+        yield compressor.flush()
+
+
+def export_filename(table: str, fmt: str, start_day: str = None, end_day: str = None, compress: bool = False) -> str:
+    period = f"_{start_day or 'start'}_{end_day or 'now'}" if table == "analytics" else ""
+    return f"{table}{period}.{fmt}" + (".gz" if compress else "")
+
+
+async def write_file(db, path: str, table: str, fmt: str = "csv", start_day: str = None, end_day: str = None,
+                     compress: bool = True) -> int:
+    """Пишет выгрузку в файл и возвращает его размер в байтах."""
+    size = 0
+    with open(path, "wb") as f:
+        async for chunk in export_chunks(db, table, fmt, start_day, end_day, compress):
+            await asyncio.to_thread(f.write, chunk)
+            size += len(chunk)
+    return size
+
+
+def parse_request(table: str, fmt: str, start_day: str = None, end_day: str = None):
+    """Проверяет параметры выгрузки; при ошибке бросает ValueError с понятным текстом."""
+    if table not in TABLES:
+        raise ValueError(f"неизвестная таблица {table}, доступны: {', '.join(TABLES)}")
+    if fmt not in FORMATS:
+        raise ValueError(f"неизвестный формат {fmt}, доступны: {', '.join(FORMATS)}")
+    for day in (start_day, end_day):
+        if day:
+            date.fromisoformat(day)
+
+
+def handler(db, token: str = None):
+    """Маршрут GET /export/{table}?format=csv|ndjson&from=YYYY-MM-DD&to=YYYY-MM-DD&gzip=1.
+
+    Требует заголовок Authorization: Bearer <token>; без токена выгрузка отключена.
+    """
+    async def export_handler(request: web.Request) -> web.StreamResponse:
+        if not token:
+            raise web.HTTPNotFound()
+        # Сравнение за постоянное время, чтобы токен нельзя было подобрать по времени ответа
+        if not hmac.compare_digest(request.headers.get("Authorization", "").encode(), f"Bearer {token}".encode()):
+            raise web.HTTPUnauthorized()
+        table, fmt = request.match_info["table"], request.query.get("format", "csv")
+        start_day, end_day = request.query.get("from"), request.query.get("to")
+        compress = request.query.get("gzip") in ("1", "true")
+        try:
+            parse_request(table, fmt, start_day, end_day)
+        except ValueError as e:
+            raise web.HTTPBadRequest(text=str(e))
+
+        response = web.StreamResponse(headers={
+            "Content-Type": "application/gzip" if compress else f"{FORMATS[fmt]}; charset=utf-8",
+            "Content-Disposition": f'attachment; filename="{export_filename(table, fmt, start_day, end_day, compress)}"',
+        })
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        async for chunk in export_chunks(db, table, fmt, start_day, end_day, compress):
+            await response.write(chunk)
+        await response.write_eof()
+        return response
+    return export_handler
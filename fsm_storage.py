@@ -0,0 +1,146 @@
+import asyncio
+import json
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fsm_sessions (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data BLOB,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+def create_schema(conn):
+    conn.executescript(SCHEMA)
+
+
+def encode_data(data: Mapping[str, Any]) -> Optional[bytes]:
+    if not data:
+        return None
+    return zlib.compress(json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode())
+
+
+def decode_data(blob: Optional[bytes]) -> Dict[str, Any]:
+    if not blob:
+        return {}
+    return json.loads(zlib.decompress(blob))
+
+
+class _Record:
+    __slots__ = ("state", "data", "last_access")
+
+    def __init__(self, state: Optional[str], data: Dict[str, Any]):
+        self.state = state
+        self.data = data
+        self.last_access = time.monotonic()
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в SQLite с ограниченным кэшем активных пользователей в памяти.
+
+    Состояние и данные пишутся в БД сразу (данные — сжатым JSON), поэтому переживают
+    перезапуск. В памяти держится не больше `max_cached` записей (LRU); записи,
+    к которым не обращались дольше `idle_ttl` секунд, выгружаются из памяти.
+    """
+
+    def __init__(self, db, max_cached: int = 10000, idle_ttl: float = 1800, key_builder=None):
+        self.db = db
+        self.max_cached = max_cached
+        self.idle_ttl = idle_ttl
+        self.key_builder = key_builder or DefaultKeyBuilder(with_destiny=True)
+        self._cache = OrderedDict()
+        self._eviction_task = None
+
+    def start(self):
+        if self._eviction_task is None:
+            self._eviction_task = asyncio.create_task(self._evict_idle_forever())
+
+    async def close(self) -> None:
+        if self._eviction_task is not None:
+            self._eviction_task.cancel()
+            self._eviction_task = None
+        self._cache.clear()
+
+    @property
+    def cached(self) -> int:
+        return len(self._cache)
+
+    # --- Кэш ---
+    def _remember(self, key: str, record: _Record):
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+
+    def evict_idle(self) -> int:
+        deadline = time.monotonic() - self.idle_ttl
+        evicted = 0
+        # Самые давние записи стоят в начале OrderedDict
+        while self._cache:
+            key, record = next(iter(self._cache.items()))
+            if record.last_access > deadline:
+                break
+            del self._cache[key]
+            evicted += 1
+        return evicted
+
+    async def _evict_idle_forever(self):
+        while True:
+            await asyncio.sleep(min(self.idle_ttl, 60))
+            self.evict_idle()
+
+    async def _load(self, key: str) -> _Record:
+        record = self._cache.get(key)
+        if record is None:
+            row = await self.db.fetchone("SELECT state, data FROM fsm_sessions WHERE key = ?", (key,))
+            # Пока шёл запрос, запись могла появиться в кэше
+            record = self._cache.get(key)
+            if record is None:
+                record = _Record(row[0], decode_data(row[1])) if row else _Record(None, {})
+        record.last_access = time.monotonic()
+        self._remember(key, record)
+        return record
+
+    async def _save(self, key: str, record: _Record):
+        if record.state is None and not record.data:
+            await self.db.execute("DELETE FROM fsm_sessions WHERE key = ?", (key,))
+            return
+        await self.db.execute(
+            """
+            INSERT INTO fsm_sessions (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET state = excluded.state, data = excluded.data, updated_at = excluded.updated_at
+            """,
+            (key, record.state, encode_data(record.data), time.time())
+        )
+
+    # --- Интерфейс BaseStorage ---
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self.key_builder.build(key)
+        record = await self._load(storage_key)
+        record.state = state.state if isinstance(state, State) else state
+        await self._save(storage_key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._load(self.key_builder.build(key))).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(
+                f"Data must be a dict or dict-like object, got {type(data).__name__}"
+            )
+        storage_key = self.key_builder.build(key)
+        record = await self._load(storage_key)
+        record.data = data.copy()
+        await self._save(storage_key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._load(self.key_builder.build(key))).data.copy()
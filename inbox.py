@@ -0,0 +1,226 @@
+"""Входящая очередь уведомлений ЮKassa.
+
+Вебхук только сохраняет событие в `payment_inbox` (ключ — id платежа) и сразу отвечает 200.
+Фоновые обработчики разбирают очередь и применяют каждый платёж ровно один раз.
+
+Инструмент для ручного разбора:
+    python inbox.py status             — сколько событий в каждом статусе и отставание очереди
+    python inbox.py replay [ID ...]    — вернуть неудачные события (все или указанные) в обработку
+"""
+import argparse
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS payment_inbox (
+    payment_id TEXT PRIMARY KEY,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    received_at REAL NOT NULL,
+    processed_at REAL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_payment_inbox_status ON payment_inbox (status, received_at);
+"""
+
+
+def create_schema(conn):
+    conn.executescript(SCHEMA)
+
+
+def _recover(conn) -> int:
+    # События, которые разбирались в момент остановки, не были применены (применение атомарно).
+    # Если их ещё разбирает другой процесс, повторное применение не пройдёт: событие уже не в 'processing'
+    return conn.execute("UPDATE payment_inbox SET status = 'pending' WHERE status = 'processing'").rowcount
+
+
+def _insert(conn, payment_id: str, payload: str) -> bool:
+    cursor = conn.execute(
+        "INSERT OR IGNORE INTO payment_inbox (payment_id, payload, received_at) VALUES (?, ?, ?)",
+        (payment_id, payload, time.time())
+    )
+    return cursor.rowcount == 1
+
+
+def _claim(conn, limit: int):
+    return conn.execute(
+        """
+        UPDATE payment_inbox SET status = 'processing', attempts = attempts + 1
+        WHERE payment_id IN (
+            SELECT payment_id FROM payment_inbox WHERE status = 'pending' ORDER BY received_at LIMIT ?
+        )
+        RETURNING payment_id, payload, attempts
+        """,
+        (limit,)
+    ).fetchall()
+
+
+def _lag(conn) -> float:
+    row = conn.execute("SELECT MIN(received_at) FROM payment_inbox WHERE status IN ('pending', 'processing')").fetchone()
+    return time.time() - row[0] if row[0] else 0.0
+
+
+class PaymentInbox:
+    """Очередь платежей: быстрое сохранение в вебхуке и пул фоновых обработчиков.
+
+    `apply(conn, payment)` вызывается в транзакции записи вместе с пометкой события
+    как обработанного, поэтому платёж не может примениться дважды.
+    `on_applied(results)` получает результаты целой пачки (например, для рассылки уведомлений).
+    """
+
+    def __init__(self, db, apply, on_applied, workers: int = 2, batch_size: int = 20,
+                 poll_interval: float = 5.0, max_attempts: int = 5, max_backoff: float = 60.0):
+        self.db = db
+        self.apply = apply
+        self.on_applied = on_applied
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.max_backoff = max_backoff
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        self.received = 0
+        self.duplicates = 0
+        self.processed = 0
+        self.failed = 0
+        self.errors = 0
+        self.last_lag = 0.0  # обновляется обработчиками: metrics() вызывается синхронно и не ходит в БД
+
+    async def put(self, payment: dict) -> bool:
+        """Сохраняет событие. Возвращает False, если такой платёж уже был получен."""
+        inserted = await self.db.transaction(_insert, payment["id"], json.dumps(payment, ensure_ascii=False))
+        if inserted:
+            self.received += 1
+            self._wakeup.set()
+        else:
+            self.duplicates += 1
+        return inserted
+
+    async def start(self):
+        """Возвращает в очередь события, прерванные остановкой, и запускает обработчики."""
+        if self._tasks:
+            return
+        recovered = await self.db.transaction(_recover)
+        if recovered:
+            logging.warning(f"Очередь платежей: {recovered} событий, прерванных остановкой, возвращены в обработку")
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def lag(self) -> float:
+        """Возраст самого старого необработанного события, в секундах."""
+        return await self.db.read(_lag)
+
+    async def _worker(self):
+        failures = 0
+        while True:
+            try:
+                await self._work_once()
+                failures = 0
+            except Exception as e:
+                # Ошибка БД не должна молча останавливать обработчик: ждём и пробуем снова
+                failures += 1
+                self.errors += 1
+                delay = min(self.max_backoff, self.poll_interval * 2 ** (failures - 1))
+                logging.error(f"Ошибка обработчика очереди платежей: {e}; повтор через {delay:.0f} с")
+                await asyncio.sleep(delay)
+
+    async def _work_once(self):
+        self._wakeup.clear()
+        batch = await self.db.transaction(_claim, self.batch_size)
+        self.last_lag = await self.lag()
+        if not batch:
+            # Не wait_for: в Python 3.11 он теряет отмену, если событие установлено в тот же момент
+            waiter = asyncio.ensure_future(self._wakeup.wait())
+            try:
+                await asyncio.wait([waiter], timeout=self.poll_interval)
+            finally:
+                waiter.cancel()
+            return
+
+        results = []
+        for payment_id, payload, attempts in batch:
+            try:
+                result = await self.db.transaction(self._apply_once, payment_id, json.loads(payload))
+                self.processed += 1
+                if result is not None:
+                    results.append(result)
+            except Exception as e:
+                status = 'failed' if attempts >= self.max_attempts else 'pending'
+                if status == 'failed':
+                    self.failed += 1
+                logging.error(f"Ошибка при обработке платежа {payment_id} (попытка {attempts}): {e}")
+                try:
+                    await self.db.execute(
+                        "UPDATE payment_inbox SET status = ?, error = ? WHERE payment_id = ?",
+                        (status, str(e), payment_id)
+                    )
+                except Exception as e:
+                    # Событие останется в 'processing' и вернётся в очередь при следующем запуске
+                    logging.error(f"Не удалось сохранить статус платежа {payment_id}: {e}")
+        if results:
+            try:
+                await self.on_applied(results)
+            except Exception as e:
+                logging.error(f"Ошибка при отправке уведомлений об оплате: {e}")
+
+    def _apply_once(self, conn, payment_id: str, payment: dict):
+        marked = conn.execute(
+            "UPDATE payment_inbox SET status = 'done', processed_at = ?, error = NULL WHERE payment_id = ? AND status = 'processing'",
+            (time.time(), payment_id)
+        ).rowcount
+        if not marked:
+            return None
+        return self.apply(conn, payment)
+
+    def metrics(self) -> dict:
+        return {
+            "received": self.received, "duplicates": self.duplicates,
+            "processed": self.processed, "failed": self.failed,
+            "worker_errors": self.errors, "lag_seconds": self.last_lag,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Управление очередью платежей ЮKassa")
+    parser.add_argument("--db", default="bot_data.db")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("status")
+    replay = commands.add_parser("replay")
+    replay.add_argument("payment_ids", nargs="*", help="id неудачных платежей (по умолчанию — все неудачные)")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    if args.command == "status":
+        for status, count in conn.execute("SELECT status, COUNT(*) FROM payment_inbox GROUP BY status"):
+            print(f"{status:>10}: {count}")
+        print(f"lag: {_lag(conn):.1f}s")
+        for payment_id, attempts, error in conn.execute(
+            "SELECT payment_id, attempts, error FROM payment_inbox WHERE status = 'failed' ORDER BY received_at"
+        ):
+            print(f"failed {payment_id} (attempts={attempts}): {error}")
+    else:
+        with conn:
+            if args.payment_ids:
+                cursor = conn.executemany(
+                    "UPDATE payment_inbox SET status = 'pending', attempts = 0 WHERE payment_id = ? AND status = 'failed'",
+                    [(payment_id,) for payment_id in args.payment_ids]
+                )
+            else:
+                cursor = conn.execute("UPDATE payment_inbox SET status = 'pending', attempts = 0 WHERE status = 'failed'")
+        print(f"replayed {cursor.rowcount} event(s); the running bot will pick them up within its poll interval")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
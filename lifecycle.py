@@ -0,0 +1,158 @@
+"""Путь пользователя: одна строка на пользователя в `user_lifecycle`.
+
+Строка обновляется в той же транзакции, что и запись пачки событий аналитики
+(слушатель EventBuffer), поэтому воронка и недельные когорты считаются
+по одной строке на пользователя, без повторного разбора `analytics`.
+
+`active_weeks` — битовая маска недель активности: бит N означает, что пользователь
+присылал события на N-й неделе после недели первого появления (недели с понедельника).
+"""
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_lifecycle (
+    user_id INTEGER PRIMARY KEY,
+    first_seen TEXT NOT NULL,
+    last_active_at TEXT NOT NULL,
+    survey_completed_at TEXT,
+    plan_generated_at TEXT,
+    first_payment_at TEXT,
+    last_payment_at TEXT,
+    payments INTEGER NOT NULL DEFAULT 0,
+    messages INTEGER NOT NULL DEFAULT 0,
+    active_weeks INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_user_lifecycle_first_seen ON user_lifecycle (first_seen);
+"""
+
+COLUMNS = [
+    "user_id", "first_seen", "last_active_at", "survey_completed_at", "plan_generated_at",
+    "first_payment_at", "last_payment_at", "payments", "messages", "active_weeks",
+]
+# Битовая маска хранится в INTEGER SQLite (со знаком), поэтому недель не больше 62
+MAX_WEEKS = 62
+PAYMENT_EVENTS = ("first_payment", "recurring_payment")
+
+
+def create_schema(conn):
+    conn.executescript(SCHEMA)
+
+
+def _week(timestamp: str) -> int:
+    return (date.fromisoformat(timestamp[:10]).toordinal() - 1) // 7
+
+
+def _earliest(current, new):
+    return new if current is None or (new is not None and new < current) else current
+
+
+def _latest(current, new):
+    return new if current is None or (new is not None and new > current) else current
+
+
+def apply_events(conn, batch):
+    """Обновляет строки пользователей по пачке событий (user_id, event_type, timestamp)."""
+    per_user = defaultdict(list)
+    for user_id, event_type, timestamp in batch:
+        per_user[user_id].append((event_type, timestamp))
+
+    rows = {}
+    user_ids = list(per_user)
+    for offset in range(0, len(user_ids), 500):
+        chunk = user_ids[offset:offset + 500]
+        for row in conn.execute(
+            f"SELECT {', '.join(COLUMNS)} FROM user_lifecycle WHERE user_id IN ({', '.join('?' * len(chunk))})", chunk
+        ):
+            rows[row[0]] = dict(zip(COLUMNS, row))
+
+    updated = []
+    for user_id, events in per_user.items():
+        row = rows.get(user_id) or {
+            "user_id": user_id, "first_seen": None, "last_active_at": None, "survey_completed_at": None,
+            "plan_generated_at": None, "first_payment_at": None, "last_payment_at": None,
+            "payments": 0, "messages": 0, "active_weeks": 0,
+        }
+        first_seen = min([timestamp for _, timestamp in events] + ([row["first_seen"]] if row["first_seen"] else []))
+        if row["first_seen"] and first_seen < row["first_seen"]:
+            # Пришли события раньше известного первого появления — сдвигаем маску недель
+            row["active_weeks"] = (row["active_weeks"] << (_week(row["first_seen"]) - _week(first_seen))) & ((1 << MAX_WEEKS) - 1)
+        row["first_seen"] = first_seen
+        base_week = _week(first_seen)
+
+        for event_type, timestamp in events:
+            row["last_active_at"] = _latest(row["last_active_at"], timestamp)
+            offset = _week(timestamp) - base_week
+            if offset < MAX_WEEKS:
+                row["active_weeks"] |= 1 << offset
+            if event_type == "message_sent":
+                row["messages"] += 1
+            elif event_type == "survey_completed":
+                row["survey_completed_at"] = _earliest(row["survey_completed_at"], timestamp)
+            elif event_type == "plan_generated":
+                row["plan_generated_at"] = _earliest(row["plan_generated_at"], timestamp)
+            elif event_type in PAYMENT_EVENTS:
+                row["payments"] += 1
+                row["first_payment_at"] = _earliest(row["first_payment_at"], timestamp)
+                row["last_payment_at"] = _latest(row["last_payment_at"], timestamp)
+        updated.append(tuple(row[column] for column in COLUMNS))
+
+    conn.executemany(
+        f"INSERT OR REPLACE INTO user_lifecycle ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+        updated
+    )
+
+
+def rebuild_if_empty(conn, archived_batches=(), page_size: int = 10000):
+    """Заполняет таблицу по архиву и analytics, если она ещё ни разу не строилась."""
+    if conn.execute("SELECT 1 FROM user_lifecycle LIMIT 1").fetchone():
+        return
+    for batch in archived_batches:
+        apply_events(conn, batch)
+    cursor = 0
+    while True:
+        page = conn.execute(
+            "SELECT id, user_id, event_type, timestamp FROM analytics WHERE id > ? ORDER BY id LIMIT ?", (cursor, page_size)
+        ).fetchall()
+        if not page:
+            return
+        apply_events(conn, [row[1:] for row in page])
+        cursor = page[-1][0]
+
+
+def query_funnel(conn, start_day: str = None, end_day: str = None) -> dict:
+    """Воронка пользователей, впервые появившихся в дни [start_day, end_day]."""
+    end = (date.fromisoformat(end_day) + timedelta(days=1)).isoformat() if end_day else "9999-12-31"
+    row = conn.execute(
+        """
+        SELECT COUNT(*), COUNT(survey_completed_at), COUNT(plan_generated_at),
+               COUNT(first_payment_at), COALESCE(SUM(payments > 1), 0)
+        FROM user_lifecycle WHERE first_seen >= ? AND first_seen < ?
+        """,
+        (start_day or "0000-01-01", end)
+    ).fetchone()
+    return dict(zip(["started", "survey_completed", "plan_generated", "first_payment", "recurring"], row))
+
+
+def query_cohorts(conn, weeks: int = 8, today: date = None) -> list:
+    """Недельные когорты за последние `weeks` недель: (начало недели, размер, [доля активных на неделе 0, 1, ...])."""
+    current_week = ((today or datetime.utcnow().date()).toordinal() - 1) // 7
+    first_week = current_week - weeks + 1
+    cohorts = defaultdict(lambda: [0, [0] * weeks])
+    for first_seen, active_weeks in conn.execute(
+        "SELECT first_seen, active_weeks FROM user_lifecycle WHERE first_seen >= ?",
+        (date.fromordinal(first_week * 7 + 1).isoformat(),)
+    ):
+        cohort = cohorts[_week(first_seen)]
+        cohort[0] += 1
+        for offset in range(weeks):
+            if active_weeks >> offset & 1:
+                cohort[1][offset] += 1
+
+    result = []
+    for week in range(first_week, current_week + 1):
+        size, active = cohorts.get(week, (0, [0] * weeks))
+        # Для молодых когорт доступны только прошедшие недели
+        observed = current_week - week + 1
+        result.append((date.fromordinal(week * 7 + 1), size, [count / size if size else 0.0 for count in active[:observed]]))
+    return result
@@ -0,0 +1,138 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from contextlib import asynccontextmanager
+
+from conversation import message_tokens
+from ratelimit import TokenBucket
+
+# Чем меньше число, тем раньше запрос получает слот
+DEFAULT_PRIORITIES = {
+    "session_turn": 0,
+    "session_opening": 0,
+    "plan_generation": 1,
+    "opener_prefetch": 2,
+    "summary": 2,
+}
+
+
+def estimate_request_tokens(messages: list, completion_tokens: int = 800) -> int:
+    """Оценка токенов, которые запрос израсходует из минутного лимита: промпт + ответ."""
+    return sum(message_tokens(m) for m in messages) + completion_tokens
+
+
+class LLMScheduler:
+    """Общий планировщик запросов к OpenAI.
+
+    Ограничивает число одновременных запросов и расход токенов в минуту,
+    выдаёт слоты в порядке приоритета места вызова, а ходы одного пользователя
+    выполняет строго по очереди, чтобы они не перезаписывали историю друг друга.
+    """
+
+    def __init__(self, max_concurrency: int = 8, tokens_per_minute: int = 30000, priorities: dict = None):
+        self.max_concurrency = max_concurrency
+        self.priorities = {**DEFAULT_PRIORITIES, **(priorities or {})}
+        self._tokens = TokenBucket(tokens_per_minute / 60, capacity=tokens_per_minute)
+        self._active = 0
+        self._waiters = []
+        self._timer = None
+        self._sequence = itertools.count()
+        self._user_locks = {}
+        self.max_queue_depth = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    # --- Очерёдность ходов одного пользователя ---
+    @asynccontextmanager
+    async def user_turn(self, user_id: int):
+        entry = self._user_locks.setdefault(user_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._user_locks[user_id]
+
+    # --- Глобальные слоты ---
+    @asynccontextmanager
+    async def slot(self, call_site: str, tokens: int = 0, on_queued=None):
+        """Ждёт свободный слот и токены из минутного бюджета — в одной очереди по приоритету.
+
+        Слот выдаётся, только когда для запроса есть и место, и токены, поэтому запрос,
+        ожидающий токенов, не занимает слот, а низкоприоритетный не обгоняет более важный.
+        Если слот не выдан сразу, вызывает `on_queued(position)`.
+        """
+        await self._acquire(self.priorities.get(call_site, max(self.priorities.values()) + 1), tokens, on_queued)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, priority: int, tokens: int, on_queued):
+        tokens = min(tokens, self._tokens.capacity)
+        if self._active < self.max_concurrency and not self._waiters and self._tokens.try_acquire(tokens):
+            self._active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._sequence), tokens, future)
+        heapq.heappush(self._waiters, entry)
+        self.max_queue_depth = max(self.max_queue_depth, len(self._waiters))
+        self._dispatch()
+        try:
+            if on_queued is not None and not future.done():
+                position = sum(1 for waiter in self._waiters if waiter[:2] <= entry[:2])
+                try:
+                    await on_queued(position)
+                except Exception as e:
+                    logging.warning(f"Не удалось сообщить пользователю об очереди: {e}")
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Слот уже выдан — возвращаем его следующему
+                self._release()
+            elif entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                # Отменённый мог ждать токенов первым в очереди
+                self._dispatch()
+            raise
+
+    def _dispatch(self):
+        """Выдаёт слоты первым в очереди, пока есть место и токены для первого."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._waiters and self._active < self.max_concurrency:
+            _, _, tokens, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            if not self._tokens.try_acquire(tokens):
+                # Первый ждёт токенов; следующие не обгоняют его, проверим снова, когда токены накопятся
+                delay = (tokens - self._tokens.tokens) / self._tokens.rate
+                self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+            heapq.heappop(self._waiters)
+            self._active += 1
+            future.set_result(None)
+
+    def _release(self):
+        self._active -= 1
+        self._dispatch()
+
+    def metrics(self) -> dict:
+        return {
+            "active": self._active,
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "users_in_turn": len(self._user_locks),
+        }
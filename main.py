@@ -1,24 +1,51 @@
 import asyncio
+import functools
 import os
+import tempfile
 import logging
+import time
+import socket
 import sys
 import sqlite3
-from datetime import datetime, timedelta
-import uuid
+from datetime import datetime, timedelta, timezone
 
 from dotenv import load_dotenv
-from yookassa import Configuration, Payment
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 from aiogram import Bot, Dispatcher, F, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import Command, CommandStart, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, Message, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
-from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.types import FSInputFile, InlineKeyboardButton, InlineKeyboardMarkup, Message, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+from aiogram.webhook.aiohttp_server import setup_application
 from aiohttp import web
 
-from openai import AsyncOpenAI
+from database import Database
+from event_buffer import EventBuffer
+import rollups
+import lifecycle
+from streaming import StreamingReply
+from model_router import ModelRouter, Route, parse_routes
+from conversation import ContextBudget, ConversationMemory
+import fsm_storage
+from subscriptions import SubscriptionCache
+import billing
+from payments import PendingPayments, YooKassaClient
+from llm_scheduler import LLMScheduler, estimate_request_tokens
+from openers import OpenerCache
+import openers
+import inbox
+import broadcast
+import metrics
+import cluster
+import retention
+import export
+import startup
+import dedup
+import promo
+import renewals
+import archive
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -30,19 +57,161 @@ WEBHOOK_URL = os.getenv("WEBHOOK_URL")
 ADMIN_ID = os.getenv("ADMIN_ID")
 YOOKASSA_SHOP_ID = os.getenv("YOOKASSA_SHOP_ID")
 YOOKASSA_SECRET_KEY = os.getenv("YOOKASSA_SECRET_KEY")
+# Адрес Bot API (например, локального сервера или фейка в нагрузочных тестах); по умолчанию api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
 
-WEB_SERVER_HOST = "0.0.0.0"
+WEB_SERVER_HOST = os.getenv("WEB_SERVER_HOST", "0.0.0.0")
 WEB_SERVER_PORT = int(os.getenv("PORT", 8000))
 
+# Многопроцессный режим: при WORKERS > 1 этот процесс — мастер, воркеры слушают порты начиная с WORKER_BASE_PORT.
+# WORKER_INDEX мастер задаёт своим воркерам сам
+WORKERS = int(os.getenv("WORKERS", 1))
+WORKER_INDEX = os.getenv("WORKER_INDEX")
+IS_WORKER = WORKER_INDEX is not None
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", WEB_SERVER_PORT + 1))
+# Срок аренды лидера (сек): плановые задачи выполняет только процесс, удерживающий аренду
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", 30))
+
+# Буфер событий аналитики: интервал сброса (сек), размер пачки и максимальная глубина
+ANALYTICS_FLUSH_INTERVAL = float(os.getenv("ANALYTICS_FLUSH_INTERVAL", 1.0))
+ANALYTICS_BATCH_SIZE = int(os.getenv("ANALYTICS_BATCH_SIZE", 500))
+ANALYTICS_MAX_BUFFER = int(os.getenv("ANALYTICS_MAX_BUFFER", 10000))
+# Хранение аналитики: события старше стольких дней (полными месяцами) уходят в архивные файлы; 0 — не архивировать
+ANALYTICS_RETENTION_DAYS = int(os.getenv("ANALYTICS_RETENTION_DAYS", 180))
+ANALYTICS_ARCHIVE_DIR = os.getenv("ANALYTICS_ARCHIVE_DIR", "analytics_archive")
+ANALYTICS_DELETE_BATCH = int(os.getenv("ANALYTICS_DELETE_BATCH", 5000))
+
+# Минимальный интервал между правками сообщения при потоковом выводе ответа (сек)
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", 1.5))
+
+# Бюджет контекста диалога (в токенах) и модель для конспекта старых реплик
+SESSION_CONTEXT_TOKENS = int(os.getenv("SESSION_CONTEXT_TOKENS", 6000))
+SESSION_RECENT_TOKENS = int(os.getenv("SESSION_RECENT_TOKENS", 3000))
+FREE_TALK_CONTEXT_TOKENS = int(os.getenv("FREE_TALK_CONTEXT_TOKENS", 3000))
+FREE_TALK_RECENT_TOKENS = int(os.getenv("FREE_TALK_RECENT_TOKENS", 1500))
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-4o-mini")
+
+# FSM: сколько активных пользователей держать в памяти и через сколько секунд простоя выгружать
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", 10000))
+FSM_IDLE_TTL = float(os.getenv("FSM_IDLE_TTL", 1800))
+
+# Сколько пользователей держать в кэше статусов подписки
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv("SUBSCRIPTION_CACHE_SIZE", 50000))
+# В многопроцессном режиме оплату может применить другой процесс, поэтому записи кэша живут ограниченное время
+SUBSCRIPTION_CACHE_TTL = float(os.getenv("SUBSCRIPTION_CACHE_TTL", 30 if WORKERS > 1 else 0)) or None
+
+# Автосписания: параллельность, запросов к ЮKassa в секунду и число повторов при временных ошибках
+BILLING_CONCURRENCY = int(os.getenv("BILLING_CONCURRENCY", 10))
+BILLING_RATE_LIMIT = float(os.getenv("BILLING_RATE_LIMIT", 5))
+BILLING_MAX_RETRIES = int(os.getenv("BILLING_MAX_RETRIES", 3))
+# Автопродление: списание в течение RENEWAL_JITTER секунд после окончания подписки,
+# повтор неудачного через RENEWAL_RETRY_INTERVAL, сверка с БД раз в RENEWAL_SYNC_INTERVAL секунд
+RENEWAL_JITTER = float(os.getenv("RENEWAL_JITTER", 300))
+RENEWAL_RETRY_INTERVAL = float(os.getenv("RENEWAL_RETRY_INTERVAL", 86400))
+RENEWAL_SYNC_INTERVAL = float(os.getenv("RENEWAL_SYNC_INTERVAL", 300))
+
+# ЮKassa: адрес API, таймаут запроса (сек) и окно, в течение которого повторные нажатия «Оплатить» получают ту же ссылку
+YOOKASSA_API_URL = os.getenv("YOOKASSA_API_URL", "https://api.yookassa.ru/v3")
+YOOKASSA_TIMEOUT = float(os.getenv("YOOKASSA_TIMEOUT", 15))
+PAYMENT_DEDUP_WINDOW = float(os.getenv("PAYMENT_DEDUP_WINDOW", 600))
+
+# OpenAI: сколько запросов одновременно, бюджет токенов в минуту и приоритеты мест вызова
+# (LLM_PRIORITIES="session_turn=0,plan_generation=1", меньше — раньше)
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", 8))
+OPENAI_TOKENS_PER_MINUTE = int(os.getenv("OPENAI_TOKENS_PER_MINUTE", 30000))
+# Кэш приветствий сессии: сколько вариантов держать на план и сколько всего
+OPENER_POOL_SIZE = int(os.getenv("OPENER_POOL_SIZE", 3))
+OPENER_CACHE_SIZE = int(os.getenv("OPENER_CACHE_SIZE", 30000))
+# Обработчики входящей очереди платежей ЮKassa
+INBOX_WORKERS = int(os.getenv("INBOX_WORKERS", 2))
+# Общий лимит исходящих сообщений бота (Telegram допускает около 30 в секунду) и параметры рассылки
+TELEGRAM_RATE_LIMIT = float(os.getenv("TELEGRAM_RATE_LIMIT", 25))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 10))
+# Как часто лидер проверяет, не создана ли рассылка в другом процессе (сек)
+BROADCAST_POLL_INTERVAL = float(os.getenv("BROADCAST_POLL_INTERVAL", 5))
+# Отсев повторно доставленных апдейтов: сколько секунд и сколько update_id помнить, сохранять ли их между перезапусками
+UPDATE_DEDUP_TTL = float(os.getenv("UPDATE_DEDUP_TTL", 3600))
+UPDATE_DEDUP_SIZE = int(os.getenv("UPDATE_DEDUP_SIZE", 100000))
+UPDATE_DEDUP_PERSIST = os.getenv("UPDATE_DEDUP_PERSIST", "1") == "1"
+# Архив диалогов: реплик в сжатом блоке, через сколько секунд записывать неполный блок, предел хранимого на пользователя (байт)
+ARCHIVE_CHUNK_TURNS = int(os.getenv("ARCHIVE_CHUNK_TURNS", 32))
+ARCHIVE_MAX_AGE = float(os.getenv("ARCHIVE_MAX_AGE", 300))
+ARCHIVE_USER_BYTES = int(os.getenv("ARCHIVE_USER_BYTES", 512 * 1024))
+# Сессия по плану продолжается с последних SESSION_RESUME_TURNS реплик, если прервана не раньше SESSION_RESUME_HOURS часов назад (0 — всегда заново)
+SESSION_RESUME_TURNS = int(os.getenv("SESSION_RESUME_TURNS", 20))
+SESSION_RESUME_HOURS = float(os.getenv("SESSION_RESUME_HOURS", 72))
+# Метрики /metrics доступны только с заголовком Authorization: Bearer <METRICS_TOKEN>; без токена маршрут отключён
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+# Выгрузка /export/{analytics|users} доступна только с заголовком Authorization: Bearer <EXPORT_TOKEN>
+EXPORT_TOKEN = os.getenv("EXPORT_TOKEN")
+# Telegram принимает от ботов файлы не больше 50 МБ
+TELEGRAM_FILE_LIMIT = 50 * 1024 * 1024
+# Сколько промокодов можно создать одной командой /promo_batch и сколько вставлять за одну транзакцию
+PROMO_BATCH_LIMIT = int(os.getenv("PROMO_BATCH_LIMIT", 100000))
+PROMO_BATCH_CHUNK = int(os.getenv("PROMO_BATCH_CHUNK", 2000))
+# Модели OpenAI: основная и запасная. Маршруты по местам вызова можно переопределить,
+# первая модель в списке — основная (MODEL_ROUTES="session_turn=gpt-4o|gpt-4o-mini,plan_generation=gpt-4o")
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o")
+FALLBACK_MODEL = os.getenv("FALLBACK_MODEL", "gpt-4o-mini")
+MODEL_ROUTES = parse_routes(os.getenv("MODEL_ROUTES", ""))
+# Места вызова, где при ответе медленнее p95 параллельно спрашивается следующая модель (HEDGED_CALL_SITES="session_turn")
+HEDGED_CALL_SITES = {name.strip() for name in os.getenv("HEDGED_CALL_SITES", "").split(",") if name.strip()}
+# Автомат защиты модели: доля ошибок и p95 до первого токена (сек), при которых модель отключается, и на сколько секунд
+MODEL_ERROR_THRESHOLD = float(os.getenv("MODEL_ERROR_THRESHOLD", 0.5))
+MODEL_SLOW_THRESHOLD = float(os.getenv("MODEL_SLOW_THRESHOLD", 15))
+MODEL_COOLDOWN = float(os.getenv("MODEL_COOLDOWN", 30))
+LLM_PRIORITIES = {
+    name.strip(): int(value)
+    for name, value in (item.split("=") for item in os.getenv("LLM_PRIORITIES", "").split(",") if "=" in item)
+}
+
+# Лимиты OpenAI и Telegram общие на все процессы — каждый воркер получает свою долю
+if IS_WORKER and WORKERS > 1:
+    OPENAI_MAX_CONCURRENCY = max(1, OPENAI_MAX_CONCURRENCY // WORKERS)
+    OPENAI_TOKENS_PER_MINUTE = max(1, OPENAI_TOKENS_PER_MINUTE // WORKERS)
+    TELEGRAM_RATE_LIMIT = TELEGRAM_RATE_LIMIT / WORKERS
+
 if not all([TELEGRAM_BOT_TOKEN, OPENAI_API_KEY, ADMIN_ID, YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY]):
     raise ValueError("Необходимо задать все переменные окружения, включая ключи ЮKassa")
 
-Configuration.configure(YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY)
-
 # Инициализация
-openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
-bot = Bot(token=TELEGRAM_BOT_TOKEN)
-dp = Dispatcher()
+DB_FILE = os.getenv("DB_FILE", "bot_data.db")
+db = Database(DB_FILE)
+
+@functools.cache
+def openai_client():
+    """Клиент OpenAI создаётся при первом обращении: импорт библиотеки openai заметно удлиняет запуск."""
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(api_key=OPENAI_API_KEY)
+
+# Ответ пользователю может дать запасная модель; заготовки приветствий делаются только основной
+DEFAULT_MODELS = list(dict.fromkeys([OPENAI_MODEL, FALLBACK_MODEL]))
+llm_router = ModelRouter(openai_client, {
+    call_site: Route(models, hedge=call_site in HEDGED_CALL_SITES)
+    for call_site, models in {
+        "session_turn": DEFAULT_MODELS,
+        "session_opening": DEFAULT_MODELS,
+        "plan_generation": DEFAULT_MODELS,
+        "opener_prefetch": [OPENAI_MODEL],
+        "summary": [SUMMARY_MODEL],
+        **MODEL_ROUTES,
+    }.items()
+}, default_route=Route(DEFAULT_MODELS), error_threshold=MODEL_ERROR_THRESHOLD,
+   slow_threshold=MODEL_SLOW_THRESHOLD, cooldown=MODEL_COOLDOWN)
+bot = Bot(
+    token=TELEGRAM_BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None,
+)
+bot.session.middleware(broadcast.OutgoingRateLimiter(rate=TELEGRAM_RATE_LIMIT))
+bot.session.middleware(metrics.TelegramMetricsMiddleware())
+storage = fsm_storage.SQLiteStorage(db, max_cached=FSM_CACHE_SIZE, idle_ttl=FSM_IDLE_TTL)
+dp = Dispatcher(storage=storage)
+update_dedup = dedup.UpdateDeduplicator(db if UPDATE_DEDUP_PERSIST else None, ttl=UPDATE_DEDUP_TTL, max_size=UPDATE_DEDUP_SIZE)
+dp.update.outer_middleware(update_dedup)
+dp.message.middleware(metrics.HandlerMetricsMiddleware("message"))
+dp.callback_query.middleware(metrics.HandlerMetricsMiddleware("callback_query"))
+yookassa_client = YooKassaClient(YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY, api_url=YOOKASSA_API_URL, timeout=YOOKASSA_TIMEOUT)
+pending_payments = PendingPayments(yookassa_client, window=PAYMENT_DEDUP_WINDOW)
 
 # --- Системные промпты ---
 PLAN_GENERATION_PROMPT = """
@@ -82,10 +251,24 @@ FREE_TALK_PROMPT = """
 """
 
 # --- РАБОТА С БАЗОЙ ДАННЫХ ---
-DB_FILE = "bot_data.db"
+event_buffer = EventBuffer(
+    db, flush_interval=ANALYTICS_FLUSH_INTERVAL, batch_size=ANALYTICS_BATCH_SIZE, max_size=ANALYTICS_MAX_BUFFER,
+    listeners=[rollups.apply_events, lifecycle.apply_events]
+)
+analytics_retention = retention.AnalyticsRetention(
+    db, ANALYTICS_ARCHIVE_DIR, horizon_days=ANALYTICS_RETENTION_DAYS, delete_batch=ANALYTICS_DELETE_BATCH
+)
+subscription_cache = SubscriptionCache(db, max_size=SUBSCRIPTION_CACHE_SIZE, ttl=SUBSCRIPTION_CACHE_TTL)
+
+# Увеличивается при каждом изменении схемы: если версия в файле БД совпадает, DDL при запуске пропускается
+SCHEMA_VERSION = 7
 
-def init_db():
+def init_db() -> bool:
+    """Создаёт и обновляет схему. Возвращает False, если схема уже актуальна."""
     conn = sqlite3.connect(DB_FILE)
+    if conn.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION:
+        conn.close()
+        return False
     cursor = conn.cursor()
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS analytics (
@@ -104,83 +287,46 @@ def init_db():
             session_plan TEXT
         )
     ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS promo_codes (
-            code TEXT PRIMARY KEY,
-            duration_days INTEGER NOT NULL,
-            is_active INTEGER DEFAULT 1
-        )
-    ''')
+    conn.commit()
+    rollups.create_schema(conn)
+    lifecycle.create_schema(conn)
+    fsm_storage.create_schema(conn)
+    billing.create_schema(conn)
+    openers.create_schema(conn)
+    inbox.create_schema(conn)
+    broadcast.create_schema(conn)
+    cluster.create_schema(conn)
+    retention.create_schema(conn)
+    dedup.create_schema(conn)
+    promo.create_schema(conn)
+    renewals.create_schema(conn)
+    archive.create_schema(conn)
+    rollups.rebuild_if_empty(conn, retention.archived_batches(conn))
+    lifecycle.rebuild_if_empty(conn, retention.archived_batches(conn))
+    conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
     conn.commit()
     conn.close()
+    return True
 
 def log_event(user_id: int, event_type: str):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    timestamp = datetime.utcnow()
-    cursor.execute(
-        "INSERT INTO analytics (user_id, event_type, timestamp) VALUES (?, ?, ?)",
-        (user_id, event_type, timestamp)
-    )
-    conn.commit()
-    conn.close()
+    event_buffer.add(user_id, event_type)
 
-def ensure_user_exists(user_id: int):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-    if cursor.fetchone() is None:
-        cursor.execute("INSERT INTO users (user_id) VALUES (?)", (user_id,))
-        conn.commit()
-    conn.close()
+async def ensure_user_exists(user_id: int):
+    await db.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
 
 async def is_user_subscribed(user_id: int) -> bool:
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT subscription_status, subscription_expires_at FROM users WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    if result:
-        status, expires_at_str = result
-        if status == 'paid' and expires_at_str:
-            expires_at = datetime.fromisoformat(expires_at_str)
-            if expires_at > datetime.utcnow():
-                return True
-    return False
+    return await subscription_cache.is_subscribed(user_id)
 
 # --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ АНАЛИТИКИ ---
-def get_stats_for_period(date_filter: str):
-    """Получает статистику за указанный период."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-
-    cursor.execute(f"SELECT COUNT(DISTINCT user_id) FROM analytics WHERE event_type = 'start_command' {date_filter.replace('WHERE', 'AND') if date_filter else ''}")
-    start_users = cursor.fetchone()[0]
-
-    cursor.execute(f"SELECT COUNT(DISTINCT user_id) FROM analytics {date_filter}")
-    total_users = cursor.fetchone()[0]
-
-    cursor.execute(f"""
-        SELECT COUNT(*) FROM (
-            SELECT user_id FROM analytics
-            {date_filter} {'AND' if date_filter else 'WHERE'} event_type = 'message_sent'
-            GROUP BY user_id
-            HAVING COUNT(*) > 5
-        )
-    """)
-    active_users = cursor.fetchone()[0]
+async def get_stats_for_period(start_day: str = None, end_day: str = None):
+    """Получает статистику за дни [start_day, end_day] из дневных агрегатов."""
+    return await db.read(rollups.query_stats, start_day, end_day)
 
-    cursor.execute(f"SELECT COUNT(DISTINCT user_id) FROM analytics WHERE event_type = 'first_payment' {date_filter.replace('WHERE', 'AND') if date_filter else ''}")
-    first_payment_users = cursor.fetchone()[0]
+def format_share(count: int, total: int) -> str:
+    return f" ({count / total * 100:.0f}%)" if total else ""
 
-    cursor.execute(f"SELECT COUNT(*) FROM analytics WHERE event_type = 'recurring_payment' {date_filter.replace('WHERE', 'AND') if date_filter else ''}")
-    recurring_payments = cursor.fetchone()[0]
-
-    conn.close()
-    return {
-        "start": start_users, "total": total_users, "active": active_users,
-        "first_payment": first_payment_users, "recurring": recurring_payments
-    }
+def days_ago(days: int) -> str:
+    return (datetime.utcnow().date() - timedelta(days=days)).isoformat()
 
 def format_change(current, previous):
     """Форматирует абсолютное и процентное изменение между двумя числами."""
@@ -216,6 +362,29 @@ class UserJourney(StatesGroup):
     in_session = State()
     in_free_talk = State()
 
+llm_scheduler = LLMScheduler(
+    max_concurrency=OPENAI_MAX_CONCURRENCY, tokens_per_minute=OPENAI_TOKENS_PER_MINUTE, priorities=LLM_PRIORITIES
+)
+
+conversation_memory = ConversationMemory(None, {
+    UserJourney.in_session.state: ContextBudget(max_prompt_tokens=SESSION_CONTEXT_TOKENS, recent_tokens=SESSION_RECENT_TOKENS),
+    UserJourney.in_free_talk.state: ContextBudget(max_prompt_tokens=FREE_TALK_CONTEXT_TOKENS, recent_tokens=FREE_TALK_RECENT_TOKENS),
+}, summary_model=SUMMARY_MODEL, scheduler=llm_scheduler, router=llm_router)
+conversation_archive = archive.ConversationArchive(
+    db, chunk_turns=ARCHIVE_CHUNK_TURNS, max_age=ARCHIVE_MAX_AGE, max_user_bytes=ARCHIVE_USER_BYTES
+)
+
+async def generate_session_opener(prompt: str) -> str:
+    messages = [{"role": "system", "content": prompt}]
+    async with llm_scheduler.slot("opener_prefetch", estimate_request_tokens(messages)):
+        response = await llm_router.complete("opener_prefetch", messages=messages, temperature=0.9)
+    return response.choices[0].message.content
+
+opener_cache = OpenerCache(db, generate_session_opener, pool_size=OPENER_POOL_SIZE, max_entries=OPENER_CACHE_SIZE)
+
+async def show_queue_position(message: Message, position: int):
+    await message.edit_text(f"⏳ Сейчас много обращений, вы в очереди (№{position}). Ответ появится здесь, как только подойдёт ваша очередь.")
+
 # --- Клавиатуры ---
 agree_keyboard = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="Я понимаю и согласна", callback_data="agree_pressed")]])
 plan_confirm_keyboard = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="✅ Готова начать", callback_data="plan_accept")]])
@@ -235,7 +404,8 @@ stats_keyboard = InlineKeyboardMarkup(inline_keyboard=[
     [InlineKeyboardButton(text="7 дней", callback_data="stats_7d"), InlineKeyboardButton(text="30 дней", callback_data="stats_30d")],
     [InlineKeyboardButton(text="Сравнить 7 дней", callback_data="stats_compare7d")],
     [InlineKeyboardButton(text="Сравнить 30 дней", callback_data="stats_compare30d")],
-    [InlineKeyboardButton(text="За всё время", callback_data="stats_all")]
+    [InlineKeyboardButton(text="За всё время", callback_data="stats_all")],
+    [InlineKeyboardButton(text="Воронка 30 дней", callback_data="stats_funnel30d"), InlineKeyboardButton(text="Когорты", callback_data="stats_cohorts")]
 ])
 back_to_stats_keyboard = InlineKeyboardMarkup(inline_keyboard=[
     [InlineKeyboardButton(text="⬅️ Назад к выбору периода", callback_data="stats_back")]
@@ -245,18 +415,28 @@ yes_no_keyboard = ReplyKeyboardMarkup(
     resize_keyboard=True, one_time_keyboard=True
 )
 
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора до завершения
+background_tasks = set()
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
 # --- Обработчики (Handlers) ---
 @dp.message(CommandStart())
 async def send_welcome(message: Message, state: FSMContext):
-    ensure_user_exists(message.from_user.id)
+    await ensure_user_exists(message.from_user.id)
     log_event(message.from_user.id, 'start_command')
+    conversation_memory.reset(state)
     await state.clear()
 
     welcome_text = (
         "👋 Здравствуйте! **Я — Ариадна**, ваш персональный цифровой ассистент, созданная, чтобы **поддержать вас на пути восстановления после развода**.\n\n"
         "**Почему стоит работать со мной?**\n"
         "* **Доступно 24/7:** Я всегда рядом, когда вам нужна поддержка, без записи и ожидания.\n"
-        "* **Конфиденциально:** Наш диалог остается только между нами.\n"
+        "* **Бережно к данным:** Наша переписка хранится в архиве сервиса, и просматривать её может только администратор — для контроля качества и безопасности. Посторонним она не передаётся.\n"
         "* **Эффективно:** Мы будем использовать **Когнитивно-Поведенческую Терапию (КПТ)** — один из самых **исследованных и доказавших свою эффективность** методов психотерапии. КПТ идеально подходит для работы после развода, так как помогает изменить негативные мысли и модели поведения, которые мешают двигаться вперед.\n"
         "* **Персонально:** Мы составим план сессий, учитывающий именно вашу ситуацию и цели.\n\n"
         "**❗️ Важное предупреждение:**\n"
@@ -271,6 +451,7 @@ async def send_welcome(message: Message, state: FSMContext):
 
 @dp.message(Command("stop"), StateFilter("*"))
 async def stop_session(message: Message, state: FSMContext):
+    conversation_memory.reset(state)
     await state.clear()
     is_subscribed = await is_user_subscribed(message.from_user.id)
     if is_subscribed:
@@ -306,19 +487,19 @@ async def handle_stats_period(callback_query: types.CallbackQuery):
     stats_text = ""
 
     if period in ["today", "yesterday", "7d", "30d", "all"]:
-        date_filter_map = {
-            "today": "WHERE DATE(timestamp) = DATE('now', 'utc')",
-            "yesterday": "WHERE DATE(timestamp) = DATE('now', '-1 day', 'utc')",
-            "7d": "WHERE DATE(timestamp) >= DATE('now', '-7 days', 'utc')",
-            "30d": "WHERE DATE(timestamp) >= DATE('now', '-30 days', 'utc')",
-            "all": ""
+        period_days_map = {
+            "today": (days_ago(0), days_ago(0)),
+            "yesterday": (days_ago(1), days_ago(1)),
+            "7d": (days_ago(7), None),
+            "30d": (days_ago(30), None),
+            "all": (None, None)
         }
         period_text_map = {
             "today": "за сегодня", "yesterday": "за вчера", "7d": "за последние 7 дней",
             "30d": "за последние 30 дней", "all": "за всё время"
         }
 
-        stats = get_stats_for_period(date_filter_map[period])
+        stats = await get_stats_for_period(*period_days_map[period])
         stats_text = (
             f"📊 **Статистика бота {period_text_map[period]}**\n\n"
             f"▫️ **Нажали /start:** {stats['start']} чел.\n"
@@ -331,11 +512,8 @@ async def handle_stats_period(callback_query: types.CallbackQuery):
     elif period in ["compare7d", "compare30d"]:
         days = 7 if period == "compare7d" else 30
 
-        current_filter = f"WHERE DATE(timestamp) >= DATE('now', '-{days} days', 'utc')"
-        current_stats = get_stats_for_period(current_filter)
-
-        previous_filter = f"WHERE DATE(timestamp) >= DATE('now', '-{days*2} days', 'utc') AND DATE(timestamp) < DATE('now', '-{days} days', 'utc')"
-        previous_stats = get_stats_for_period(previous_filter)
+        current_stats = await get_stats_for_period(days_ago(days))
+        previous_stats = await get_stats_for_period(days_ago(days * 2), days_ago(days + 1))
 
         stats_text = (
             f"📊 **Сравнение статистики за {days} дней**\n"
@@ -347,11 +525,210 @@ async def handle_stats_period(callback_query: types.CallbackQuery):
             f"🔁 **Повторные оплаты:** {current_stats['recurring']} (vs {previous_stats['recurring']}){format_change(current_stats['recurring'], previous_stats['recurring'])}"
         )
 
+    elif period == "funnel30d":
+        funnel = await db.read(lifecycle.query_funnel, days_ago(30))
+        started = funnel['started']
+        stats_text = (
+            f"🔻 **Воронка за 30 дней**\n"
+            f"_(пользователи, впервые пришедшие за период)_\n\n"
+            f"▫️ **Пришли:** {started} чел.\n"
+            f"▫️ **Прошли опрос:** {funnel['survey_completed']} чел.{format_share(funnel['survey_completed'], started)}\n"
+            f"▫️ **Получили план:** {funnel['plan_generated']} чел.{format_share(funnel['plan_generated'], started)}\n"
+            f"💳 **Оплатили:** {funnel['first_payment']} чел.{format_share(funnel['first_payment'], started)}\n"
+            f"🔁 **Оплатили повторно:** {funnel['recurring']} чел.{format_share(funnel['recurring'], started)}"
+        )
+
+    elif period == "cohorts":
+        cohorts = await db.read(lifecycle.query_cohorts, 8)
+        lines = [f"{'неделя':<6}{'польз':>6} " + "".join(f"{f'н{offset}':>5}" for offset in range(8))]
+        for week_start, size, shares in cohorts:
+            lines.append(f"{week_start.strftime('%d.%m'):<6}{size:>6} " + "".join(f"{share * 100:>4.0f}%" for share in shares))
+        stats_text = (
+            "👥 **Недельные когорты**\n"
+            "_(доля пользователей когорты, активных на N-й неделе после прихода)_\n\n"
+            "```\n" + "\n".join(lines) + "\n```"
+        )
+
     if stats_text:
         await callback_query.message.edit_text(stats_text, parse_mode="Markdown", reply_markup=back_to_stats_keyboard)
 
     await callback_query.answer()
 
+# Рассылку ведёт только лидер; leader_lease создаётся ниже, к моменту вызова он уже есть
+broadcast_engine = broadcast.BroadcastEngine(db, bot, concurrency=BROADCAST_CONCURRENCY,
+                                             is_active=lambda: leader_lease.is_leader)
+
+@dp.message(Command("broadcast"), StateFilter("*"))
+async def broadcast_command(message: Message):
+    if str(message.from_user.id) != ADMIN_ID:
+        await message.answer("У вас нет доступа к этой команде.")
+        return
+    text = (message.text or "").partition(" ")[2].strip()
+    if not text:
+        await message.answer("Использование: /broadcast <текст сообщения для всех пользователей>")
+        return
+    await broadcast_engine.start(text, message.chat.id)
+
+@dp.callback_query(F.data.startswith("broadcast_cancel_"))
+async def broadcast_cancel_handler(callback_query: types.CallbackQuery):
+    if str(callback_query.from_user.id) != ADMIN_ID:
+        await callback_query.answer("У вас нет доступа к этой команде.", show_alert=True)
+        return
+    broadcast_id = int(callback_query.data.rsplit("_", 1)[1])
+    if await broadcast_engine.cancel(broadcast_id):
+        await callback_query.answer("Рассылка остановлена.")
+    else:
+        await callback_query.answer("Рассылка уже завершена.")
+
+@dp.my_chat_member(F.chat.type == "private")
+async def bot_blocked_handler(update: types.ChatMemberUpdated):
+    # Пользователь заблокировал бота («kicked») или разблокировал его: рассылки пропускают заблокировавших
+    await db.transaction(broadcast.set_blocked, [update.from_user.id], update.new_chat_member.status == "kicked")
+
+
+async def send_export(chat_id: int, table: str, fmt: str, start_day: str, end_day: str):
+    filename = export.export_filename(table, fmt, start_day, end_day, compress=True)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, filename)
+        try:
+            size = await export.write_file(db, path, table, fmt, start_day, end_day, compress=True)
+            if size > TELEGRAM_FILE_LIMIT:
+                await bot.send_message(chat_id, f"Файл получился {size // 2 ** 20} МБ — больше лимита Telegram. Используйте HTTP-выгрузку /export/{table}.")
+                return
+            await bot.send_document(chat_id, FSInputFile(path, filename=filename))
+        except Exception as e:
+            logging.error(f"Ошибка при выгрузке {table}: {e}")
+            await bot.send_message(chat_id, "Не удалось подготовить выгрузку.")
+
+@dp.message(Command("export"), StateFilter("*"))
+async def export_command(message: Message):
+    if str(message.from_user.id) != ADMIN_ID:
+        await message.answer("У вас нет доступа к этой команде.")
+        return
+    args = (message.text or "").split()[1:]
+    table = args[0] if args else ""
+    days = [arg for arg in args[1:] if arg not in export.FORMATS]
+    fmt = next((arg for arg in args[1:] if arg in export.FORMATS), "csv")
+    start_day, end_day = (days + [None, None])[:2]
+    try:
+        export.parse_request(table, fmt, start_day, end_day)
+    except ValueError as e:
+        await message.answer(
+            f"Ошибка: {e}\n\nИспользование: /export analytics|users [с YYYY-MM-DD] [по YYYY-MM-DD] [csv|ndjson]"
+        )
+        return
+    await message.answer("Готовлю выгрузку, файл придёт сюда.")
+    run_in_background(send_export(message.chat.id, table, fmt, start_day, end_day))
+
+
+HISTORY_USAGE = "Использование: /history <user_id> [с YYYY-MM-DD] [по YYYY-MM-DD]"
+HISTORY_PAGE_SIZE = 10
+
+def _history_day(day: str, shift: int = 0):
+    # Границы периода — по UTC; день «по» включается целиком
+    if day == "-":
+        return None
+    return (datetime.strptime(day, "%Y-%m-%d") + timedelta(days=shift)).replace(tzinfo=timezone.utc).timestamp()
+
+async def show_history_page(message: Message, user_id: int, start_day: str, end_day: str, cursor: str = None):
+    start, end = _history_day(start_day), _history_day(end_day, shift=1)
+    turns, next_cursor = await conversation_archive.page(user_id, start, end, cursor, limit=HISTORY_PAGE_SIZE)
+    chunks, total_turns, raw_bytes, stored_bytes = await db.read(archive.user_usage, user_id)
+    lines = [
+        f"История {user_id}: {total_turns} реплик в {chunks} блоках, "
+        f"{stored_bytes // 1024} КБ в архиве ({raw_bytes // 1024} КБ до сжатия). Сначала новые."
+    ]
+    for turn in turns:
+        moment = datetime.fromtimestamp(turn["t"], timezone.utc).strftime("%d.%m.%Y %H:%M")
+        author = "👤" if turn["role"] == "user" else "🤖"
+        content = turn["content"] if len(turn["content"]) <= 300 else turn["content"][:300] + "…"
+        lines.append(f"{moment} {author} {content}")
+    if not turns:
+        lines.append("Реплик за этот период нет.")
+    keyboard = None
+    if next_cursor:
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(
+            text="Старее ▸", callback_data=f"history_{user_id}_{next_cursor}_{start_day}_{end_day}"
+        )]])
+    await message.answer("\n\n".join(lines), reply_markup=keyboard)
+
+@dp.message(Command("history"), StateFilter("*"))
+async def history_command(message: Message):
+    if str(message.from_user.id) != ADMIN_ID:
+        await message.answer("У вас нет доступа к этой команде.")
+        return
+    args = (message.text or "").split()[1:]
+    try:
+        user_id = int(args[0])
+        start_day, end_day = (args[1:] + ["-", "-"])[:2]
+        _history_day(start_day), _history_day(end_day)
+    except (ValueError, IndexError):
+        await message.answer(HISTORY_USAGE)
+        return
+    await show_history_page(message, user_id, start_day, end_day)
+
+@dp.callback_query(F.data.startswith("history_"))
+async def history_page_handler(callback_query: types.CallbackQuery):
+    if str(callback_query.from_user.id) != ADMIN_ID:
+        await callback_query.answer("У вас нет доступа к этой команде.", show_alert=True)
+        return
+    _, user_id, cursor, start_day, end_day = callback_query.data.split("_")
+    await show_history_page(callback_query.message, int(user_id), start_day, end_day, cursor)
+    await callback_query.answer()
+
+
+PROMO_BATCH_USAGE = (
+    "Использование: /promo_batch <количество> <дней подписки> [активаций на код, 0 — без ограничения] [заметка]\n"
+    "Например: /promo_batch 1000 30 1 партнёры-октябрь"
+)
+
+async def send_promo_batch(chat_id: int, batch_id: int):
+    filename = f"promo_batch_{batch_id}.txt"
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, filename)
+        try:
+            codes = await db.read(promo.batch_codes, batch_id)
+            with open(path, "w", encoding="utf-8") as file:
+                file.write("\n".join(codes) + "\n")
+            await bot.send_document(chat_id, FSInputFile(path, filename=filename), caption=f"Пакет #{batch_id}: {len(codes)} кодов")
+        except Exception as e:
+            logging.error(f"Ошибка при отправке пакета промокодов {batch_id}: {e}")
+            await bot.send_message(chat_id, f"Пакет #{batch_id} создан, но файл с кодами отправить не удалось.")
+
+@dp.message(Command("promo_batch"), StateFilter("*"))
+async def promo_batch_command(message: Message):
+    if str(message.from_user.id) != ADMIN_ID:
+        await message.answer("У вас нет доступа к этой команде.")
+        return
+    args = (message.text or "").split(maxsplit=4)[1:]
+    if not args:
+        batches = await db.read(promo.batch_summaries)
+        lines = [
+            f"#{batch_id} от {created_at[:10]}: {codes} кодов на {days} дн., "
+            f"{'без ограничения' if max_uses is None else f'до {max_uses} акт.'} на код, активаций: {redeemed}"
+            + (f" — {note}" if note else "")
+            for batch_id, created_at, codes, days, max_uses, note, redeemed in batches
+        ]
+        await message.answer("\n".join(lines or ["Пакетов промокодов пока нет."]) + "\n\n" + PROMO_BATCH_USAGE)
+        return
+    try:
+        count, days = int(args[0]), int(args[1])
+        max_uses = int(args[2]) if len(args) > 2 else 1
+    except (ValueError, IndexError):
+        await message.answer(PROMO_BATCH_USAGE)
+        return
+    if not 0 < count <= PROMO_BATCH_LIMIT or days <= 0 or max_uses < 0:
+        await message.answer(f"Количество — от 1 до {PROMO_BATCH_LIMIT}, дней и активаций — положительные числа.\n\n{PROMO_BATCH_USAGE}")
+        return
+    note = args[3] if len(args) > 3 else ""
+    batch_id = await db.transaction(promo.new_batch, days, max_uses or None, note, message.from_user.id)
+    # Частями: между транзакциями поток записи успевает обслужить FSM, очередь платежей и аналитику
+    for start in range(0, count, PROMO_BATCH_CHUNK):
+        await db.transaction(promo.add_codes, batch_id, min(PROMO_BATCH_CHUNK, count - start))
+    logging.info(f"Создан пакет промокодов #{batch_id}: {count} шт. на {days} дн.")
+    await message.answer(f"Пакет #{batch_id} создан, файл с кодами придёт сюда.")
+    run_in_background(send_promo_batch(message.chat.id, batch_id))
+
 
 @dp.message(Command("promo"), StateFilter("*"))
 async def promo_command(message: Message, state: FSMContext):
@@ -361,25 +738,14 @@ async def promo_command(message: Message, state: FSMContext):
 @dp.message(UserJourney.waiting_for_promo)
 async def process_promo_code(message: Message, state: FSMContext):
     code = message.text.strip().upper()
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT duration_days FROM promo_codes WHERE code = ? AND is_active = 1", (code,))
-    result = cursor.fetchone()
-
-    if result:
-        duration_days = result[0]
-        expires_at = datetime.utcnow() + timedelta(days=duration_days)
-        cursor.execute(
-            "UPDATE users SET subscription_status = ?, subscription_expires_at = ? WHERE user_id = ?",
-            ('paid', expires_at.isoformat(), message.from_user.id)
-        )
-        cursor.execute("UPDATE promo_codes SET is_active = 0 WHERE code = ?", (code,))
-        conn.commit()
+    duration_days = await db.transaction(promo.redeem, code, message.from_user.id)
+    if duration_days:
+        subscription_cache.invalidate(message.from_user.id)
+        await renewal_scheduler.refresh([message.from_user.id])
         await message.answer(f"✅ Промокод успешно активирован! Ваша подписка действительна на {duration_days} дней.\n\nВы вернулись в главное меню.", reply_markup=main_menu_keyboard)
     else:
         await message.answer("❌ Промокод не найден или уже был использован.")
 
-    conn.close()
     await state.clear()
 
 @dp.message(Command("subscription"), StateFilter("*"))
@@ -392,45 +758,69 @@ async def subscription_command(message: Message):
 
 @dp.callback_query(F.data == "cancel_subscription")
 async def cancel_subscription_handler(callback_query: types.CallbackQuery):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE users SET yookassa_payment_method_id = NULL WHERE user_id = ?", (callback_query.from_user.id,))
-    conn.commit()
-    conn.close()
+    await db.execute("UPDATE users SET yookassa_payment_method_id = NULL WHERE user_id = ?", (callback_query.from_user.id,))
+    subscription_cache.invalidate(callback_query.from_user.id)
+    await renewal_scheduler.refresh([callback_query.from_user.id])
     await callback_query.message.edit_text("✅ Автопродление подписки отменено. Текущая подписка будет действовать до конца оплаченного периода.")
 
 @dp.callback_query(F.data == "menu_start_plan_session")
 async def start_plan_session_handler(callback_query: types.CallbackQuery, state: FSMContext):
     await callback_query.message.edit_text("Загружаю вашу сессию по плану...")
+    await callback_query.answer()
 
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT session_plan FROM users WHERE user_id = ?", (callback_query.from_user.id,))
-    result = cursor.fetchone()
-    conn.close()
+    result = await db.fetchone("SELECT session_plan FROM users WHERE user_id = ?", (callback_query.from_user.id,))
 
     session_plan = result[0] if result and result[0] else "План не найден. Начните с общих вопросов."
     personalized_prompt = SESSION_PROMPT.format(plan=session_plan)
 
+    conversation_memory.reset(state)
     await state.set_state(UserJourney.in_session)
 
-    first_message_response = await openai_client.chat.completions.create(
-        model="gpt-4o", messages=[{"role": "system", "content": personalized_prompt}], temperature=0.7
-    )
-    first_message = first_message_response.choices[0].message.content
-
-    await state.update_data(messages=[
-        {"role": "system", "content": personalized_prompt},
-        {"role": "assistant", "content": first_message}
-    ])
+    # Недавно прерванную сессию продолжаем: в контекст попадают только последние реплики из архива
+    previous = await conversation_archive.recent(
+        callback_query.from_user.id, SESSION_RESUME_TURNS, mode=UserJourney.in_session.state,
+        since=time.time() - SESSION_RESUME_HOURS * 3600
+    ) if SESSION_RESUME_TURNS > 0 else []
+    if previous:
+        await state.update_data(messages=[{"role": "system", "content": personalized_prompt}] + [
+            {"role": turn["role"], "content": turn["content"]} for turn in previous
+        ], summary="", summarized=0)
+        last_answer = next((turn["content"] for turn in reversed(previous) if turn["role"] == "assistant"), "")
+        text = "Продолжаем сессию с того места, где мы остановились."
+        if last_answer:
+            text += f"\n\nВ прошлый раз я писала:\n{last_answer[:3000]}"
+        await callback_query.message.answer(text)
+        return
 
-    await callback_query.message.answer(first_message)
-    await callback_query.answer()
+    async with llm_scheduler.user_turn(callback_query.from_user.id):
+        reply = None
+        first_message = await opener_cache.take(personalized_prompt)
+        if first_message is None:
+            placeholder = await callback_query.message.answer("Думаю...")
+            prompt_messages = [{"role": "system", "content": personalized_prompt}]
+            reply = StreamingReply(placeholder, call_site="session_opening", edit_interval=STREAM_EDIT_INTERVAL)
+            async with llm_scheduler.slot("session_opening", estimate_request_tokens(prompt_messages),
+                                          on_queued=lambda position: show_queue_position(placeholder, position)):
+                first_message = await reply.stream(llm_router.stream(
+                    "session_opening", messages=prompt_messages, temperature=0.7
+                ))
+
+        await state.update_data(messages=[
+            {"role": "system", "content": personalized_prompt},
+            {"role": "assistant", "content": first_message}
+        ], summary="", summarized=0)
+        conversation_archive.add(callback_query.from_user.id, UserJourney.in_session.state, "assistant", first_message)
+
+    if reply is not None:
+        await reply.finish()
+    else:
+        await callback_query.message.answer(first_message)
 
 @dp.callback_query(F.data == "menu_start_free_talk")
 async def start_free_talk_handler(callback_query: types.CallbackQuery, state: FSMContext):
+    conversation_memory.reset(state)
     await state.set_state(UserJourney.in_free_talk)
-    await state.update_data(messages=[{"role": "system", "content": FREE_TALK_PROMPT}])
+    await state.update_data(messages=[{"role": "system", "content": FREE_TALK_PROMPT}], summary="", summarized=0)
     await callback_query.message.edit_text("Режим 'Пообщаться' активирован. Можете задать любой вопрос или рассказать, что вас волнует.")
     await callback_query.answer()
 
@@ -514,6 +904,7 @@ async def process_survey_goal(message: Message, state: FSMContext):
 @dp.message(UserJourney.survey_obstacles)
 async def process_survey_obstacles_and_generate_plan(message: Message, state: FSMContext):
     log_event(message.from_user.id, 'message_sent')
+    log_event(message.from_user.id, 'survey_completed')
     await state.update_data(q_obstacles=message.text)
     user_data = await state.get_data()
     
@@ -530,27 +921,28 @@ async def process_survey_obstacles_and_generate_plan(message: Message, state: FS
             q_obstacles=user_data.get('q_obstacles')
         )
 
-        response = await openai_client.chat.completions.create(
-            model="gpt-4o", messages=[{"role": "user", "content": prompt}], temperature=0.7
-        )
-        plan_text = response.choices[0].message.content
+        prompt_messages = [{"role": "user", "content": prompt}]
+        reply = StreamingReply(thinking_message, call_site="plan_generation", edit_interval=STREAM_EDIT_INTERVAL)
+        async with llm_scheduler.slot("plan_generation", estimate_request_tokens(prompt_messages),
+                                      on_queued=lambda position: show_queue_position(thinking_message, position)):
+            plan_text = await reply.stream(llm_router.stream(
+                "plan_generation", messages=prompt_messages, temperature=0.7
+            ))
 
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("UPDATE users SET session_plan = ? WHERE user_id = ?", (plan_text, message.from_user.id))
-        conn.commit()
-        conn.close()
+        await db.execute("UPDATE users SET session_plan = ? WHERE user_id = ?", (plan_text, message.from_user.id))
+        log_event(message.from_user.id, 'plan_generated')
+        opener_cache.warm(SESSION_PROMPT.format(plan=plan_text))
 
         is_subscribed = await is_user_subscribed(message.from_user.id)
         if is_subscribed:
-            await thinking_message.edit_text(
-                f"{plan_text}\n\nВаш новый план сохранен! Вы вернулись в главное меню.",
+            await reply.finish(
+                "\n\nВаш новый план сохранен! Вы вернулись в главное меню.",
                 reply_markup=main_menu_keyboard, parse_mode="Markdown"
             )
             await state.clear()
         else:
-            await thinking_message.edit_text(
-                f"{plan_text}\n\nЕсли вы готовы начать работу по этому плану, нажмите кнопку ниже.",
+            await reply.finish(
+                "\n\nЕсли вы готовы начать работу по этому плану, нажмите кнопку ниже.",
                 reply_markup=plan_confirm_keyboard, parse_mode="Markdown"
             )
             await state.set_state(UserJourney.plan_confirmation)
@@ -572,24 +964,37 @@ async def show_payment_options(callback_query: types.CallbackQuery, state: FSMCo
     )
     await callback_query.answer()
 
-@dp.callback_query(F.data == "pay_subscription", UserJourney.plan_confirmation)
-async def offer_payment(callback_query: types.CallbackQuery, state: FSMContext):
+async def send_payment_link(message: Message, user_id: int, state: FSMContext = None):
     PRICE = 250.00
-    payment = Payment.create({
-        "amount": {"value": f"{PRICE:.2f}", "currency": "RUB"},
-        "confirmation": {"type": "redirect", "return_url": f"https://t.me/{(await bot.get_me()).username}"},
-        "capture": True,
-        "description": "Подписка на 7 дней (с автопродлением)",
-        "save_payment_method": True,
-        "metadata": {"user_id": callback_query.from_user.id, "duration_days": 7}
-    }, uuid.uuid4())
-    
-    await callback_query.message.answer(
+    try:
+        confirmation_url = await pending_payments.confirmation_url(user_id, {
+            "amount": {"value": f"{PRICE:.2f}", "currency": "RUB"},
+            "confirmation": {"type": "redirect", "return_url": f"https://t.me/{(await bot.me()).username}"},
+            "capture": True,
+            "description": "Подписка на 7 дней (с автопродлением)",
+            "save_payment_method": True,
+            "metadata": {"user_id": user_id, "duration_days": 7}
+        })
+    except Exception as e:
+        logging.error(f"Ошибка при создании платежа для {user_id}: {e}")
+        # Состояние plan_confirmation сохраняется, поэтому кнопка оплаты снова работает
+        await message.answer("Не удалось создать платёж. Попробуйте ещё раз чуть позже.", reply_markup=payment_keyboard)
+        return
+
+    await message.answer(
         "Нажмите на кнопку ниже, чтобы перейти к оплате.",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="✅ Перейти к оплате", url=payment.confirmation.confirmation_url)]])
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="✅ Перейти к оплате", url=confirmation_url)]])
     )
-    await callback_query.answer()
-    await state.clear()
+    # Пока ссылка создавалась, пользователь мог перейти к вводу промокода — его состояние не трогаем
+    if state is not None and await state.get_state() == UserJourney.plan_confirmation.state:
+        await state.clear()
+
+@dp.callback_query(F.data == "pay_subscription", UserJourney.plan_confirmation)
+async def offer_payment(callback_query: types.CallbackQuery, state: FSMContext):
+    # Платёж создаётся в фоне: ответ обработчика не зависит от скорости ЮKassa.
+    # Состояние сбрасывается только после отправки ссылки: повторные нажатия до этого получат ту же ссылку
+    run_in_background(send_payment_link(callback_query.message, callback_query.from_user.id, state))
+    await callback_query.answer("Готовлю ссылку на оплату...")
 
 @dp.callback_query(F.data == "enter_promo", UserJourney.plan_confirmation)
 async def ask_for_promo(callback_query: types.CallbackQuery, state: FSMContext):
@@ -597,121 +1002,266 @@ async def ask_for_promo(callback_query: types.CallbackQuery, state: FSMContext):
     await state.set_state(UserJourney.waiting_for_promo)
     await callback_query.answer()
 
+def _apply_successful_payment(conn, payment: dict):
+    user_id = int(payment['metadata']['user_id'])
+    duration_days = int(payment['metadata'].get('duration_days', 7))
+    expires_at = datetime.utcnow() + timedelta(days=duration_days)
+
+    row = conn.execute("SELECT subscription_status FROM users WHERE user_id = ?", (user_id,)).fetchone()
+    event_type = 'recurring_payment' if row and row[0] == 'paid' else 'first_payment'
+
+    payment_method_id = payment.get('payment_method', {}).get('id')
+    conn.execute(
+        "UPDATE users SET subscription_status = ?, subscription_expires_at = ?, yookassa_payment_method_id = ? WHERE user_id = ?",
+        ('paid', expires_at.isoformat(), payment_method_id, user_id)
+    )
+    return user_id, duration_days, event_type
+
+async def notify_payments_applied(results):
+    for user_id, _, event_type in results:
+        subscription_cache.invalidate(user_id)
+        log_event(user_id, event_type)
+    await renewal_scheduler.refresh([user_id for user_id, _, _ in results])
+    await asyncio.gather(*(
+        bot.send_message(user_id,
+            f"✅ Оплата прошла успешно! Ваша подписка активирована на {duration_days} дней.\n\n"
+            "Вы вернулись в главное меню. Выберите, с чего хотите начать.",
+            reply_markup=main_menu_keyboard
+        )
+        for user_id, duration_days, _ in results
+    ), return_exceptions=True)
+
+payment_inbox = inbox.PaymentInbox(db, _apply_successful_payment, notify_payments_applied, workers=INBOX_WORKERS)
+
 async def yookassa_webhook_handler(request):
     try:
         event_json = await request.json()
         payment = event_json.get('object')
-
-        if payment and payment.get('status') == 'succeeded' and payment.get('paid'):
-            user_id = int(payment['metadata']['user_id'])
-            
-            is_already_subscribed = await is_user_subscribed(user_id)
-            if not is_already_subscribed:
-                log_event(user_id, 'first_payment')
-            else:
-                log_event(user_id, 'recurring_payment')
-            
-            duration_days = int(payment['metadata'].get('duration_days', 7))
-            expires_at = datetime.utcnow() + timedelta(days=duration_days)
-
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-
-            payment_method_id = payment.get('payment_method', {}).get('id')
-            cursor.execute(
-                "UPDATE users SET subscription_status = ?, subscription_expires_at = ?, yookassa_payment_method_id = ? WHERE user_id = ?",
-                ('paid', expires_at.isoformat(), payment_method_id, user_id)
-            )
-            conn.commit()
-            conn.close()
-            await bot.send_message(user_id,
-                f"✅ Оплата прошла успешно! Ваша подписка активирована на {duration_days} дней.\n\n"
-                "Вы вернулись в главное меню. Выберите, с чего хотите начать.",
-                reply_markup=main_menu_keyboard
-            )
     except Exception as e:
         logging.error(f"Ошибка в обработчике ЮKassa: {e}")
+        return web.Response(status=200)
+
+    if payment and payment.get('id') and payment.get('status') == 'succeeded' and payment.get('paid'):
+        try:
+            await payment_inbox.put(payment)
+        except Exception as e:
+            # Событие не сохранено — просим ЮKassa прислать его повторно
+            logging.error(f"Не удалось сохранить событие ЮKassa {payment.get('id')}: {e}")
+            return web.Response(status=500)
     return web.Response(status=200)
 
-async def charge_recurring_payments():
-    logging.info("Starting recurring payment check...")
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id, yookassa_payment_method_id FROM users WHERE subscription_status = 'paid' AND subscription_expires_at < ? AND yookassa_payment_method_id IS NOT NULL", (datetime.utcnow(),))
+async def notify_failed_charge(user_id: int, error: Exception):
+    await bot.send_message(user_id, "⚠️ Не удалось продлить подписку. Пожалуйста, проверьте вашу карту и оплатите вручную через команду /start.")
 
-    users_to_charge = cursor.fetchall()
-    conn.close()
+billing_engine = billing.BillingEngine(
+    yookassa_client, concurrency=BILLING_CONCURRENCY, rate_per_second=BILLING_RATE_LIMIT,
+    max_retries=BILLING_MAX_RETRIES, on_failure=notify_failed_charge
+)
 
-    for user_id, payment_method_id in users_to_charge:
-        try:
-            Payment.create({
-                "amount": {"value": "250.00", "currency": "RUB"},
-                "capture": True,
-                "payment_method_id": payment_method_id,
-                "description": "Автопродление подписки на 7 дней",
-                "metadata": {"user_id": user_id, "duration_days": 7}
-            })
-            logging.info(f"Successfully charged user {user_id}")
-        except Exception as e:
-            logging.error(f"Failed to charge user {user_id}: {e}")
-            await bot.send_message(user_id, "⚠️ Не удалось продлить подписку. Пожалуйста, проверьте вашу карту и оплатите вручную через команду /start.")
+async def charge_renewals(charges):
+    report = await billing_engine.run(charges)
+    await db.transaction(billing.save_report, report)
+    logging.info(report.summary())
+
+# Списывает только лидер: куча сроков строится при получении лидерства
+renewal_scheduler = renewals.RenewalScheduler(
+    db, charge_renewals, is_active=lambda: leader_lease.is_leader, jitter=RENEWAL_JITTER,
+    sync_interval=RENEWAL_SYNC_INTERVAL, retry_interval=RENEWAL_RETRY_INTERVAL
+)
 
 @dp.message(F.text, UserJourney.in_session)
 @dp.message(F.text, UserJourney.in_free_talk)
 async def handle_paid_session(message: Message, state: FSMContext):
     log_event(message.from_user.id, 'message_sent')
-    data = await state.get_data()
-    messages_history = data.get("messages", [])
+    thinking_message = await message.answer("Думаю...")
 
-    messages_history.append({"role": "user", "content": message.text})
+    # Ходы одного пользователя обрабатываются по очереди, иначе они затрут историю друг друга
+    async with llm_scheduler.user_turn(message.from_user.id):
+        data = await state.get_data()
+        mode = await state.get_state()
+        messages_history = conversation_memory.history(data)
 
-    thinking_message = await message.answer("Думаю...")
+        messages_history.append({"role": "user", "content": message.text})
+
+        try:
+            prompt_messages = conversation_memory.prompt(messages_history, data.get("summary"), mode)
+            reply = StreamingReply(thinking_message, call_site="session_turn", edit_interval=STREAM_EDIT_INTERVAL)
+            async with llm_scheduler.slot("session_turn", estimate_request_tokens(prompt_messages),
+                                          on_queued=lambda position: show_queue_position(thinking_message, position)):
+                gpt_answer = await reply.stream(llm_router.stream(
+                    "session_turn",
+                    messages=prompt_messages,
+                    temperature=0.75,
+                ))
+            messages_history.append({"role": "assistant", "content": gpt_answer})
+            await conversation_memory.save(state, data, messages_history)
+            conversation_archive.add(message.from_user.id, mode, "user", message.text, at=message.date.timestamp())
+            conversation_archive.add(message.from_user.id, mode, "assistant", gpt_answer)
+            conversation_memory.maybe_summarize(state, mode)
+            await reply.finish()
+        except Exception as e:
+            logging.error(f"Ошибка в handle_paid_session: {e}")
+            await thinking_message.edit_text("Произошла ошибка. Попробуйте еще раз.")
+
+# --- Метрики компонентов для /metrics ---
+metrics.REGISTRY.register_component("analytics_buffer", event_buffer.metrics)
+metrics.REGISTRY.register_component("subscription_cache", subscription_cache.metrics)
+metrics.REGISTRY.register_component("fsm_cache", lambda: {"size": storage.cached})
+metrics.REGISTRY.register_component("llm_scheduler", llm_scheduler.metrics)
+metrics.REGISTRY.register_component("opener_cache", opener_cache.metrics)
+metrics.REGISTRY.register_component("payment_inbox", payment_inbox.metrics)
+metrics.REGISTRY.register_component("pending_payments", lambda: {"reused": pending_payments.reused})
+metrics.REGISTRY.register_component("analytics_retention", analytics_retention.metrics)
+metrics.REGISTRY.register_component("model_router", llm_router.metrics)
+metrics.REGISTRY.register_component("update_dedup", update_dedup.metrics)
+metrics.REGISTRY.register_component("renewals", renewal_scheduler.metrics)
+metrics.REGISTRY.register_component("conversation_archive", conversation_archive.metrics)
+
+# --- Функции для запуска ---
+# Прерванные рассылки и автопродления ведёт лидер, чтобы в многопроцессном режиме они не шли из нескольких процессов
+async def on_elected():
+    renewal_scheduler.start()
+    await broadcast_engine.resume()
+
+leader_lease = cluster.LeaderLease(
+    db, "scheduler", holder=f"{socket.gethostname()}:{os.getpid()}", ttl=LEADER_LEASE_TTL,
+    on_elected=on_elected
+)
+
+async def archive_old_analytics():
     try:
-        response = await openai_client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages_history,
-            temperature=0.75,
-        )
-        gpt_answer = response.choices[0].message.content
-        messages_history.append({"role": "assistant", "content": gpt_answer})
-        await state.update_data(messages=messages_history)
-        await thinking_message.edit_text(gpt_answer)
+        moved = await analytics_retention.run()
+        logging.info(f"Архивирование аналитики завершено: перенесено {moved} событий")
     except Exception as e:
-        logging.error(f"Ошибка в handle_paid_session: {e}")
-        await thinking_message.edit_text("Произошла ошибка. Попробуйте еще раз.")
+        logging.error(f"Ошибка при архивировании аналитики: {e}")
 
-# --- Функции для запуска ---
-async def on_startup_scheduler(app):
+async def start_scheduler():
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler
     scheduler = AsyncIOScheduler(timezone="UTC")
-    scheduler.add_job(charge_recurring_payments, 'cron', day_of_week='*', hour=10, minute=0)
+    # Рассылки, созданные в других процессах, лидер подхватывает без перезапуска (на остальных resume ничего не делает)
+    scheduler.add_job(broadcast_engine.resume, 'interval', seconds=BROADCAST_POLL_INTERVAL)
+    if ANALYTICS_RETENTION_DAYS > 0:
+        scheduler.add_job(leader_lease.only(archive_old_analytics), 'cron', day_of_week='*', hour=3, minute=0)
     scheduler.start()
 
-async def on_startup(bot: Bot) -> None:
-    webhook_url_from_env = os.getenv("WEBHOOK_URL")
-    if webhook_url_from_env:
-        await bot.set_webhook(f"{webhook_url_from_env}/webhook")
+# --- Запуск по шагам: порт открыт сразу, /readyz отвечает 200 после последнего шага ---
+bot_startup = startup.Startup(gated_paths=["/webhook", "/yookassa_webhook"])
+
+async def check_schema():
+    # Схему создаёт мастер (или единственный процесс) до запуска воркеров
+    if IS_WORKER:
+        return
+    if await asyncio.to_thread(init_db):
+        logging.info(f"Схема базы данных обновлена до версии {SCHEMA_VERSION}")
+
+async def start_services():
+    await update_dedup.load()
+    update_dedup.start()
+    conversation_archive.start()
+    event_buffer.start()
+    storage.start()
+    await payment_inbox.start()
+    await leader_lease.start()
+    run_in_background(metrics.monitor_event_loop())
+
+async def warm_openai():
+    client = await asyncio.to_thread(openai_client)
+    await startup.warm("OpenAI", client.with_options(max_retries=0, timeout=10).models.list())
+
+async def warm_connections():
+    # Импорт openai занимает около секунды, готовность его не ждёт: первый запрос к модели дождётся сам
+    run_in_background(warm_openai())
+    await asyncio.gather(
+        # Bot.me() кэширует ответ getMe — дальше имя бота берётся без запроса к Telegram
+        startup.warm("Telegram", bot.me()),
+        startup.warm("ЮKassa", yookassa_client.warm()),
+    )
+
+async def set_webhook():
+    if IS_WORKER:
+        # Вебхук Telegram указывает на мастер, он его и устанавливает
+        return
+    if WEBHOOK_URL:
+        await bot.set_webhook(f"{WEBHOOK_URL}/webhook")
     else:
         logging.warning("WEBHOOK_URL не установлен.")
 
-async def on_shutdown(bot: Bot) -> None:
-    await bot.delete_webhook()
+bot_startup.step("schema", check_schema)
+bot_startup.step("services", start_services)
+bot_startup.step("scheduler", start_scheduler)
+bot_startup.step("connections", warm_connections)
+bot_startup.step("webhook", set_webhook)
 
-def main() -> None:
-    dp.startup.register(on_startup)
+async def on_shutdown(bot: Bot) -> None:
+    if not IS_WORKER:
+        await bot.delete_webhook()
+    await payment_inbox.stop()
+    await broadcast_engine.stop()
+    await renewal_scheduler.stop()
+    await leader_lease.stop()
+    await update_dedup.stop()
+    await conversation_archive.stop()
+    await event_buffer.stop()
+    await storage.close()
+    await yookassa_client.close()
+    db.close()
+
+def create_app() -> web.Application:
     dp.shutdown.register(on_shutdown)
 
     app = web.Application()
-    app.on_startup.append(on_startup_scheduler)
+    bot_startup.setup(app)
+    metrics.REGISTRY.register_component("startup", bot_startup.metrics)
 
-    webhook_requests_handler = SimpleRequestHandler(dispatcher=dp, bot=bot)
+    webhook_requests_handler = cluster.OrderedRequestHandler(dispatcher=dp, bot=bot)
     webhook_requests_handler.register(app, path="/webhook")
     app.router.add_post("/yookassa_webhook", yookassa_webhook_handler)
+    app.router.add_get("/metrics", metrics.handler(METRICS_TOKEN))
+    app.router.add_get("/export/{table}", export.handler(db, EXPORT_TOKEN))
     
     setup_application(app, dp, bot=bot)
-    
-    web.run_app(app, host=WEB_SERVER_HOST, port=WEB_SERVER_PORT)
+    return app
+
+def create_master_app() -> web.Application:
+    """Мастер многопроцессного режима: принимает вебхуки и раздаёт их воркерам по user_id."""
+    pool = cluster.WorkerPool(WORKERS, script=os.path.abspath(__file__), base_port=WORKER_BASE_PORT)
+    router = cluster.UpdateRouter(pool.urls)
+    metrics.REGISTRY.register_component("router", router.metrics)
+    metrics.REGISTRY.register_component("workers", lambda: {"restarts": pool.restarts})
+
+    async def start_workers():
+        pool.start()
+        router.start()
+
+    async def on_master_cleanup(app):
+        await bot.delete_webhook()
+        await bot.session.close()
+        await router.stop()
+        await pool.stop()
+        db.close()
+
+    # Воркеры запускаются после проверки схемы; пока они поднимаются, мастер отвечает на вебхуки 503 и Telegram повторяет доставку
+    master_startup = startup.Startup(gated_paths=["/webhook", "/yookassa_webhook"])
+    master_startup.step("schema", check_schema)
+    master_startup.step("workers", start_workers)
+    master_startup.step("webhook", set_webhook)
+    metrics.REGISTRY.register_component("startup", master_startup.metrics)
+
+    app = web.Application()
+    master_startup.setup(app)
+    app.on_cleanup.append(on_master_cleanup)
+    app.router.add_post("/webhook", router.webhook_handler)
+    app.router.add_post("/yookassa_webhook", router.yookassa_handler)
+    app.router.add_get("/metrics", metrics.handler(METRICS_TOKEN, lambda: router.worker_metrics(METRICS_TOKEN)))
+    app.router.add_get("/export/{table}", export.handler(db, EXPORT_TOKEN))
+    return app
+
+def main() -> None:
+    if WORKERS > 1 and not IS_WORKER:
+        web.run_app(create_master_app(), host=WEB_SERVER_HOST, port=WEB_SERVER_PORT)
+    else:
+        web.run_app(create_app(), host=WEB_SERVER_HOST, port=WEB_SERVER_PORT)
 
 if __name__ == "__main__":
-    init_db()
     logging.basicConfig(level=logging.INFO, stream=sys.stdout)
     main()
\ No newline at end of file
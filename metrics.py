@@ -0,0 +1,292 @@
+"""Метрики бота в текстовом формате Prometheus (маршрут /metrics).
+
+Счётчики и гистограммы обновляются из event loop и из потоков базы данных,
+поэтому все изменения идут под блокировкой. Показатели компонентов
+(буфер аналитики, кэши, планировщик и т. п.) снимаются в момент запроса
+через их методы metrics().
+"""
+import asyncio
+import hmac
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels=(), buckets=DEFAULT_BUCKETS, registry=None):
+        super().__init__(name, documentation, labels, registry)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = _format_labels(self.labels, key, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric: _Metric):
+        self._metrics.append(metric)
+
+    def register_component(self, component: str, collect):
+        """Добавляет показатели компонента: `collect()` возвращает словарь «имя → число»,
+        каждое значение выводится как gauge `bot_<component>_<имя>`."""
+        self._collectors.append((component, collect))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for component, collect in self._collectors:
+            try:
+                values = collect()
+            except Exception as e:
+                logging.warning(f"Не удалось снять метрики компонента {component}: {e}")
+                continue
+            for key, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    name = f"bot_{component}_{key}"
+                    lines.append(f"# TYPE {name} gauge")
+                    lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+handler_latency = Histogram("bot_handler_duration_seconds", "Время работы обработчика апдейта", ["event", "handler"])
+handler_errors = Counter("bot_handler_errors_total", "Исключения в обработчиках", ["event", "handler"])
+openai_latency = Histogram("bot_openai_request_duration_seconds", "Полное время запроса к OpenAI", ["call_site"])
+openai_ttft = Histogram("bot_openai_time_to_first_token_seconds", "Время до первого токена потокового ответа", ["call_site"])
+openai_tokens = Counter("bot_openai_tokens_total", "Токены, израсходованные запросами к OpenAI", ["call_site", "kind"])
+openai_errors = Counter("bot_openai_errors_total", "Ошибки запросов к OpenAI", ["call_site", "error"])
+duplicate_updates = Counter("bot_duplicate_updates_total", "Повторно доставленные апдейты, отброшенные без обработки")
+openai_model_requests = Counter(
+    "bot_openai_model_requests_total", "Запросы маршрутизатора к моделям по исходу (ok, error, cancelled)",
+    ["call_site", "model", "outcome"],
+)
+openai_model_state = Gauge("bot_openai_model_state", "Автомат защиты модели: 0 — замкнут, 1 — пробный запрос, 2 — отключена", ["model"])
+db_latency = Histogram(
+    "bot_db_query_duration_seconds", "Время выполнения запроса или транзакции SQLite в потоке базы", ["pool", "statement"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+db_wait = Histogram(
+    "bot_db_queue_wait_seconds", "Ожидание свободного потока базы", ["pool"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+telegram_latency = Histogram("bot_telegram_request_duration_seconds", "Время запроса к Bot API", ["method"])
+telegram_errors = Counter("bot_telegram_errors_total", "Ошибки запросов к Bot API", ["method", "error"])
+event_loop_lag = Histogram(
+    "bot_event_loop_lag_seconds", "Запаздывание event loop относительно запланированного пробуждения", [],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+
+
+def statement_label(sql: str) -> str:
+    """Короткая метка запроса: SQL без лишних пробелов (параметры в текст не попадают)."""
+    return " ".join(sql.split())[:80]
+
+
+def observe_openai_usage(call_site: str, usage):
+    if usage is None:
+        return
+    openai_tokens.inc(usage.prompt_tokens or 0, call_site=call_site, kind="prompt")
+    openai_tokens.inc(usage.completion_tokens or 0, call_site=call_site, kind="completion")
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Внутренний middleware наблюдателя (dp.message, dp.callback_query):
+    к этому моменту обработчик уже выбран, и известно его имя."""
+
+    def __init__(self, event: str):
+        self.event = event
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.inc(event=self.event, handler=name)
+            raise
+        finally:
+            handler_latency.observe(time.perf_counter() - started, event=self.event, handler=name)
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: время и ошибки каждого запроса к Bot API."""
+
+    async def __call__(self, make_request, bot, method):
+        name = getattr(method, "__api_method__", type(method).__name__)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            telegram_errors.inc(method=name, error=type(e).__name__)
+            raise
+        finally:
+            telegram_latency.observe(time.perf_counter() - started, method=name)
+
+
+async def monitor_event_loop(interval: float = 0.5):
+    """Раз в `interval` секунд измеряет, насколько позже запланированного проснулась задача."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        event_loop_lag.observe(max(0.0, loop.time() - started - interval))
+
+
+def merge_expositions(texts: dict, label: str = "worker") -> str:
+    """Сводит тексты /metrics нескольких процессов в один: «значение метки -> текст».
+
+    К каждому сэмплу добавляется метка `label`, сэмплы одной метрики из разных процессов
+    выводятся подряд под общими # HELP / # TYPE, как требует формат Prometheus.
+    """
+    families = {}
+    for value, text in texts.items():
+        family = None
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            if line.startswith("#"):
+                parts = line.split(" ", 3)
+                if len(parts) >= 3 and parts[1] in ("HELP", "TYPE"):
+                    family = families.setdefault(parts[2], {"HELP": None, "TYPE": None, "samples": []})
+                    family[parts[1]] = family[parts[1]] or line
+                continue
+            if family is None:
+                family = families.setdefault(line.split("{")[0].split(" ")[0],
+                                             {"HELP": None, "TYPE": None, "samples": []})
+            extra = f'{label}="{_escape(value)}"'
+            name, brace, rest = line.partition("{")
+            if brace:
+                separator = "" if rest.startswith("}") else ","
+                family["samples"].append(f"{name}{{{extra}{separator}{rest}")
+            else:
+                name, _, rest = line.partition(" ")
+                family["samples"].append(f"{name}{{{extra}}} {rest}")
+    lines = []
+    for family in families.values():
+        lines.extend(line for line in (family["HELP"], family["TYPE"]) if line)
+        lines.extend(family["samples"])
+    return "\n".join(lines) + "\n"
+
+
+def handler(token: str = None, collect_workers=None):
+    """Обработчик маршрута /metrics. Требует заголовок Authorization: Bearer <token>; без токена маршрут отключён.
+
+    `collect_workers` (для мастера многопроцессного режима) — корутина, возвращающая тексты
+    /metrics воркеров по их номерам; они сводятся с метриками мастера по метке `worker`.
+    """
+    async def metrics_handler(request: web.Request) -> web.Response:
+        if not token:
+            raise web.HTTPNotFound()
+        # Сравнение за постоянное время, чтобы токен нельзя было подобрать по времени ответа
+        if not hmac.compare_digest(request.headers.get("Authorization", "").encode(), f"Bearer {token}".encode()):
+            raise web.HTTPUnauthorized()
+        body = REGISTRY.render()
+        if collect_workers is not None:
+            body = merge_expositions({"master": body, **await collect_workers()})
+        return web.Response(body=body.encode(),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+    return metrics_handler
@@ -0,0 +1,303 @@
+"""Выбор модели OpenAI для каждого запроса.
+
+Для каждого места вызова (session_turn, plan_generation, summary, ...) задан маршрут —
+список моделей по убыванию предпочтения. По каждой модели ведётся скользящая статистика:
+доля ошибок и задержка (для потоковых ответов — время до первого токена). Если модель
+деградировала, её автомат защиты размыкается и запросы идут к следующей модели маршрута;
+через `cooldown` секунд один пробный запрос проверяет, восстановилась ли модель.
+
+Ошибка до первого токена (сеть, таймаут, 429, 5xx) переводит запрос на следующую модель.
+Ошибки запроса (400 и т. п.) не зависят от модели и пробрасываются сразу, а оборванный
+на середине поток — тоже: часть ответа пользователь уже видит.
+
+Хеджирование (Route.hedge) необязательно: если основная модель не ответила за p95 своей
+задержки, параллельно отправляется запрос к следующей модели и берётся тот ответ,
+что придёт первым. Дублирующий запрос не проходит через LLMScheduler.
+
+Клиент можно передать функцией — тогда он (и библиотека openai) создаётся при первом запросе.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+
+import metrics
+from streaming import chat_completion, chat_completion_chunks
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+@dataclass
+class Route:
+    models: list
+    hedge: bool = False
+
+
+def parse_routes(value: str) -> dict:
+    """MODEL_ROUTES="session_turn=gpt-4o|gpt-4o-mini,summary=gpt-4o-mini" → {место вызова: [модели]}."""
+    return {
+        name.strip(): [model.strip() for model in models.split("|") if model.strip()]
+        for name, models in (item.split("=") for item in value.split(",") if "=" in item)
+    }
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Ошибка, после которой имеет смысл спросить другую модель: сеть, таймаут, 429, 5xx."""
+    # openai к этому моменту уже импортирован клиентом, повторный импорт ничего не стоит
+    import openai
+    return isinstance(error, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError, asyncio.TimeoutError))
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+@dataclass
+class ModelHealth:
+    """Скользящая статистика модели за последние `window` секунд и её автомат защиты."""
+
+    model: str
+    window: float = 60
+    min_samples: int = 5
+    error_threshold: float = 0.5
+    slow_threshold: float = None
+    cooldown: float = 30
+    state: str = field(default=CLOSED, init=False)
+    opened_at: float = field(default=0.0, init=False)
+    _outcomes: deque = field(default_factory=deque, init=False, repr=False)
+    _latencies: dict = field(default_factory=dict, init=False, repr=False)
+    _probing: bool = field(default=False, init=False, repr=False)
+
+    def _trim(self, samples: deque, now: float):
+        while samples and samples[0][0] < now - self.window:
+            samples.popleft()
+
+    def error_rate(self, now: float = None) -> float:
+        self._trim(self._outcomes, now or time.monotonic())
+        return sum(1 for _, ok in self._outcomes if not ok) / len(self._outcomes) if self._outcomes else 0.0
+
+    def p95(self, kind: str, now: float = None):
+        """p95 задержки вида `kind` ("stream" — до первого токена, "complete" — всего ответа) или None, если данных мало."""
+        samples = self._latencies.get(kind)
+        if not samples:
+            return None
+        self._trim(samples, now or time.monotonic())
+        return percentile([seconds for _, seconds in samples], 0.95) if len(samples) >= self.min_samples else None
+
+    def allow(self, now: float = None) -> bool:
+        """Можно ли отправить запрос. В полуоткрытом состоянии пропускается один пробный запрос."""
+        now = now or time.monotonic()
+        if self.state == OPEN and now - self.opened_at >= self.cooldown:
+            self._set_state(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            if self._probing:
+                return False
+            self._probing = True
+        return self.state != OPEN
+
+    def observe(self, kind: str, seconds: float):
+        samples = self._latencies.setdefault(kind, deque())
+        samples.append((time.monotonic(), seconds))
+
+    def abandon(self, kind: str, seconds: float):
+        """Запрос отменён, потому что раньше ответила другая модель."""
+        self.observe(kind, seconds)
+        self._probing = False
+
+    def success(self, kind: str, seconds: float):
+        now = time.monotonic()
+        if self.state == HALF_OPEN:
+            if kind == "stream" and self.slow_threshold and seconds >= self.slow_threshold:
+                self.observe(kind, seconds)
+                self._open(now, f"пробный запрос ответил за {seconds:.1f} с")
+                return
+            # Статистика до отключения устарела
+            self._reset()
+            self._set_state(CLOSED)
+        self.observe(kind, seconds)
+        self._outcomes.append((now, True))
+        if self.state == CLOSED:
+            self._check(now)
+
+    def failure(self):
+        now = time.monotonic()
+        self._outcomes.append((now, False))
+        if self.state == HALF_OPEN:
+            self._open(now, "пробный запрос не удался")
+        elif self.state == CLOSED:
+            self._check(now)
+
+    def _check(self, now: float):
+        self._trim(self._outcomes, now)
+        if len(self._outcomes) >= self.min_samples and self.error_rate(now) >= self.error_threshold:
+            self._open(now, f"доля ошибок {self.error_rate(now):.0%}")
+            return
+        slow = self.p95("stream", now)
+        if self.slow_threshold and slow is not None and slow >= self.slow_threshold:
+            self._open(now, f"p95 до первого токена {slow:.1f} с")
+
+    def _open(self, now: float, reason: str):
+        logging.warning(f"Модель {self.model} отключена на {self.cooldown:.0f} с: {reason}")
+        self.opened_at = now
+        self._set_state(OPEN)
+
+    def _reset(self):
+        self._outcomes.clear()
+        self._latencies.clear()
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            if state == CLOSED:
+                logging.info(f"Модель {self.model} снова доступна")
+            self.state = state
+        self._probing = False
+        metrics.openai_model_state.set(STATE_CODES[state], model=self.model)
+
+
+class ModelRouter:
+    """Отправляет запросы к OpenAI по маршрутам с учётом состояния моделей."""
+
+    def __init__(self, client, routes: dict, default_route: Route, window: float = 60, min_samples: int = 5,
+                 error_threshold: float = 0.5, slow_threshold: float = None, cooldown: float = 30):
+        self._client = client
+        self.routes = routes
+        self.default_route = default_route
+        self._health_options = dict(window=window, min_samples=min_samples, error_threshold=error_threshold,
+                                    slow_threshold=slow_threshold, cooldown=cooldown)
+        self.health = {}
+        self.fallbacks = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    @property
+    def client(self):
+        return self._client() if callable(self._client) else self._client
+
+    def route(self, call_site: str) -> Route:
+        return self.routes.get(call_site, self.default_route)
+
+    def model_health(self, model: str) -> ModelHealth:
+        if model not in self.health:
+            self.health[model] = ModelHealth(model, **self._health_options)
+            metrics.openai_model_state.set(STATE_CODES[CLOSED], model=model)
+        return self.health[model]
+
+    async def _first_response(self, call_site: str, kind: str, attempt, discard):
+        """Возвращает (модель, результат) первой модели маршрута, ответившей без ошибки."""
+        route = self.route(call_site)
+        models = list(route.models)
+        pending = {}
+        winner = None
+        last_error = None
+
+        def launch(hedged: bool = False) -> bool:
+            # Состояние модели проверяется непосредственно перед запросом: allow() выдаёт пробный запрос
+            while models:
+                model = models.pop(0)
+                if self.model_health(model).allow():
+                    pending[asyncio.create_task(attempt(model))] = (model, time.perf_counter(), hedged)
+                    return True
+            return False
+
+        if not launch():
+            # Отключены все модели маршрута — лучше попробовать основную, чем сразу отказать пользователю
+            model = route.models[0]
+            pending[asyncio.create_task(attempt(model))] = (model, time.perf_counter(), False)
+        try:
+            while pending and winner is None:
+                hedge_after = None
+                if route.hedge and models and len(pending) == 1:
+                    (model, started, _), = pending.values()
+                    p95 = self.model_health(model).p95(kind)
+                    if p95 is not None:
+                        hedge_after = max(0.0, started + p95 - time.perf_counter())
+                done, _ = await asyncio.wait(pending, timeout=hedge_after, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if launch(hedged=True):
+                        self.hedges += 1
+                    continue
+                for task in done:
+                    model, started, hedged = pending.pop(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        if not is_retryable(e):
+                            raise
+                        self.model_health(model).failure()
+                        metrics.openai_model_requests.inc(call_site=call_site, model=model, outcome="error")
+                        logging.warning(f"[{call_site}] модель {model} не ответила: {e!r}")
+                        last_error = e
+                        continue
+                    if winner is not None:
+                        # Обе модели ответили одновременно — лишний ответ закрываем
+                        await discard(result)
+                        continue
+                    self.model_health(model).success(kind, time.perf_counter() - started)
+                    metrics.openai_model_requests.inc(call_site=call_site, model=model, outcome="ok")
+                    self.hedge_wins += hedged
+                    winner = model, result
+                if winner is None and not pending and launch():
+                    self.fallbacks += 1
+            if winner is None:
+                raise last_error
+            return winner
+        finally:
+            for task, (model, started, _) in pending.items():
+                task.cancel()
+                # Проигравший запрос был как минимум настолько медленным
+                self.model_health(model).abandon(kind, time.perf_counter() - started)
+                metrics.openai_model_requests.inc(call_site=call_site, model=model, outcome="cancelled")
+            for task in pending:
+                try:
+                    result = await task
+                except BaseException:
+                    continue
+                await discard(result)
+
+    async def complete(self, call_site: str, **kwargs):
+        """Обычный запрос: ответ первой доступной модели маршрута."""
+        async def attempt(model):
+            return await chat_completion(self.client, call_site, model=model, **kwargs)
+
+        async def discard(response):
+            pass
+
+        _, response = await self._first_response(call_site, "complete", attempt, discard)
+        return response
+
+    async def stream(self, call_site: str, **kwargs):
+        """Потоковый запрос: модель выбирается по первому кусочку ответа, дальше поток идёт от неё."""
+        async def attempt(model):
+            chunks = chat_completion_chunks(self.client, call_site, model=model, **kwargs)
+            try:
+                return chunks, await chunks.__anext__()
+            except StopAsyncIteration:
+                return chunks, None
+            except BaseException:
+                await chunks.aclose()
+                raise
+
+        async def discard(result):
+            await result[0].aclose()
+
+        model, (chunks, first) = await self._first_response(call_site, "stream", attempt, discard)
+        try:
+            if first is not None:
+                yield first
+            async for delta in chunks:
+                yield delta
+        except Exception as e:
+            if is_retryable(e):
+                self.model_health(model).failure()
+            raise
+        finally:
+            await chunks.aclose()
+
+    def metrics(self) -> dict:
+        return {
+            "fallbacks": self.fallbacks, "hedges": self.hedges, "hedge_wins": self.hedge_wins,
+            "open_models": sum(1 for health in self.health.values() if health.state == OPEN),
+        }
@@ -0,0 +1,90 @@
+import asyncio
+import hashlib
+import logging
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS session_openers (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    prompt_hash TEXT NOT NULL,
+    text TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_session_openers_prompt ON session_openers (prompt_hash);
+"""
+
+
+def create_schema(conn):
+    conn.executescript(SCHEMA)
+
+
+def prompt_hash(prompt: str) -> str:
+    """Ключ кэша: хэш готового промпта сессии (шаблон промпта + текст плана)."""
+    return hashlib.sha256(prompt.encode()).hexdigest()
+
+
+class OpenerCache:
+    """Кэш приветственных сообщений для начала сессии по плану.
+
+    Для каждого плана хранится небольшой пул заранее сгенерированных вариантов.
+    `take()` выдаёт случайный вариант из пула и в фоне догенерирует новый,
+    поэтому начало сессии обходится без запроса к модели. Общее число
+    сохранённых вариантов ограничено `max_entries`: при вставке удаляются варианты,
+    сохранённые раньше последних `max_entries` вставок (по id, без подсчёта всей таблицы).
+    """
+
+    def __init__(self, db, generate, pool_size: int = 3, max_entries: int = 30000):
+        self.db = db
+        self.generate = generate
+        self.pool_size = pool_size
+        self.max_entries = max_entries
+        self._refilling = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def take(self, prompt: str):
+        key = prompt_hash(prompt)
+        text = await self.db.transaction(self._pop, key)
+        if text is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        self.warm(prompt)
+        return text
+
+    @staticmethod
+    def _pop(conn, key: str):
+        row = conn.execute(
+            "DELETE FROM session_openers WHERE id = (SELECT id FROM session_openers WHERE prompt_hash = ? ORDER BY random() LIMIT 1) RETURNING text",
+            (key,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def warm(self, prompt: str):
+        """Запускает фоновое пополнение пула для промпта, если оно ещё не идёт."""
+        key = prompt_hash(prompt)
+        if key in self._refilling:
+            return
+        task = asyncio.create_task(self._refill(key, prompt))
+        self._refilling[key] = task
+        task.add_done_callback(lambda _: self._refilling.pop(key, None))
+
+    async def _refill(self, key: str, prompt: str):
+        try:
+            row = await self.db.fetchone("SELECT COUNT(*) FROM session_openers WHERE prompt_hash = ?", (key,))
+            for _ in range(self.pool_size - row[0]):
+                text = await self.generate(prompt)
+                await self.db.transaction(self._store, key, text)
+        except Exception as e:
+            logging.error(f"Не удалось пополнить кэш приветствий: {e}")
+
+    def _store(self, conn, key: str, text: str):
+        new_id = conn.execute(
+            "INSERT INTO session_openers (prompt_hash, text, created_at) VALUES (?, ?, ?)",
+            (key, text, time.time())
+        ).lastrowid
+        # id растут монотонно (AUTOINCREMENT), поэтому строк с id из последнего окна не больше max_entries
+        conn.execute("DELETE FROM session_openers WHERE id <= ?", (new_id - self.max_entries,))
+
+    def metrics(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "refilling": len(self._refilling)}
@@ -0,0 +1,106 @@
+import asyncio
+import json
+import logging
+import time
+import uuid
+
+import aiohttp
+
+YOOKASSA_API_URL = "https://api.yookassa.ru/v3"
+
+
+class PaymentError(Exception):
+    """Ошибка платёжного провайдера."""
+
+
+class TransientPaymentError(PaymentError):
+    """Временная ошибка платёжного провайдера, запрос можно повторить."""
+
+
+class YooKassaClient:
+    """Асинхронный клиент API ЮKassa с общим пулом HTTP-соединений и таймаутами."""
+
+    def __init__(self, shop_id: str, secret_key: str, api_url: str = YOOKASSA_API_URL,
+                 timeout: float = 15, pool_size: int = 20):
+        self.api_url = api_url.rstrip("/")
+        self._auth = aiohttp.BasicAuth(shop_id, secret_key)
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+        self._pool_size = pool_size
+        self._session = None
+
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                auth=self._auth, timeout=self._timeout,
+                connector=aiohttp.TCPConnector(limit=self._pool_size, keepalive_timeout=60),
+            )
+        return self._session
+
+    async def create_payment(self, payload: dict, idempotency_key: str) -> dict:
+        try:
+            async with self.session().post(
+                f"{self.api_url}/payments", json=payload, headers={"Idempotence-Key": str(idempotency_key)}
+            ) as response:
+                text = await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise TransientPaymentError(f"YooKassa request failed: {e!r}") from e
+        try:
+            body = json.loads(text)
+        except ValueError:
+            # Балансировщик при 502/503 отвечает HTML-страницей: тело оставляем для текста ошибки
+            body = text[:500]
+        if response.status == 429 or response.status >= 500:
+            raise TransientPaymentError(f"YooKassa {response.status}: {body}")
+        if response.status >= 400:
+            raise PaymentError(f"YooKassa {response.status}: {body}")
+        if not isinstance(body, dict):
+            # Платёж мог создаться; повтор с тем же ключом идемпотентности вернёт его, а не создаст новый
+            raise TransientPaymentError(f"YooKassa {response.status}: unexpected response {body!r}")
+        return body
+
+    async def warm(self):
+        """Открывает соединение с API заранее, чтобы первый платёж не ждал TCP и TLS."""
+        async with self.session().get(f"{self.api_url}/me") as response:
+            await response.read()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+class PendingPayments:
+    """Повторные нажатия «Оплатить» в течение `window` секунд получают ту же ссылку на оплату.
+
+    Одновременные запросы одного пользователя ждут один и тот же вызов провайдера.
+    """
+
+    def __init__(self, client: YooKassaClient, window: float = 600):
+        self.client = client
+        self.window = window
+        self._pending = {}
+        self.reused = 0
+
+    async def confirmation_url(self, user_id: int, payload: dict) -> str:
+        now = time.monotonic()
+        for key in [k for k, (created, _) in self._pending.items() if now - created >= self.window]:
+            del self._pending[key]
+
+        entry = self._pending.get(user_id)
+        if entry is not None:
+            self.reused += 1
+            return await asyncio.shield(entry[1])
+
+        task = asyncio.create_task(self._create(payload))
+        self._pending[user_id] = (now, task)
+        try:
+            return await asyncio.shield(task)
+        except Exception:
+            # Неудачную попытку не кэшируем — следующее нажатие создаст платёж заново
+            if self._pending.get(user_id, (None, None))[1] is task:
+                del self._pending[user_id]
+            raise
+
+    async def _create(self, payload: dict) -> str:
+        payment = await self.client.create_payment(payload, str(uuid.uuid4()))
+        logging.info(f"Created payment {payment.get('id')} for user {payload.get('metadata', {}).get('user_id')}")
+        return payment["confirmation"]["confirmation_url"]
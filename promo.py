@@ -0,0 +1,137 @@
+"""Промокоды: пакетная генерация и атомарная активация.
+
+Коды создаются пакетами (`promo_batches`) массовой вставкой. Большой пакет бот пишет частями,
+по транзакции на часть (`add_codes`), чтобы не занимать поток записи надолго.
+Код может быть одноразовым (max_uses = 1), многоразовым (max_uses = N) или
+безлимитным (max_uses IS NULL); один пользователь активирует код не больше одного раза.
+
+Активация — один условный UPDATE ... RETURNING: проверка и списание использования
+происходят в одном операторе под блокировкой записи SQLite, поэтому при одновременных
+попытках (в том числе из разных процессов) код не активируется сверх лимита.
+"""
+import secrets
+from datetime import datetime, timedelta
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS promo_codes (
+    code TEXT PRIMARY KEY,
+    duration_days INTEGER NOT NULL,
+    is_active INTEGER DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS promo_batches (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    codes INTEGER NOT NULL,
+    duration_days INTEGER NOT NULL,
+    max_uses INTEGER,
+    note TEXT NOT NULL DEFAULT '',
+    created_by INTEGER,
+    created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS promo_redemptions (
+    code TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    redeemed_at TEXT NOT NULL,
+    PRIMARY KEY (code, user_id)
+);
+"""
+
+# Колонки, добавленные к promo_codes после первой версии; старые коды — одноразовые и без пакета
+PROMO_CODE_COLUMNS = {
+    "max_uses": "INTEGER DEFAULT 1",
+    "uses": "INTEGER NOT NULL DEFAULT 0",
+    "batch_id": "INTEGER",
+}
+
+# Без 0/O и 1/I, которые легко перепутать при вводе
+ALPHABET = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"
+CODE_LENGTH = 10
+# Случайный байт -> символ алфавита; 256 делится на 32, так что все символы равновероятны
+_BYTE_TO_CHAR = bytes(ord(ALPHABET[i % len(ALPHABET)]) for i in range(256))
+
+
+def create_schema(conn):
+    conn.executescript(SCHEMA)
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(promo_codes)")}
+    for column, definition in PROMO_CODE_COLUMNS.items():
+        if column not in existing:
+            conn.execute(f"ALTER TABLE promo_codes ADD COLUMN {column} {definition}")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_promo_codes_batch ON promo_codes (batch_id)")
+
+
+def generate_code(length: int = CODE_LENGTH, prefix: str = "") -> str:
+    return prefix + secrets.token_bytes(length).translate(_BYTE_TO_CHAR).decode()
+
+
+def new_batch(conn, duration_days: int, max_uses: int = 1, note: str = "", created_by: int = None) -> int:
+    """Создаёт пустой пакет и возвращает его id; коды добавляет `add_codes`. max_uses=None — без ограничения."""
+    return conn.execute(
+        "INSERT INTO promo_batches (codes, duration_days, max_uses, note, created_by, created_at) VALUES (0, ?, ?, ?, ?, ?)",
+        (duration_days, max_uses, note, created_by, datetime.utcnow().isoformat(" "))
+    ).lastrowid
+
+
+def add_codes(conn, batch_id: int, count: int, prefix: str = "") -> int:
+    """Добавляет в пакет `count` новых кодов с его сроком и лимитом активаций."""
+    duration_days, max_uses = conn.execute(
+        "SELECT duration_days, max_uses FROM promo_batches WHERE id = ?", (batch_id,)
+    ).fetchone()
+    inserted = 0
+    # Совпадение со существующим кодом маловероятно (32^10 вариантов), но возможно — тогда догенерируем
+    while inserted < count:
+        before = conn.total_changes
+        conn.executemany(
+            "INSERT OR IGNORE INTO promo_codes (code, duration_days, is_active, max_uses, uses, batch_id) VALUES (?, ?, 1, ?, 0, ?)",
+            ((generate_code(prefix=prefix), duration_days, max_uses, batch_id) for _ in range(count - inserted))
+        )
+        inserted += conn.total_changes - before
+    conn.execute("UPDATE promo_batches SET codes = codes + ? WHERE id = ?", (count, batch_id))
+    return count
+
+
+def create_batch(conn, count: int, duration_days: int, max_uses: int = 1, note: str = "", created_by: int = None,
+                 prefix: str = "") -> int:
+    """Создаёт пакет из `count` кодов в одной транзакции и возвращает его id."""
+    batch_id = new_batch(conn, duration_days, max_uses, note, created_by)
+    add_codes(conn, batch_id, count, prefix)
+    return batch_id
+
+
+def batch_codes(conn, batch_id: int) -> list:
+    return [code for (code,) in conn.execute("SELECT code FROM promo_codes WHERE batch_id = ? ORDER BY rowid", (batch_id,))]
+
+
+def batch_summaries(conn, limit: int = 10) -> list:
+    """Последние пакеты: (id, created_at, codes, duration_days, max_uses, note, активаций)."""
+    return conn.execute(
+        """
+        SELECT b.id, b.created_at, b.codes, b.duration_days, b.max_uses, b.note,
+               (SELECT COALESCE(SUM(uses), 0) FROM promo_codes WHERE batch_id = b.id)
+        FROM promo_batches b ORDER BY b.id DESC LIMIT ?
+        """,
+        (limit,)
+    ).fetchall()
+
+
+def redeem(conn, code: str, user_id: int, now: datetime = None):
+    """Активирует код для пользователя. Возвращает срок подписки в днях или None, если код недоступен."""
+    row = conn.execute(
+        """
+        UPDATE promo_codes
+        SET uses = uses + 1,
+            is_active = CASE WHEN max_uses IS NOT NULL AND uses + 1 >= max_uses THEN 0 ELSE 1 END
+        WHERE code = ? AND is_active = 1 AND (max_uses IS NULL OR uses < max_uses)
+          AND NOT EXISTS (SELECT 1 FROM promo_redemptions WHERE code = ? AND user_id = ?)
+        RETURNING duration_days
+        """,
+        (code, code, user_id)
+    ).fetchone()
+    if row is None:
+        return None
+    now = now or datetime.utcnow()
+    conn.execute("INSERT INTO promo_redemptions (code, user_id, redeemed_at) VALUES (?, ?, ?)",
+                 (code, user_id, now.isoformat(" ")))
+    conn.execute(
+        "UPDATE users SET subscription_status = ?, subscription_expires_at = ? WHERE user_id = ?",
+        ('paid', (now + timedelta(days=row[0])).isoformat(), user_id)
+    )
+    return row[0]
@@ -0,0 +1,42 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """Ограничитель частоты «ведро токенов»: `rate` токенов в секунду, запас до `capacity`."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    @property
+    def tokens(self) -> float:
+        self._refill()
+        return self._tokens
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    def consume(self, tokens: float = 1):
+        """Забирает токены без ожидания, даже в долг: следующим ожидающим придётся подождать дольше."""
+        self._refill()
+        self._tokens -= tokens
+
+    async def acquire(self, tokens: float = 1):
+        """Ждёт, пока в ведре наберётся `tokens` токенов, и забирает их (в порядке очереди)."""
+        tokens = min(tokens, self.capacity)
+        async with self._lock:
+            while not self.try_acquire(tokens):
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
@@ -0,0 +1,232 @@
+"""Автопродление подписок по сроку окончания, а не ежедневным сканированием.
+
+Ближайшие окончания подписок с сохранённой картой держатся в памяти в min-куче
+(срок, user_id). Каждое продление срабатывает вскоре после окончания подписки
+со случайной задержкой до `jitter` секунд, чтобы одновременные окончания не шли
+к ЮKassa одной пачкой.
+
+Куча строится из БД при запуске (по частичному индексу `idx_users_renewal`).
+Оплата и промокод в этом процессе сразу обновляют её через `refresh()`. Изменения
+из других процессов планировщик подхватывает, раз в `sync_interval` секунд
+перечитывая окно ближайших окончаний. Устаревшие записи кучи не удаляются, а
+пропускаются при извлечении. Перед списанием строка пользователя перечитывается:
+если карту отвязали или срок уже продлён, списания не будет.
+
+Если списание не привело к продлению (карта отклонена, платёж не подтверждён),
+следующая попытка будет через `retry_interval` секунд, как раньше при ежедневном запуске.
+"""
+import asyncio
+import heapq
+import logging
+import random
+import time
+from datetime import datetime, timezone
+
+SCHEMA = """
+CREATE INDEX IF NOT EXISTS idx_users_renewal ON users (subscription_expires_at)
+    WHERE subscription_status = 'paid' AND yookassa_payment_method_id IS NOT NULL;
+"""
+
+RENEWABLE = "subscription_status = 'paid' AND yookassa_payment_method_id IS NOT NULL"
+# Верхняя граница для выборки всех сроков. Не число: у колонки DATETIME числовое сродство,
+# и строка вроде "9999" стала бы числом, которое меньше любой строки
+MAX_EXPIRY = "9999-12-31"
+
+
+def create_schema(conn):
+    conn.executescript(SCHEMA)
+
+
+def expiring_between(conn, start: str, end: str) -> list:
+    """(user_id, subscription_expires_at) подписок с картой, истекающих в [start, end)."""
+    return conn.execute(
+        f"SELECT user_id, subscription_expires_at FROM users WHERE {RENEWABLE} "
+        "AND subscription_expires_at >= ? AND subscription_expires_at < ?",
+        (start, end)
+    ).fetchall()
+
+
+def renewable_rows(conn, user_ids) -> dict:
+    """user_id -> (payment_method_id, subscription_expires_at) для тех, кого ещё можно продлить."""
+    placeholders = ",".join("?" * len(user_ids))
+    rows = conn.execute(
+        f"SELECT user_id, yookassa_payment_method_id, subscription_expires_at FROM users "
+        f"WHERE user_id IN ({placeholders}) AND {RENEWABLE}",
+        list(user_ids)
+    ).fetchall()
+    return {user_id: (payment_method_id, expires_at) for user_id, payment_method_id, expires_at in rows}
+
+
+def timestamp(expires_at: str) -> float:
+    return datetime.fromisoformat(expires_at).replace(tzinfo=timezone.utc).timestamp()
+
+
+def isoformat(ts: float) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).replace(tzinfo=None).isoformat()
+
+
+class RenewalScheduler:
+    """`charge(charges)` получает список (user_id, payment_method_id, период) — как BillingEngine.run.
+
+    `is_active()` — можно ли списывать сейчас; в многопроцессном режиме это лидерство,
+    остальные процессы планировщик не запускают.
+    """
+
+    def __init__(self, db, charge, is_active=lambda: True, jitter: float = 300, sync_interval: float = 300,
+                 retry_interval: float = 86400, batch_size: int = 500):
+        self.db = db
+        self.charge = charge
+        self.is_active = is_active
+        self.jitter = jitter
+        self.sync_interval = sync_interval
+        self.retry_interval = retry_interval
+        self.batch_size = batch_size
+        self._heap = []
+        self._due = {}  # user_id -> (срок срабатывания, subscription_expires_at) — актуальная запись кучи
+        self._wakeup = asyncio.Event()
+        self._needs_rebuild = True
+        self._next_sync = 0.0
+        self._task = None
+        self.charged = 0
+        self.dropped = 0
+        self.max_lag = 0.0
+
+    # --- Куча ---
+    def _push(self, user_id: int, expires_at: str, due: float = None):
+        if due is None:
+            due = timestamp(expires_at) + random.uniform(0, self.jitter)
+        self._due[user_id] = (due, expires_at)
+        heapq.heappush(self._heap, (due, user_id, expires_at))
+        # Устаревших записей стало слишком много — пересобираем кучу из актуальных
+        if len(self._heap) > 2 * len(self._due) + 1000:
+            self._heap = [(due, user_id, expires_at) for user_id, (due, expires_at) in self._due.items()]
+            heapq.heapify(self._heap)
+        if self._heap[0][1] == user_id:
+            self._wakeup.set()
+
+    def _pop_due(self, now: float) -> list:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            when, user_id, expires_at = heapq.heappop(self._heap)
+            if self._due.get(user_id) == (when, expires_at):
+                due.append((user_id, expires_at))
+        return due
+
+    async def rebuild(self):
+        """Загружает из БД все подписки с картой. Давно истёкшие (их уже пытались продлить)
+        распределяются по ближайшему `retry_interval`, чтобы перезапуск не списывал их разом."""
+        rows = await self.db.read(expiring_between, "", MAX_EXPIRY)
+        now = time.time()
+        self._heap, self._due = [], {}
+        for user_id, expires_at in rows:
+            expires = timestamp(expires_at)
+            due = now + random.uniform(0, self.retry_interval) if expires < now - self.jitter else None
+            self._push(user_id, expires_at, due)
+        self._next_sync = now + self.sync_interval
+        self._needs_rebuild = False
+        logging.info(f"Планировщик продлений: загружено {len(rows)} подписок с автопродлением")
+
+    async def sync(self, now: float):
+        """Подхватывает сроки, изменённые в других процессах, в окне ближайших окончаний."""
+        rows = await self.db.read(expiring_between, isoformat(now - self.sync_interval), isoformat(now + 2 * self.sync_interval))
+        for user_id, expires_at in rows:
+            if self._due.get(user_id, (None, None))[1] != expires_at:
+                self._push(user_id, expires_at)
+        self._next_sync = now + self.sync_interval
+
+    async def refresh(self, user_ids):
+        """Перечитывает сроки пользователей после оплаты, промокода или отвязки карты."""
+        if self._task is None or not user_ids:
+            return
+        rows = await self.db.read(renewable_rows, list(user_ids))
+        for user_id in user_ids:
+            if user_id in rows:
+                expires_at = rows[user_id][1]
+                if self._due.get(user_id, (None, None))[1] != expires_at:
+                    self._push(user_id, expires_at)
+            else:
+                self._due.pop(user_id, None)
+
+    # --- Списания ---
+    async def _fire_due(self, now: float):
+        due = self._pop_due(now)
+        for start in range(0, len(due), self.batch_size):
+            end = start + self.batch_size
+            batch = dict(due[start:end])
+            try:
+                rows = await self.db.read(renewable_rows, list(batch))
+            except Exception:
+                # Не смогли проверить — вернём в кучу всё, что ещё не списывали
+                for user_id, expires_at in due[start:]:
+                    self._push(user_id, expires_at, now + self.sync_interval)
+                raise
+            charges = []
+            for user_id, expires_at in batch.items():
+                if user_id not in rows:
+                    self._due.pop(user_id, None)
+                    self.dropped += 1
+                    continue
+                payment_method_id, current = rows[user_id]
+                if current != expires_at:
+                    self._push(user_id, current)
+                    continue
+                charges.append((user_id, payment_method_id, expires_at))
+                self.max_lag = max(self.max_lag, now - timestamp(expires_at))
+                # Повтор, если оплата так и не продлит срок; после продления запись устареет
+                self._push(user_id, expires_at, now + self.retry_interval + random.uniform(0, self.jitter))
+            if charges:
+                logging.info(f"Планировщик продлений: списание для {len(charges)} подписок")
+                try:
+                    await self.charge(charges)
+                except Exception:
+                    # Эта пачка уже стоит в куче на повтор; следующие пачки вернём, как при ошибке чтения
+                    for user_id, expires_at in due[end:]:
+                        self._push(user_id, expires_at, now + self.sync_interval)
+                    raise
+                self.charged += len(charges)
+
+    # --- Жизненный цикл ---
+    def start(self):
+        """Запускает планировщик; повторный вызов (например, при новом получении лидерства) перечитывает БД."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        else:
+            self._needs_rebuild = True
+            self._wakeup.set()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            timeout = self.sync_interval
+            try:
+                if self._needs_rebuild:
+                    await self.rebuild()
+                now = time.time()
+                if now >= self._next_sync:
+                    await self.sync(now)
+                if self.is_active():
+                    await self._fire_due(now)
+                    if self._heap:
+                        timeout = self._heap[0][0] - time.time()
+                timeout = max(0.0, min(timeout, self._next_sync - time.time()))
+            except Exception as e:
+                logging.error(f"Ошибка планировщика продлений: {e}")
+            self._wakeup.clear()
+            # Не wait_for: в Python 3.11 он теряет отмену, если событие установлено в тот же момент
+            waiter = asyncio.ensure_future(self._wakeup.wait())
+            try:
+                await asyncio.wait([waiter], timeout=timeout)
+            finally:
+                waiter.cancel()
+
+    def metrics(self) -> dict:
+        next_due = self._heap[0][0] - time.time() if self._heap else 0
+        return {
+            "tracked": len(self._due), "heap": len(self._heap), "charged": self.charged,
+            "dropped": self.dropped, "max_lag_seconds": self.max_lag, "next_due_seconds": max(0.0, next_due),
+        }
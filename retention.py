@@ -0,0 +1,287 @@
+"""Хранение аналитики: старые события переносятся из `analytics` в помесячные архивные файлы.
+
+События старше горизонта хранения (полные месяцы) выгружаются в сжатый колоночный файл
+`<archive_dir>/analytics-YYYY-MM.partN.bin`, партиция регистрируется в
+`analytics_archive_partitions`, после чего строки удаляются из `analytics` небольшими
+пачками, каждая в своей короткой транзакции, — запись новых событий не блокируется.
+
+Статистика не зависит от `analytics`: она считается по дневным агрегатам (rollups),
+в которые архивные события уже вошли. Если агрегаты нужно перестроить, `archived_batches()`
+отдаёт события из архивов вместе с живыми строками.
+
+Формат файла: MAGIC, 4 байта длины JSON-заголовка, заголовок, затем колонки подряд,
+каждая сжата zlib: id (дельты, int64), user_id (int64), код типа события (uint16,
+словарь типов в заголовке), время в микросекундах UTC (дельты, int64). Строки упорядочены по id.
+
+Инструмент:
+    python retention.py status              — партиции архива и число живых строк
+    python retention.py read 2025-01        — вывести события месяца из архива в CSV
+"""
+import argparse
+import asyncio
+import csv
+import hashlib
+import heapq
+import json
+import logging
+import os
+import sqlite3
+import struct
+import sys
+import time
+import zlib
+from array import array
+from collections import Counter
+from datetime import datetime, timedelta
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS analytics_archive_partitions (
+    month TEXT NOT NULL,
+    part INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    rows INTEGER NOT NULL,
+    bytes INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    event_counts TEXT NOT NULL,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (month, part)
+);
+"""
+
+MAGIC = b"BOTANL1\n"
+# Сколько строк читать из курсора за раз при выгрузке месяца
+EXPORT_PAGE_ROWS = 10000
+EPOCH = datetime(1970, 1, 1)
+
+
+def create_schema(conn):
+    conn.executescript(SCHEMA)
+
+
+def _to_micros(timestamp: str) -> int:
+    delta = datetime.fromisoformat(timestamp) - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+
+def _from_micros(micros: int) -> str:
+    return (EPOCH + timedelta(microseconds=micros)).isoformat(" ")
+
+
+def _deltas(values: array) -> array:
+    result = array("q", values)
+    for index in range(len(result) - 1, 0, -1):
+        result[index] -= result[index - 1]
+    return result
+
+
+def _undeltas(values: array) -> array:
+    for index in range(1, len(values)):
+        values[index] += values[index - 1]
+    return values
+
+
+def encode_partition(month: str, rows) -> tuple:
+    """Кодирует строки (id, user_id, event_type, timestamp), упорядоченные по id, в байты файла."""
+    ids, user_ids, codes, times = array("q"), array("q"), array("H"), array("q")
+    event_types = {}
+    for row_id, user_id, event_type, timestamp in rows:
+        ids.append(row_id)
+        user_ids.append(user_id)
+        codes.append(event_types.setdefault(event_type, len(event_types)))
+        times.append(_to_micros(timestamp))
+
+    columns = [("id", _deltas(ids)), ("user_id", user_ids), ("event_type", codes), ("timestamp_us", _deltas(times))]
+    blobs = [zlib.compress(column.tobytes(), 6) for _, column in columns]
+    header = json.dumps({
+        "month": month, "rows": len(ids), "byteorder": sys.byteorder,
+        "event_types": list(event_types),
+        "columns": [[name, column.typecode, len(blob)] for (name, column), blob in zip(columns, blobs)],
+    }).encode()
+    return MAGIC + struct.pack(">I", len(header)) + header + b"".join(blobs), ids
+
+
+def decode_partition(data: bytes):
+    """Читает файл партиции и отдаёт строки (id, user_id, event_type, timestamp)."""
+    if not data.startswith(MAGIC):
+        raise ValueError("not an analytics archive partition")
+    offset = len(MAGIC)
+    (header_size,) = struct.unpack(">I", data[offset:offset + 4])
+    offset += 4
+    header = json.loads(data[offset:offset + header_size])
+    offset += header_size
+
+    columns = {}
+    for name, typecode, size in header["columns"]:
+        column = array(typecode)
+        column.frombytes(zlib.decompress(data[offset:offset + size]))
+        if header["byteorder"] != sys.byteorder:
+            column.byteswap()
+        columns[name] = column
+        offset += size
+
+    ids, times = _undeltas(columns["id"]), _undeltas(columns["timestamp_us"])
+    event_types = header["event_types"]
+    for index in range(header["rows"]):
+        yield ids[index], columns["user_id"][index], event_types[columns["event_type"][index]], _from_micros(times[index])
+
+
+def read_partition(path: str):
+    with open(path, "rb") as f:
+        return list(decode_partition(f.read()))
+
+
+def archived_batches(conn, batch_size: int = 10000):
+    """События из всех архивных партиций пачками (user_id, event_type, timestamp) — для перестройки агрегатов."""
+    for (path,) in conn.execute("SELECT path FROM analytics_archive_partitions ORDER BY month, part").fetchall():
+        batch = []
+        for _, user_id, event_type, timestamp in read_partition(path):
+            batch.append((user_id, event_type, timestamp))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def _month_start(day: datetime) -> datetime:
+    return day.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _next_month(month: str) -> str:
+    year, number = map(int, month.split("-"))
+    return f"{year + number // 12}-{number % 12 + 1:02d}"
+
+
+class AnalyticsRetention:
+    """Переносит в архив полные месяцы старше `horizon_days` дней."""
+
+    def __init__(self, db, archive_dir: str, horizon_days: int = 180, delete_batch: int = 5000, pause: float = 0.05):
+        self.db = db
+        self.archive_dir = archive_dir
+        self.horizon_days = horizon_days
+        self.delete_batch = delete_batch
+        self.pause = pause
+        self.archived_rows = 0
+        self.deleted_rows = 0
+
+    def cutoff(self, now: datetime = None) -> str:
+        """Начало месяца, в который попадает горизонт хранения: всё раньше этой даты архивируется."""
+        return _month_start((now or datetime.utcnow()) - timedelta(days=self.horizon_days)).isoformat(" ")
+
+    @staticmethod
+    def _months(conn, cutoff: str) -> list:
+        # Поиск идёт по индексу (event_type, timestamp, user_id) отдельно для каждого типа события
+        months = set()
+        for (event_type,) in conn.execute("SELECT DISTINCT event_type FROM daily_event_counts").fetchall():
+            row = conn.execute(
+                "SELECT MIN(timestamp) FROM analytics WHERE event_type = ? AND timestamp < ?", (event_type, cutoff)
+            ).fetchone()
+            month = row[0][:7] if row[0] else None
+            while month and f"{month}-01" < cutoff[:10]:
+                months.add(month)
+                month = _next_month(month)
+        return sorted(months)
+
+    @staticmethod
+    def _export(conn, month: str, path: str):
+        start, end = f"{month}-01", f"{_next_month(month)}-01"
+        counts = Counter()
+
+        def event_rows(event_type):
+            # Месяц не загружается в память целиком: строки читаются страницами и сразу раскладываются по колонкам
+            cursor = conn.execute(
+                "SELECT id, user_id, event_type, timestamp FROM analytics "
+                "WHERE event_type = ? AND timestamp >= ? AND timestamp < ? ORDER BY id",
+                (event_type, start, end)
+            )
+            while True:
+                page = cursor.fetchmany(EXPORT_PAGE_ROWS)
+                if not page:
+                    return
+                counts[event_type] += len(page)
+                yield from page
+
+        # Выборка по каждому типу идёт по индексу, слияние по id даёт общий порядок строк файла
+        event_types = [event_type for (event_type,) in conn.execute("SELECT DISTINCT event_type FROM daily_event_counts").fetchall()]
+        data, ids = encode_partition(month, heapq.merge(*(event_rows(event_type) for event_type in event_types)))
+        if not ids:
+            return None
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+        return ids, len(data), hashlib.sha256(data).hexdigest(), dict(counts)
+
+    async def run(self, now: datetime = None) -> int:
+        """Архивирует и удаляет все подходящие месяцы. Возвращает число перенесённых строк."""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        # Доводим до конца удаление, прерванное перезапуском
+        for month, part, path in await self.db.fetchall(
+            "SELECT month, part, path FROM analytics_archive_partitions WHERE deleted = 0"
+        ):
+            ids = array("q", (row[0] for row in read_partition(path)))
+            await self._delete(month, part, ids)
+
+        moved = 0
+        for month in await self.db.read(self._months, self.cutoff(now)):
+            row = await self.db.fetchone("SELECT COALESCE(MAX(part), 0) FROM analytics_archive_partitions WHERE month = ?", (month,))
+            part = row[0] + 1
+            path = os.path.abspath(os.path.join(self.archive_dir, f"analytics-{month}.part{part}.bin"))
+            exported = await self.db.read(self._export, month, path)
+            if exported is None:
+                continue
+            ids, size, digest, counts = exported
+            await self.db.execute(
+                "INSERT INTO analytics_archive_partitions (month, part, path, rows, bytes, sha256, event_counts, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (month, part, path, len(ids), size, digest, json.dumps(counts, ensure_ascii=False), time.time())
+            )
+            self.archived_rows += len(ids)
+            logging.info(f"Аналитика за {month}: {len(ids)} событий перенесено в архив {path} ({size} байт)")
+            await self._delete(month, part, ids)
+            moved += len(ids)
+        return moved
+
+    async def _delete(self, month: str, part: int, ids: array):
+        for offset in range(0, len(ids), self.delete_batch):
+            chunk = ids[offset:offset + self.delete_batch]
+            self.deleted_rows += await self.db.executemany("DELETE FROM analytics WHERE id = ?", [(row_id,) for row_id in chunk])
+            # Пауза между пачками освобождает поток записи для сброса новых событий
+            await asyncio.sleep(self.pause)
+        await self.db.execute("UPDATE analytics_archive_partitions SET deleted = 1 WHERE month = ? AND part = ?", (month, part))
+
+    def metrics(self) -> dict:
+        return {"archived_rows": self.archived_rows, "deleted_rows": self.deleted_rows}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Архив аналитики")
+    parser.add_argument("--db", default="bot_data.db")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("status")
+    read = commands.add_parser("read")
+    read.add_argument("month", help="месяц в формате YYYY-MM")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    if args.command == "status":
+        for month, part, rows, size, deleted, path in conn.execute(
+            "SELECT month, part, rows, bytes, deleted, path FROM analytics_archive_partitions ORDER BY month, part"
+        ):
+            print(f"{month} part{part}: {rows} rows, {size} bytes{'' if deleted else ', delete pending'} -> {path}")
+        print(f"live rows: {conn.execute('SELECT COUNT(*) FROM analytics').fetchone()[0]}")
+    else:
+        writer = csv.writer(sys.stdout)
+        writer.writerow(["id", "user_id", "event_type", "timestamp"])
+        for (path,) in conn.execute(
+            "SELECT path FROM analytics_archive_partitions WHERE month = ? ORDER BY part", (args.month,)
+        ).fetchall():
+            writer.writerows(read_partition(path))
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
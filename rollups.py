@@ -0,0 +1,158 @@
+from collections import Counter
+
+# Дневные агрегаты аналитики.
+# daily_event_counts — число событий каждого типа за день;
+# daily_user_events — точное множество пользователей (и число их событий) по типу и дню;
+# user_last_event_day — последний день, когда пользователь присылал событие каждого типа
+# (тип '' — любое событие): одна строка на пользователя и тип.
+# Таблицы обновляются в той же транзакции, что и вставка пачки событий в analytics,
+# поэтому статистика за любой период считается без сканирования analytics.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS daily_event_counts (
+    event_type TEXT NOT NULL,
+    day TEXT NOT NULL,
+    events INTEGER NOT NULL,
+    PRIMARY KEY (event_type, day)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS daily_user_events (
+    event_type TEXT NOT NULL,
+    day TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    events INTEGER NOT NULL,
+    PRIMARY KEY (event_type, day, user_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_daily_user_events_day ON daily_user_events (day, user_id);
+CREATE TABLE IF NOT EXISTS user_last_event_day (
+    event_type TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    day TEXT NOT NULL,
+    PRIMARY KEY (event_type, user_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_user_last_event_day ON user_last_event_day (event_type, day);
+CREATE INDEX IF NOT EXISTS idx_analytics_type_ts_user ON analytics (event_type, timestamp, user_id);
+"""
+
+MIN_DAY = "0000-01-01"
+MAX_DAY = "9999-12-31"
+# Тип в user_last_event_day для «любого события»
+ANY_EVENT = ""
+
+
+def create_schema(conn):
+    conn.executescript(SCHEMA)
+
+
+def rebuild_if_empty(conn, archived_batches=()):
+    """Заполняет агрегаты из analytics, если они ещё ни разу не строились.
+
+    `archived_batches` — пачки событий, уже перенесённых из analytics в архив (см. retention).
+    """
+    if conn.execute("SELECT 1 FROM daily_event_counts LIMIT 1").fetchone():
+        if not conn.execute("SELECT 1 FROM user_last_event_day LIMIT 1").fetchone():
+            # Таблица последних дней появилась позже дневных агрегатов — заполняем её по ним
+            _fill_last_days(conn)
+        return
+    conn.execute("""
+        INSERT INTO daily_user_events (event_type, day, user_id, events)
+        SELECT event_type, substr(timestamp, 1, 10), user_id, COUNT(*)
+        FROM analytics GROUP BY 1, 2, 3
+    """)
+    conn.execute("""
+        INSERT INTO daily_event_counts (event_type, day, events)
+        SELECT event_type, day, SUM(events) FROM daily_user_events GROUP BY 1, 2
+    """)
+    _fill_last_days(conn)
+    for batch in archived_batches:
+        apply_events(conn, batch)
+
+
+def _fill_last_days(conn):
+    conn.execute("""
+        INSERT OR REPLACE INTO user_last_event_day (event_type, user_id, day)
+        SELECT event_type, user_id, MAX(day) FROM daily_user_events GROUP BY 1, 2
+    """)
+    conn.execute("""
+        INSERT OR REPLACE INTO user_last_event_day (event_type, user_id, day)
+        SELECT ?, user_id, MAX(day) FROM daily_user_events GROUP BY 2
+    """, (ANY_EVENT,))
+
+
+def apply_events(conn, batch):
+    """Добавляет пачку событий (user_id, event_type, timestamp) к дневным агрегатам."""
+    per_user = Counter((event_type, timestamp[:10], user_id) for user_id, event_type, timestamp in batch)
+    per_day = Counter()
+    for (event_type, day, _), events in per_user.items():
+        per_day[(event_type, day)] += events
+
+    conn.executemany("""
+        INSERT INTO daily_user_events (event_type, day, user_id, events) VALUES (?, ?, ?, ?)
+        ON CONFLICT (event_type, day, user_id) DO UPDATE SET events = events + excluded.events
+    """, [(*key, events) for key, events in per_user.items()])
+    conn.executemany("""
+        INSERT INTO daily_event_counts (event_type, day, events) VALUES (?, ?, ?)
+        ON CONFLICT (event_type, day) DO UPDATE SET events = events + excluded.events
+    """, [(*key, events) for key, events in per_day.items()])
+
+    last_days = {}
+    for event_type, day, user_id in per_user:
+        for key in ((event_type, user_id), (ANY_EVENT, user_id)):
+            if day > last_days.get(key, ""):
+                last_days[key] = day
+    conn.executemany("""
+        INSERT INTO user_last_event_day (event_type, user_id, day) VALUES (?, ?, ?)
+        ON CONFLICT (event_type, user_id) DO UPDATE SET day = MAX(day, excluded.day)
+    """, [(*key, day) for key, day in last_days.items()])
+
+
+def query_stats(conn, start_day: str = None, end_day: str = None):
+    """Статистика за дни [start_day, end_day] включительно (None — без ограничения).
+
+    Стоимость. Для периода без конца («7 дней», «30 дней», «всё время») /start, уникальные
+    и первые оплаты считаются по user_last_event_day: пользователь был в периоде, если его
+    последний день не раньше начала. Это диапазон индекса — по строке на подходящего
+    пользователя, сколько бы дней ни было в периоде. Для периода с концом (сегодня, вчера,
+    предыдущий период сравнения) и для «активных» (> 5 сообщений именно за период) запрос
+    идёт по daily_user_events: O(пользователе-дней в периоде).
+    """
+    period = (start_day or MIN_DAY, end_day or MAX_DAY)
+    cursor = conn.cursor()
+
+    def distinct_users(event_type):
+        if end_day is None:
+            cursor.execute(
+                "SELECT COUNT(*) FROM user_last_event_day WHERE event_type = ? AND day >= ?", (event_type, period[0])
+            )
+        elif event_type == ANY_EVENT:
+            cursor.execute("SELECT COUNT(DISTINCT user_id) FROM daily_user_events WHERE day BETWEEN ? AND ?", period)
+        else:
+            cursor.execute(
+                "SELECT COUNT(DISTINCT user_id) FROM daily_user_events WHERE event_type = ? AND day BETWEEN ? AND ?",
+                (event_type, *period)
+            )
+        return cursor.fetchone()[0]
+
+    start_users = distinct_users('start_command')
+    total_users = distinct_users(ANY_EVENT)
+
+    cursor.execute("""
+        SELECT COUNT(*) FROM (
+            SELECT user_id FROM daily_user_events
+            WHERE event_type = 'message_sent' AND day BETWEEN ? AND ?
+            GROUP BY user_id
+            HAVING SUM(events) > 5
+        )
+    """, period)
+    active_users = cursor.fetchone()[0]
+
+    first_payment_users = distinct_users('first_payment')
+
+    cursor.execute(
+        "SELECT COALESCE(SUM(events), 0) FROM daily_event_counts WHERE event_type = 'recurring_payment' AND day BETWEEN ? AND ?",
+        period
+    )
+    recurring_payments = cursor.fetchone()[0]
+
+    return {
+        "start": start_users, "total": total_users, "active": active_users,
+        "first_payment": first_payment_users, "recurring": recurring_payments
+    }
@@ -0,0 +1,112 @@
+"""Запуск бота: порт открывается сразу после импорта, подготовка идёт в фоне по шагам.
+
+Шаги (проверка схемы БД, запуск фоновых компонентов, прогрев соединений, установка вебхука)
+выполняются по порядку в фоновой задаче. Пока они не завершены:
+  /readyz отвечает 503 со списком оставшихся шагов — балансировщик не шлёт сюда трафик;
+  вебхуки Telegram и ЮKassa получают 503 — оба сервиса повторяют доставку, апдейты не теряются.
+/healthz отвечает 200, пока процесс жив и ни один шаг не упал.
+"""
+import asyncio
+import logging
+import time
+
+from aiohttp import web
+
+
+class Startup:
+    def __init__(self, gated_paths=()):
+        self.gated_paths = set(gated_paths)
+        self.steps = []
+        self.durations = {}
+        self.failed = None
+        self.ready_after = None
+        self._ready = asyncio.Event()
+        self._task = None
+        self._created = time.monotonic()
+
+    @property
+    def is_ready(self) -> bool:
+        return self._ready.is_set()
+
+    def step(self, name: str, fn):
+        """Добавляет шаг: `fn()` — корутина-функция. Шаги выполняются в порядке добавления."""
+        self.steps.append((name, fn))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def wait(self):
+        await self._ready.wait()
+
+    async def stop(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self):
+        for name, fn in self.steps:
+            started = time.monotonic()
+            try:
+                await fn()
+            except Exception as e:
+                self.failed = name
+                logging.exception(f"Шаг запуска «{name}» завершился ошибкой: {e}")
+                return
+            self.durations[name] = time.monotonic() - started
+            logging.info(f"Шаг запуска «{name}»: {self.durations[name]:.2f} с")
+        self.ready_after = time.monotonic() - self._created
+        self._ready.set()
+        logging.info(f"Бот готов к работе через {self.ready_after:.2f} с после создания приложения")
+
+    # --- HTTP ---
+    async def healthz(self, request: web.Request) -> web.Response:
+        if self.failed:
+            return web.json_response({"status": "failed", "step": self.failed}, status=500)
+        return web.json_response({"status": "ok"})
+
+    async def readyz(self, request: web.Request) -> web.Response:
+        if self.is_ready:
+            return web.json_response({"status": "ready"})
+        pending = [name for name, _ in self.steps if name not in self.durations]
+        return web.json_response({"status": "starting", "pending": pending, "failed": self.failed}, status=503)
+
+    @web.middleware
+    async def gate(self, request: web.Request, handler):
+        if request.path in self.gated_paths and not self.is_ready:
+            return web.Response(status=503, headers={"Retry-After": "1"})
+        return await handler(request)
+
+    def setup(self, app: web.Application):
+        """Подключает /healthz, /readyz и отказ 503 на gated_paths; шаги стартуют вместе с приложением.
+
+        Вызывается до setup_application, чтобы при остановке незавершённый запуск отменялся первым."""
+        app.middlewares.append(self.gate)
+        app.router.add_get("/healthz", self.healthz)
+        app.router.add_get("/readyz", self.readyz)
+
+        async def on_startup(app):
+            self.start()
+
+        async def on_shutdown(app):
+            await self.stop()
+
+        app.on_startup.append(on_startup)
+        app.on_shutdown.append(on_shutdown)
+
+    def metrics(self) -> dict:
+        return {
+            "ready": int(self.is_ready), "failed": int(self.failed is not None),
+            **{f"step_seconds_{name}": seconds for name, seconds in self.durations.items()},
+        }
+
+
+async def warm(name: str, coro):
+    """Прогрев соединения: ошибки только пишутся в лог, запуск они не останавливают."""
+    started = time.monotonic()
+    try:
+        await coro
+    except Exception as e:
+        logging.warning(f"Прогрев {name} не удался: {e!r}")
+        return
+    logging.info(f"Соединение с {name} прогрето за {time.monotonic() - started:.2f} с")
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import time
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+import metrics
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+async def chat_completion_chunks(client, call_site: str = "unknown", **kwargs):
+    """Запрашивает ответ модели в режиме stream=True и отдаёт текст по кусочкам.
+
+    Последним кусочком потока OpenAI присылает расход токенов (stream_options.include_usage) — он идёт в метрики.
+    """
+    started = time.perf_counter()
+    first_token = True
+    try:
+        stream = await client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **kwargs)
+        async for chunk in stream:
+            if chunk.usage is not None:
+                metrics.observe_openai_usage(call_site, chunk.usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                if first_token:
+                    first_token = False
+                    metrics.openai_ttft.observe(time.perf_counter() - started, call_site=call_site)
+                yield chunk.choices[0].delta.content
+    except Exception as e:
+        metrics.openai_errors.inc(call_site=call_site, error=type(e).__name__)
+        raise
+    finally:
+        metrics.openai_latency.observe(time.perf_counter() - started, call_site=call_site)
+
+
+async def chat_completion(client, call_site: str = "unknown", **kwargs):
+    """Обычный (не потоковый) запрос к модели с записью времени и расхода токенов в метрики."""
+    started = time.perf_counter()
+    try:
+        response = await client.chat.completions.create(**kwargs)
+    except Exception as e:
+        metrics.openai_errors.inc(call_site=call_site, error=type(e).__name__)
+        raise
+    finally:
+        metrics.openai_latency.observe(time.perf_counter() - started, call_site=call_site)
+    metrics.observe_openai_usage(call_site, response.usage)
+    return response
+
+
+def _split_point(text: str, limit: int) -> int:
+    """Позиция разреза длинного текста: по абзацу, строке или пробелу, если получится."""
+    for separator in ("\n\n", "\n", " "):
+        cut = text.rfind(separator, limit // 2, limit)
+        if cut != -1:
+            return cut + len(separator)
+    return limit
+
+
+class StreamingReply:
+    """Постепенно выводит ответ модели в сообщение Telegram.
+
+    Текст обновляется через edit_text не чаще, чем раз в `edit_interval` секунд.
+    Когда текст перестаёт помещаться в одно сообщение, оно фиксируется
+    и продолжение идёт в новом сообщении.
+    """
+
+    def __init__(self, placeholder, call_site: str, edit_interval: float = 1.5, limit: int = TELEGRAM_MESSAGE_LIMIT):
+        self.message = placeholder
+        self.call_site = call_site
+        self.edit_interval = edit_interval
+        self.limit = limit
+        self.text = ""
+        self.time_to_first_token = None
+        self._offset = 0
+        self._shown = None
+        self._last_edit = 0.0
+
+    async def _edit(self, text: str, wait: bool = False, **kwargs):
+        """Правит текущее сообщение. Промежуточные правки при флуд-контроле пропускаются,
+        окончательные (wait=True) дожидаются разрешения Telegram."""
+        while True:
+            try:
+                await self.message.edit_text(text, **kwargs)
+                break
+            except TelegramRetryAfter as e:
+                logging.warning(f"[{self.call_site}] Telegram просит подождать {e.retry_after} с перед правкой сообщения")
+                self._last_edit = time.monotonic() + e.retry_after
+                if not wait:
+                    return
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest as e:
+                if "message is not modified" not in str(e):
+                    raise
+                break
+        self._shown = text
+        self._last_edit = time.monotonic()
+
+    async def _roll_over(self, text: str):
+        """Фиксирует заполненные сообщения и переносит остаток текста в новые."""
+        while len(text) - self._offset > self.limit:
+            cut = self._offset + _split_point(text[self._offset:], self.limit)
+            await self._edit(text[self._offset:cut], wait=True)
+            self._offset = cut
+            self.message = await self.message.answer("…")
+            self._shown = "…"
+
+    async def stream(self, chunks) -> str:
+        """Читает кусочки текста и обновляет сообщение по мере их поступления."""
+        started = time.monotonic()
+        async for delta in chunks:
+            if self.time_to_first_token is None:
+                self.time_to_first_token = time.monotonic() - started
+            self.text += delta
+            await self._roll_over(self.text)
+            segment = self.text[self._offset:]
+            if segment.strip() and segment != self._shown and time.monotonic() - self._last_edit >= self.edit_interval:
+                await self._edit(segment)
+        logging.info(
+            f"[{self.call_site}] время до первого токена: {self.time_to_first_token or 0:.2f} с, "
+            f"весь ответ: {time.monotonic() - started:.2f} с, {len(self.text)} символов"
+        )
+        return self.text
+
+    async def finish(self, suffix: str = "", reply_markup=None, parse_mode=None):
+        """Выводит окончательный текст (с необязательным дополнением и клавиатурой)."""
+        full_text = self.text + suffix
+        await self._roll_over(full_text)
+        segment = full_text[self._offset:].strip() or "…"
+        try:
+            await self._edit(segment, wait=True, reply_markup=reply_markup, parse_mode=parse_mode)
+        except TelegramBadRequest:
+            if not parse_mode:
+                raise
+            # Разметку могло сломать разбиение на сообщения — показываем как есть
+            await self._edit(segment, wait=True, reply_markup=reply_markup)
@@ -0,0 +1,60 @@
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+
+class SubscriptionCache:
+    """Кэш сроков подписки пользователей (LRU, не больше `max_size` записей).
+
+    Хранит момент окончания подписки (или None, если её нет), поэтому ответ
+    «подписан ли пользователь» считается без обращения к БД. Любой код,
+    меняющий строку пользователя в `users`, обязан вызвать `invalidate()`.
+
+    Если бот работает в нескольких процессах, инвалидация в одном из них не видна
+    остальным — тогда записи живут не дольше `ttl` секунд.
+    """
+
+    def __init__(self, db, max_size: int = 50000, ttl: float = None):
+        self.db = db
+        self.max_size = max_size
+        self.ttl = ttl
+        self._expiries = OrderedDict()
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+
+    async def get_expiry(self, user_id: int):
+        entry = self._expiries.get(user_id)
+        if entry is not None and (self.ttl is None or time.monotonic() - entry[1] < self.ttl):
+            self.hits += 1
+            self._expiries.move_to_end(user_id)
+            return entry[0]
+
+        self.misses += 1
+        version = self._version
+        row = await self.db.fetchone(
+            "SELECT subscription_status, subscription_expires_at FROM users WHERE user_id = ?", (user_id,)
+        )
+        expires_at = None
+        if row:
+            status, expires_at_str = row
+            if status == 'paid' and expires_at_str:
+                expires_at = datetime.fromisoformat(expires_at_str)
+        # Если во время запроса была инвалидация, прочитанное значение могло устареть
+        if version == self._version:
+            self._expiries[user_id] = (expires_at, time.monotonic())
+            self._expiries.move_to_end(user_id)
+            while len(self._expiries) > self.max_size:
+                self._expiries.popitem(last=False)
+        return expires_at
+
+    async def is_subscribed(self, user_id: int) -> bool:
+        expires_at = await self.get_expiry(user_id)
+        return expires_at is not None and expires_at > datetime.utcnow()
+
+    def invalidate(self, user_id: int):
+        self._version += 1
+        self._expiries.pop(user_id, None)
+
+    def metrics(self) -> dict:
+        return {"size": len(self._expiries), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,131 @@
+"""Очередь платежей: восстановление после перезапуска.
+
+Запуск: python -m pytest tests
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import inbox
+from database import Database
+
+
+def make_db(tmp_path) -> str:
+    path = str(tmp_path / "bot_data.db")
+    conn = sqlite3.connect(path)
+    inbox.create_schema(conn)
+    conn.close()
+    return path
+
+
+async def run_until_processed(db, applied, expected: int, timeout: float = 5.0):
+    def apply(conn, payment):
+        applied.append(payment["id"])
+        return payment["id"]
+
+    async def on_applied(results):
+        pass
+
+    payment_inbox = inbox.PaymentInbox(db, apply, on_applied, workers=1, poll_interval=0.05)
+    await payment_inbox.start()
+    deadline = time.monotonic() + timeout
+    while len(applied) < expected and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    await payment_inbox.stop()
+    return payment_inbox
+
+
+def test_restart_resumes_processing_events(tmp_path):
+    path = make_db(tmp_path)
+    # Процесс остановился, пока событие разбиралось; схема уже актуальна, и create_schema при перезапуске не вызывается
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute(
+            "INSERT INTO payment_inbox (payment_id, payload, status, attempts, received_at) VALUES (?, ?, 'processing', 1, ?)",
+            ("pay-1", json.dumps({"id": "pay-1"}), time.time())
+        )
+    conn.close()
+
+    db = Database(path)
+    applied = []
+    payment_inbox = asyncio.run(run_until_processed(db, applied, expected=1))
+    status, attempts = asyncio.run(db.fetchone("SELECT status, attempts FROM payment_inbox WHERE payment_id = 'pay-1'"))
+    db.close()
+
+    assert applied == ["pay-1"]
+    assert (status, attempts) == ("done", 2)
+    assert payment_inbox.metrics()["processed"] == 1
+
+
+def test_done_events_are_not_replayed(tmp_path):
+    path = make_db(tmp_path)
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute(
+            "INSERT INTO payment_inbox (payment_id, payload, status, attempts, received_at, processed_at) "
+            "VALUES (?, ?, 'done', 1, ?, ?)",
+            ("pay-1", json.dumps({"id": "pay-1"}), time.time(), time.time())
+        )
+    conn.close()
+
+    db = Database(path)
+    applied = []
+    asyncio.run(run_until_processed(db, applied, expected=1, timeout=0.3))
+    db.close()
+
+    assert applied == []
+
+
+class FlakyDatabase:
+    """Database, у которой первые `failures` транзакций падают."""
+
+    def __init__(self, db, failures: int):
+        self.db = db
+        self.failures = failures
+
+    async def transaction(self, fn, *args):
+        if self.failures:
+            self.failures -= 1
+            raise sqlite3.OperationalError("database is locked")
+        return await self.db.transaction(fn, *args)
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+
+def test_worker_survives_database_errors(tmp_path):
+    path = make_db(tmp_path)
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute(
+            "INSERT INTO payment_inbox (payment_id, payload, received_at) VALUES (?, ?, ?)",
+            ("pay-1", json.dumps({"id": "pay-1"}), time.time())
+        )
+    conn.close()
+
+    db = Database(path)
+    applied = []
+
+    async def run():
+        flaky = FlakyDatabase(db, failures=0)
+        payment_inbox = inbox.PaymentInbox(flaky, lambda conn, payment: applied.append(payment["id"]), None,
+                                           workers=1, poll_interval=0.01)
+        await payment_inbox.start()
+        # Обработчик ещё не успел выбрать пачку: две первые выборки упадут
+        flaky.failures = 2
+        deadline = time.monotonic() + 5
+        while not applied and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        await payment_inbox.stop()
+        return payment_inbox
+
+    payment_inbox = asyncio.run(run())
+    db.close()
+
+    assert applied == ["pay-1"]
+    assert payment_inbox.metrics()["worker_errors"] == 2
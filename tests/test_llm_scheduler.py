@@ -0,0 +1,118 @@
+"""Планировщик запросов к OpenAI: порядок по приоритету и ожидание токенов.
+
+Запуск: python -m pytest tests
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_scheduler import LLMScheduler
+
+
+async def hold_slot(scheduler, call_site: str, release: asyncio.Event, tokens: int = 0):
+    async with scheduler.slot(call_site, tokens):
+        await release.wait()
+
+
+async def take_slot(scheduler, call_site: str, order: list, name: str = None, tokens: int = 0):
+    async with scheduler.slot(call_site, tokens):
+        order.append(name or call_site)
+
+
+def test_slots_follow_priority_then_arrival_order():
+    async def run():
+        scheduler = LLMScheduler(max_concurrency=1, tokens_per_minute=600000)
+        release = asyncio.Event()
+        holder = asyncio.create_task(hold_slot(scheduler, "session_turn", release))
+        await asyncio.sleep(0)
+        order = []
+        waiters = [
+            asyncio.create_task(take_slot(scheduler, call_site, order, name))
+            for call_site, name in [("summary", "summary"), ("unknown_site", "unknown_site"),
+                                    ("plan_generation", "plan_generation"), ("session_turn", "turn-1"),
+                                    ("session_opening", "opening"), ("session_turn", "turn-2")]
+        ]
+        await asyncio.sleep(0)
+        queued = scheduler.queue_depth
+        release.set()
+        await asyncio.gather(holder, *waiters)
+        return order, queued, scheduler
+
+    order, queued, scheduler = asyncio.run(run())
+
+    assert queued == 6
+    # Приоритет места вызова, внутри одного приоритета — порядок поступления; неизвестное место — последним
+    assert order == ["turn-1", "opening", "turn-2", "plan_generation", "summary", "unknown_site"]
+    assert (scheduler.active, scheduler.queue_depth, scheduler.max_queue_depth) == (0, 0, 6)
+
+
+def test_waiting_for_tokens_does_not_hold_a_slot_or_get_overtaken():
+    async def run():
+        # 600 токенов в минуту — 10 в секунду
+        scheduler = LLMScheduler(max_concurrency=2, tokens_per_minute=600)
+        release = asyncio.Event()
+        holder = asyncio.create_task(hold_slot(scheduler, "session_turn", release, tokens=600))
+        await asyncio.sleep(0)
+        order = []
+        started = time.monotonic()
+        waiting = asyncio.create_task(take_slot(scheduler, "session_turn", order, tokens=5))
+        cheap = asyncio.create_task(take_slot(scheduler, "summary", order))
+        await asyncio.sleep(0.1)
+        # Свободный слот есть, но первый в очереди ждёт токенов, а следующий его не обгоняет
+        during_wait = (scheduler.active, scheduler.queue_depth, list(order))
+        await asyncio.gather(waiting, cheap)
+        waited = time.monotonic() - started
+        release.set()
+        await holder
+        return order, during_wait, waited, scheduler
+
+    order, during_wait, waited, scheduler = asyncio.run(run())
+
+    assert during_wait == (1, 2, [])
+    assert order == ["session_turn", "summary"]
+    assert 0.4 <= waited < 2
+    assert scheduler.active == 0
+
+
+def test_request_larger_than_budget_waits_for_full_bucket():
+    async def run():
+        scheduler = LLMScheduler(max_concurrency=4, tokens_per_minute=600)
+        order = []
+        await take_slot(scheduler, "session_turn", order, "first", tokens=3)
+        started = time.monotonic()
+        # Оценка больше минутного бюджета урезается до него, иначе запрос не дождался бы никогда
+        await asyncio.wait_for(take_slot(scheduler, "session_turn", order, "huge", tokens=10000), timeout=5)
+        return order, time.monotonic() - started
+
+    order, waited = asyncio.run(run())
+
+    assert order == ["first", "huge"]
+    # Не хватает 3 токенов при 10 в секунду
+    assert 0.2 <= waited < 1.5
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def run():
+        scheduler = LLMScheduler(max_concurrency=1, tokens_per_minute=600000)
+        release = asyncio.Event()
+        holder = asyncio.create_task(hold_slot(scheduler, "session_turn", release))
+        await asyncio.sleep(0)
+        order = []
+        cancelled = asyncio.create_task(take_slot(scheduler, "session_turn", order, "cancelled"))
+        later = asyncio.create_task(take_slot(scheduler, "summary", order, "later"))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.gather(cancelled, return_exceptions=True)
+        queued = scheduler.queue_depth
+        release.set()
+        await asyncio.gather(holder, later)
+        return order, queued, scheduler
+
+    order, queued, scheduler = asyncio.run(run())
+
+    assert queued == 1
+    assert order == ["later"]
+    assert (scheduler.active, scheduler.queue_depth) == (0, 0)
@@ -0,0 +1,157 @@
+"""Маршрутизатор моделей: переход на запасную модель и автомат защиты.
+
+Запуск: python -m pytest tests
+"""
+import asyncio
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model_router import CLOSED, HALF_OPEN, OPEN, ModelRouter, Route
+
+COOLDOWN = 0.05
+
+
+def connection_error() -> openai.APIConnectionError:
+    return openai.APIConnectionError(request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions"))
+
+
+class FakeClient:
+    """Клиент OpenAI, у которого поведение каждой модели задаёт тест: ответ, исключение или задержка."""
+
+    def __init__(self, **behaviour):
+        self.behaviour = behaviour
+        self.calls = []
+        self.chat = SimpleNamespace(completions=self)
+
+    async def create(self, model: str, **kwargs):
+        self.calls.append(model)
+        outcome = self.behaviour.get(model, "ok")
+        if isinstance(outcome, BaseException):
+            raise outcome
+        if isinstance(outcome, float):
+            await asyncio.sleep(outcome)
+        return SimpleNamespace(model=model, usage=None)
+
+
+def make_router(client) -> ModelRouter:
+    return ModelRouter(client, {"session_turn": Route(["primary", "fallback"])}, Route(["fallback"]),
+                       min_samples=2, error_threshold=0.5, cooldown=COOLDOWN)
+
+
+def ask(router, times: int = 1) -> list:
+    async def run():
+        return [(await router.complete("session_turn", messages=[])).model for _ in range(times)]
+    return asyncio.run(run())
+
+
+def test_retryable_error_falls_back_to_next_model():
+    client = FakeClient(primary=connection_error())
+    router = make_router(client)
+
+    assert ask(router) == ["fallback"]
+    assert client.calls == ["primary", "fallback"]
+    assert router.fallbacks == 1
+    assert router.health["primary"].state == CLOSED
+
+
+def test_request_error_is_not_retried_on_another_model():
+    client = FakeClient(primary=ValueError("bad request"))
+    router = make_router(client)
+
+    with pytest.raises(ValueError):
+        ask(router)
+    assert client.calls == ["primary"]
+    assert router.fallbacks == 0
+
+
+def test_breaker_opens_and_skips_failing_model():
+    client = FakeClient(primary=connection_error())
+    router = make_router(client)
+
+    assert ask(router, times=2) == ["fallback", "fallback"]
+    assert router.health["primary"].state == OPEN
+    assert router.metrics()["open_models"] == 1
+
+    client.calls.clear()
+    assert ask(router) == ["fallback"]
+    # Отключённой модели запрос не отправляется вовсе
+    assert client.calls == ["fallback"]
+
+
+def test_successful_probe_closes_breaker():
+    client = FakeClient(primary=connection_error())
+    router = make_router(client)
+    ask(router, times=2)
+    assert router.health["primary"].state == OPEN
+
+    time.sleep(COOLDOWN * 2)
+    client.behaviour["primary"] = "ok"
+    client.calls.clear()
+
+    assert ask(router) == ["primary"]
+    assert client.calls == ["primary"]
+    assert router.health["primary"].state == CLOSED
+    # Статистика до отключения сброшена: одна новая ошибка не размыкает автомат снова
+    assert router.health["primary"].error_rate() == 0
+
+
+def test_failed_probe_reopens_breaker():
+    client = FakeClient(primary=connection_error())
+    router = make_router(client)
+    ask(router, times=2)
+    opened_at = router.health["primary"].opened_at
+
+    time.sleep(COOLDOWN * 2)
+    client.calls.clear()
+
+    assert ask(router) == ["fallback"]
+    assert client.calls == ["primary", "fallback"]
+    assert router.health["primary"].state == OPEN
+    assert router.health["primary"].opened_at > opened_at
+
+
+def test_half_open_model_gets_a_single_probe():
+    client = FakeClient(primary=connection_error())
+    router = make_router(client)
+    ask(router, times=2)
+    time.sleep(COOLDOWN * 2)
+    client.behaviour["primary"] = 0.1
+    client.calls.clear()
+
+    async def run():
+        first = asyncio.create_task(router.complete("session_turn", messages=[]))
+        await asyncio.sleep(0.01)
+        state = router.health["primary"].state
+        second = await router.complete("session_turn", messages=[])
+        return state, (await first).model, second.model
+
+    state, first, second = asyncio.run(run())
+
+    assert state == HALF_OPEN
+    # Пока пробный запрос не ответил, остальные идут к запасной модели
+    assert (first, second) == ("primary", "fallback")
+    assert client.calls == ["primary", "fallback"]
+    assert router.health["primary"].state == CLOSED
+
+
+def test_all_models_open_still_tries_primary():
+    client = FakeClient(primary=connection_error(), fallback=connection_error())
+    router = make_router(client)
+    for _ in range(2):
+        with pytest.raises(openai.APIConnectionError):
+            ask(router)
+    assert {health.state for health in router.health.values()} == {OPEN}
+
+    client.behaviour.update(primary="ok", fallback="ok")
+    client.calls.clear()
+
+    assert ask(router) == ["primary"]
+    assert client.calls == ["primary"]
@@ -0,0 +1,94 @@
+"""Промокоды: одноразовый код активируется ровно один раз при одновременных попытках.
+
+Запуск: python -m pytest tests
+"""
+import asyncio
+import os
+import sqlite3
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import promo
+from database import Database
+
+USERS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    subscription_status TEXT DEFAULT 'free',
+    subscription_expires_at DATETIME
+);
+"""
+USERS = 50
+
+
+def make_db(tmp_path, max_uses=1) -> tuple:
+    path = str(tmp_path / "bot_data.db")
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(USERS_SCHEMA)
+    promo.create_schema(conn)
+    conn.executemany("INSERT INTO users (user_id) VALUES (?)", [(user_id,) for user_id in range(USERS)])
+    with conn:
+        batch_id = promo.create_batch(conn, 1, 30, max_uses)
+    code = promo.batch_codes(conn, batch_id)[0]
+    conn.close()
+    return path, code
+
+
+def stored(path: str, code: str) -> tuple:
+    conn = sqlite3.connect(path)
+    redemptions = conn.execute("SELECT COUNT(*) FROM promo_redemptions WHERE code = ?", (code,)).fetchone()[0]
+    uses, is_active = conn.execute("SELECT uses, is_active FROM promo_codes WHERE code = ?", (code,)).fetchone()
+    paid = conn.execute("SELECT COUNT(*) FROM users WHERE subscription_status = 'paid'").fetchone()[0]
+    conn.close()
+    return redemptions, uses, is_active, paid
+
+
+def test_single_use_code_from_concurrent_tasks(tmp_path):
+    path, code = make_db(tmp_path)
+    db = Database(path)
+
+    async def run():
+        return await asyncio.gather(*(db.transaction(promo.redeem, code, user_id) for user_id in range(USERS)))
+
+    results = asyncio.run(run())
+    db.close()
+
+    assert sum(1 for days in results if days) == 1
+    assert stored(path, code) == (1, 1, 0, 1)
+
+
+def test_single_use_code_from_concurrent_connections(tmp_path):
+    # Отдельные соединения в потоках — как несколько процессов бота над одной базой
+    path, code = make_db(tmp_path)
+
+    def redeem(user_id):
+        conn = sqlite3.connect(path, timeout=10)
+        try:
+            with conn:
+                return promo.redeem(conn, code, user_id)
+        finally:
+            conn.close()
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        results = list(pool.map(redeem, range(USERS)))
+
+    assert sum(1 for days in results if days) == 1
+    assert stored(path, code) == (1, 1, 0, 1)
+
+
+def test_multi_use_code_stops_at_limit_and_once_per_user(tmp_path):
+    path, code = make_db(tmp_path, max_uses=3)
+    db = Database(path)
+
+    async def run():
+        attempts = [db.transaction(promo.redeem, code, user_id % 10) for user_id in range(USERS)]
+        return await asyncio.gather(*attempts)
+
+    results = asyncio.run(run())
+    db.close()
+
+    assert sum(1 for days in results if days) == 3
+    assert stored(path, code) == (3, 3, 0, 3)